@@ -1,28 +1,81 @@
 #!/usr/bin/env python3
 # Kyle Fitzsimmons, 2018
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 import dateutil.parser
+import itertools
 import json
 import logging
 import os
 import shutil
+import sys
 import time
 import unicodedata
 
+import checksums
 import cold_storage
 import csv_formatters
 import database
 import emailer
 import fileio
+import metrics
+import pipeline
+import planner
+import profiling
+import prometheus
+import seekable
+import trackfile
 import webpage
 
 
 ## GLOBALS
 CFG_FN = './config.json'
+PIPELINE_DEFAULTS = {
+    'queue_size': 4,
+    'batch_size': 50000,
+    'format_workers': 1,
+    'compress_workers': 2
+}
+# `archive.batch`: inactive surveys estimated at no more than `max_rows` rows are
+# exported together, up to `max_surveys` per batch, when at least `min_surveys`
+# of them qualify
+BATCH_DEFAULTS = {
+    'max_rows': 50000,
+    'min_surveys': 2,
+    'max_surveys': 100
+}
+COPY_TABLES = ['mobile_users', 'mobile_survey_responses', 'mobile_coordinates',
+               'mobile_prompt_responses', 'mobile_cancelled_prompt_responses']
+# (table, json columns, float columns) of each table copied to the .sqlite export
+SQLITE_TABLES = [
+    ('mobile_users', None, None),
+    ('mobile_survey_responses', ['response'], None),
+    ('mobile_coordinates', None, [
+        'latitude', 'longitude', 'altitude', 'speed', 'direction', 'h_accuracy',
+        'v_accuracy', 'acceleration_x', 'acceleration_y', 'acceleration_z']),
+    ('mobile_prompt_responses', ['response'], ['latitude', 'longitude']),
+    ('mobile_cancelled_prompt_responses', None, ['latitude', 'longitude'])
+]
+LOCATIONS_COLS = ['location_home', 'location_work', 'location_study']
+SURVEY_TIMESTAMP_COLS = ['created_at', 'modified_at']
+SURVEY_EXCLUDE_COLS = ['id', 'survey_id', 'mobile_id', 'response']
+COORDINATES_HEADER = ['uuid', 'latitude', 'longitude', 'altitude', 'speed', 'direction',
+                      'h_accuracy', 'v_accuracy', 'acceleration_x', 'acceleration_y', 'acceleration_z',
+                      'mode_detected', 'point_type', 'timestamp_UTC', 'timestamp_epoch']
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Archive inactive Itinerum surveys.')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile each stage to <output_dir>/profiles (see `profile` config)')
+    parser.add_argument('--plan', action='store_true',
+                        help='print the estimated export schedule without exporting anything')
+    return parser.parse_args(args)
+
+
 def load_config(cfg_fn):
     '''Load a configuration JSON to Python dict.'''
     cfg = None
@@ -46,13 +99,92 @@ def filter_inactive_surveys(cfg, surveys_latest_activity):
                       surveys_latest_activity)
 
 
-def copy_psql_sqlite(source_db, dest_db, table_name, survey_id, json_cols=None, float_cols=None):
+def survey_time_spans(source_db, exports_db, survey_ids):
+    '''Return {survey_id: (start, end)} epoch spans of recorded coordinates for
+       every survey. Spans are cached in the exports db with each survey's last
+       seen coordinate id so later runs only aggregate newer coordinates.'''
+    def _epoch(ts):
+        if ts:
+            return int(ts.timestamp())
+
+    def _merge(a, b, fn):
+        values = [v for v in (a, b) if v is not None]
+        if values:
+            return fn(values)
+
+    cached = exports_db.fetch_survey_spans()
+    since_ids = {_id: cached[_id][2] for _id in survey_ids if _id in cached}
+    spans = source_db.time_spans(survey_ids, since_ids=since_ids)
+
+    records = []
+    for survey_id, (start, end, max_id) in spans.items():
+        cached_start, cached_end, cached_max_id = cached.get(survey_id, (None, None, None))
+        records.append((survey_id,
+                        _merge(cached_start, _epoch(start), min),
+                        _merge(cached_end, _epoch(end), max),
+                        _merge(cached_max_id, max_id, max)))
+    exports_db.upsert_many('survey_spans',
+                           ['survey_id', 'survey_start', 'survey_end', 'max_coordinate_id'],
+                           records)
+
+    cached.update({record[0]: record[1:] for record in records})
+    return {_id: cached[_id][:2] if _id in cached else (None, None) for _id in survey_ids}
+
+
+def chunk_sizer(name, pipe, pipeline_cfg):
+    '''Return a `pipeline.ChunkSizer` for a pipeline's fetches when a
+       `memory_budget_mb` is configured, otherwise None for fixed chunks split
+       into `batch_size` batches. Each fetched chunk is passed through as one
+       batch, so the budget must hold every batch in flight plus the chunk
+       being fetched, twice over for the raw and formatted copies.'''
+    if not pipeline_cfg.get('memory_budget_mb'):
+        return None
+    return pipeline.ChunkSizer(name, pipeline_cfg['memory_budget_mb'],
+                               buffers=(pipe.max_inflight + 1) * 2,
+                               target_seconds=pipeline_cfg.get('fetch_seconds', 1.0))
+
+
+def copy_psql_sqlite(source_db, dest_db, table_name, survey_id, json_cols=None, float_cols=None,
+                     pipeline_cfg=PIPELINE_DEFAULTS, counter=None):
     '''Read the colums from existing PostgreSQL table, create the output SQLite 
-       table, and copy all rows for a particular `survey_id` from input to output dbs.'''
+       table, and copy all rows for a particular `survey_id` from input to output dbs.
+       With `raw_types` in `pipeline_cfg`, rows are fetched as tuples decoded by
+       the cursor's typecasters instead of formatted from `DictRow`s; with
+       `binary_copy`, they are streamed by a binary COPY and decoded in bulk.
+       Fetched rows are counted by a `pipeline.ByteCounter` when given.'''
     cols = source_db.table_schema(table_name)
     dest_db.generate_table(table_name, cols)
-    rows = source_db.select_all(table_name, survey_id, json_cols, float_cols)
-    dest_db.insert_many(table_name, cols, rows)
+
+    def _format(rows):
+        return [database.format_sqlite_row(row, json_cols, float_cols) for row in rows]
+
+    def _write(rows):
+        dest_db.insert_many(table_name, cols, rows)
+
+    copy = pipeline.Pipeline(table_name, queue_size=pipeline_cfg['queue_size'])
+    sizer = chunk_sizer(table_name, copy, pipeline_cfg)
+    if pipeline_cfg.get('binary_copy'):
+        # a single COPY streams the whole table, so there are no fetches to size
+        sizer = None
+        chunks = source_db.copy_binary_chunks(table_name, survey_id,
+                                              source_db.table_types(table_name),
+                                              batch_size=pipeline_cfg['batch_size'])
+    elif pipeline_cfg.get('raw_types'):
+        # rows arrive as tuples already in SQLite form, so there is no format stage
+        chunks = source_db.select_all_raw_chunks(table_name, survey_id,
+                                                 [name for name, _ in cols], sizer=sizer)
+    else:
+        copy.add_stage(table_name + ' format', _format, workers=pipeline_cfg['format_workers'])
+        chunks = source_db.select_all_chunks(table_name, survey_id, sizer=sizer)
+    if counter:
+        chunks = counter.count(chunks)
+    stats = copy.run(chunks if sizer else pipeline.rebatch(chunks, pipeline_cfg['batch_size']),
+                     _write,
+                     source_name=table_name + ' fetch',
+                     sink_name=table_name + ' sqlite write')
+    if sizer:
+        sizer.log_summary()
+    return stats
 
 
 def create_psql_copy_table(source_db, table_name, survey_id, survey_name):
@@ -70,74 +202,156 @@ def drop_psql_copy_tables(source_db, survey_name, copy_tables):
         source_db.drop_table(temp_table_name)
 
 
-def dump_csv_survey_responses(source_db, csv_dir, survey_id, survey_name):
-    locations_cols = ['location_home', 'location_work', 'location_study']
-    timestamp_cols = ['created_at', 'modified_at']
-    exclude_cols = ['id', 'survey_id', 'mobile_id', 'response']
+def dump_psql(cfg, recorder, source_db, survey_id, survey_name):
+    '''Dump a survey's tables to .psql.gz through temporary copies of its rows
+       and return the dump's manifest entry.'''
+    psql_dump_fn = '{survey}.psql.gz'.format(survey=survey_name)
+    psql_dump_fp = os.path.join(cfg['archive']['output_dir'], psql_dump_fn)
+    logger.info('Export {survey} to {fn}'.format(survey=survey_name,
+                                                 fn=psql_dump_fn))
+    with recorder.stage('psql_dump', survey_id, survey_name) as stage:
+        create_psql_copy_table(source_db, 'mobile_users', survey_id, survey_name)
+        create_psql_copy_table(source_db, 'mobile_survey_responses', survey_id, survey_name)
+        create_psql_copy_table(source_db, 'mobile_coordinates', survey_id, survey_name)
+        create_psql_copy_table(source_db, 'mobile_prompt_responses', survey_id, survey_name)
+        create_psql_copy_table(source_db, 'mobile_cancelled_prompt_responses', survey_id, survey_name)
+        entry = fileio.dump_psql_copy_tables(psql_dump_fp, survey_name, **cfg['source_db'])
+        drop_psql_copy_tables(source_db, survey_name, COPY_TABLES)
+        stage.rows = entry['rows']
+        stage.bytes_read = entry['bytes']
+        stage.bytes_written = entry['compressed_bytes']
+        stage.compressed_bytes = stage.bytes_written
+        stage.artifact_bytes['psql.gz'] = stage.bytes_written
+    return entry
+
 
+def survey_responses_header(source_db, survey_id):
     mobile_users_cols = [col for col in source_db.table_cols('mobile_users')
-                         if col not in exclude_cols]
+                         if col not in SURVEY_EXCLUDE_COLS]
     survey_questions = source_db.fetch_survey_questions(survey_id)
     survey_question_cols = []
     for q in survey_questions:
         col = q['question_label']
-        if not col.lower() in locations_cols:
+        if not col.lower() in LOCATIONS_COLS:
             survey_question_cols.append(col)
 
-    header = csv_formatters.survey_response_header(mobile_users_cols,
-                                                   survey_question_cols,
-                                                   timestamp_cols,
-                                                   locations_cols,
-                                                   exclude_cols)
-    responses = source_db.fetch_survey_responses(survey_id)
+    return csv_formatters.survey_response_header(mobile_users_cols,
+                                                 survey_question_cols,
+                                                 SURVEY_TIMESTAMP_COLS,
+                                                 LOCATIONS_COLS,
+                                                 SURVEY_EXCLUDE_COLS)
+
+
+def write_csv_survey_responses(csv_dir, header, responses):
     csv_rows = []
     for user in responses:
         survey_response = user.get('response')
         # skip users who never completed a survey response
         if not survey_response:
             continue
-        row = csv_formatters.survey_response_row(header, user, timestamp_cols, locations_cols)
+        row = csv_formatters.survey_response_row(header, user, SURVEY_TIMESTAMP_COLS, LOCATIONS_COLS)
         csv_rows.append(row)
 
     fp = os.path.join(csv_dir, 'survey_responses.csv')
     fileio.write_csv(fp, header, csv_rows)
+    return len(csv_rows)
 
 
-def dump_csv_coordinates(source_db, csv_dir, survey_id, survey_name):
-    header = ['uuid', 'latitude', 'longitude', 'altitude', 'speed', 'direction',
-              'h_accuracy', 'v_accuracy', 'acceleration_x', 'acceleration_y', 'acceleration_z',
-              'mode_detected', 'point_type', 'timestamp_UTC', 'timestamp_epoch']
-    coordinates = source_db.fetch_coordinates(survey_id)
-    uuid_lookup = source_db.uuids(survey_id)
-    csv_rows = []
-    last_row = None  # filters points recorded as duplicates in database
-    csv_header = header
-    for point in coordinates:
+def dump_csv_survey_responses(source_db, csv_dir, survey_id, survey_name, counter=None):
+    header = survey_responses_header(source_db, survey_id)
+    responses = source_db.fetch_survey_responses(survey_id)
+    if counter:
+        counter.add(responses)
+    return write_csv_survey_responses(csv_dir, header, responses)
+
+
+def coordinate_rows(points, uuid_lookup):
+    rows = []
+    for point in points:
         point = dict(point)
         if int(point['latitude']) == 0 and int(point['longitude'] == 0):
             continue
         point['uuid'] = uuid_lookup[point['mobile_id']]
-        row = csv_formatters.coordinate_row(header, point)
+        rows.append(csv_formatters.coordinate_row(COORDINATES_HEADER, point))
+    return rows
+
+
+def write_csv_coordinates(csv_dir, points, uuid_lookup):
+    '''Write all of a (small) survey's coordinates to its coordinates.csv at
+       once, filtering points recorded as duplicates in database.'''
+    csv_rows = []
+    last_row = None
+    for row in coordinate_rows(points, uuid_lookup):
         if row != last_row:
             csv_rows.append(row)
-        last_row = row    
+        last_row = row
+
+    fp = os.path.join(csv_dir, 'coordinates.csv')
+    fileio.write_csv(fp, COORDINATES_HEADER, csv_rows)
+    return len(csv_rows)
+
 
-        if len(csv_rows) == 50000:
-            fp = os.path.join(csv_dir, 'coordinates.csv')
-            fileio.write_coordinates_csv(fp, csv_header, csv_rows)
-            csv_header = None
-            csv_rows = []
+def dump_csv_coordinates(source_db, csv_dir, survey_id, survey_name, pipeline_cfg=PIPELINE_DEFAULTS,
+                         counter=None):
+    uuid_lookup = source_db.uuids(survey_id)
     fp = os.path.join(csv_dir, 'coordinates.csv')
-    fileio.write_coordinates_csv(fp, csv_header, csv_rows)
-        
+    csv_header = COORDINATES_HEADER
+    last_row = None  # filters points recorded as duplicates in database
 
-def dump_csv_prompts(source_db, csv_dir, survey_id, survey_name):
+    def _format(points):
+        return coordinate_rows(points, uuid_lookup)
+
+    # duplicates are filtered by the writer since it receives rows in order
+    def _write(rows):
+        nonlocal csv_header, last_row
+        csv_rows = []
+        for row in rows:
+            if row != last_row:
+                csv_rows.append(row)
+            last_row = row
+        fileio.write_coordinates_csv(fp, csv_header, csv_rows)
+        csv_header = None
+
+    dump = pipeline.Pipeline('coordinates', queue_size=pipeline_cfg['queue_size'])
+    dump.add_stage('coordinates format', _format, workers=pipeline_cfg['format_workers'])
+    sizer = chunk_sizer('coordinates', dump, pipeline_cfg)
+    chunks = source_db.fetch_coordinates_chunks(survey_id, sizer=sizer)
+    if counter:
+        chunks = counter.count(chunks)
+    stats = dump.run(chunks if sizer else pipeline.rebatch(chunks, pipeline_cfg['batch_size']),
+                     _write,
+                     source_name='coordinates fetch',
+                     sink_name='coordinates csv write')
+    if sizer:
+        sizer.log_summary()
+    if csv_header:
+        fileio.write_coordinates_csv(fp, csv_header, [])
+    return stats
+
+
+def tracks_output(cfg, survey_name):
+    return os.path.join(cfg['archive']['output_dir'], '{survey}.tracks'.format(survey=survey_name))
+
+
+def write_tracks(tracks_fp, points, uuid_lookup):
+    '''Write coordinates grouped by user in time order to a .tracks archive,
+       filtered like coordinates.csv. Returns the archive's manifest entry.'''
+    with trackfile.TrackWriter(tracks_fp) as writer:
+        for point in points:
+            if int(point['latitude']) == 0 and int(point['longitude'] == 0):
+                continue
+            writer.add(uuid_lookup[point['mobile_id']], point)
+        size = writer.close()
+    return checksums.manifest_entry(os.path.basename(tracks_fp), writer.rows, size, size,
+                                    writer.sha256)
+
+
+def write_csv_prompts(csv_dir, prompts):
     header = ['uuid', 'prompt_uuid', 'prompt_num', 'response', 'displayed_at_UTC',
               'displayed_at_epoch', 'recorded_at_UTC', 'recorded_at_epoch',
               'edited_at_UTC', 'edited_at_epoch', 'latitude', 'longitude']
 
     # group the prompt responses by displayed_at
-    prompts = source_db.fetch_prompt_responses(survey_id)
     grouped_prompts = csv_formatters.group_prompt_responses(prompts)
     
     csv_rows = []
@@ -147,6 +361,14 @@ def dump_csv_prompts(source_db, csv_dir, survey_id, survey_name):
 
     fp = os.path.join(csv_dir, 'prompt_responses.csv')
     fileio.write_csv(fp, header, csv_rows)
+    return len(csv_rows)
+
+
+def dump_csv_prompts(source_db, csv_dir, survey_id, survey_name, counter=None):
+    prompts = source_db.fetch_prompt_responses(survey_id)
+    if counter:
+        counter.add(prompts)
+    return write_csv_prompts(csv_dir, prompts)
 
 
 def _prompt_timestamps_by_uuid(prompts):
@@ -162,15 +384,11 @@ def _duplicate_prompt_exists(cancelled, answered_prompt_times):
     return displayed_at in answered_prompt_times.get(uuid, [])
 
 
-def dump_csv_cancelled_prompts(source_db, csv_dir, survey_id, survey_name):
+def write_csv_cancelled_prompts(csv_dir, cancelled_prompts, answered_prompt_times):
     header = ['uuid', 'prompt_uuid', 'latitude', 'longitude', 'displayed_at_UTC', 
               'displayed_at_epoch', 'cancelled_at_UTC', 'cancelled_at_epoch',
               'is_travelling']
 
-    prompts = source_db.fetch_prompt_responses(survey_id)
-    answered_prompt_times = _prompt_timestamps_by_uuid(prompts)
-
-    cancelled_prompts = source_db.fetch_cancelled_prompt_responses(survey_id)
     csv_rows = []
     for cancelled in cancelled_prompts:
         if _duplicate_prompt_exists(cancelled, answered_prompt_times):
@@ -180,126 +398,499 @@ def dump_csv_cancelled_prompts(source_db, csv_dir, survey_id, survey_name):
 
     fp = os.path.join(csv_dir, 'cancelled_prompts.csv')
     fileio.write_csv(fp, header, csv_rows)
+    return len(csv_rows)
+
+
+def dump_csv_cancelled_prompts(source_db, csv_dir, survey_id, survey_name, counter=None):
+    prompts = source_db.fetch_prompt_responses(survey_id)
+    answered_prompt_times = _prompt_timestamps_by_uuid(prompts)
+
+    cancelled_prompts = source_db.fetch_cancelled_prompt_responses(survey_id)
+    if counter:
+        counter.add(prompts)
+        counter.add(cancelled_prompts)
+    return write_csv_cancelled_prompts(csv_dir, cancelled_prompts, answered_prompt_times)
+
+
+def delete_survey(cfg, source_db, exports_db, survey_id):
+    '''Delete a survey from the source database, in checkpointed batches when
+       `delete_batches` is configured so an interrupted delete resumes where the
+       previous run stopped. Returns the number of mobile rows deleted.'''
+    def _checkpoint(table_name, last_id):
+        exports_db.upsert('delete_progress', ['survey_id', 'table_name', 'last_id'],
+                          [survey_id, table_name, last_id])
+
+    progress = exports_db.fetch_delete_progress(survey_id)
+    deleted = source_db.delete_survey(survey_id, progress=progress, checkpoint=_checkpoint,
+                                      **cfg.get('delete_batches', {}))
+    exports_db.clear_delete_progress(survey_id)
+    return deleted
+
+
+def compress_outputs(paths, pipeline_cfg=PIPELINE_DEFAULTS, artifacts=None):
+    '''Compress each output file or directory on its own compression worker,
+       appending the manifest entries of the created archives to `artifacts`
+       when given.'''
+    def _compress(batch):
+        return [fileio.create_archive(fp_or_dir) for fp_or_dir in batch]
+
+    def _compressed(batch):
+        if artifacts is not None:
+            artifacts.extend(entry for _, entry in batch)
+
+    compress = pipeline.Pipeline('compress', queue_size=pipeline_cfg['queue_size'])
+    compress.add_stage('compress', _compress, workers=pipeline_cfg['compress_workers'])
+    return compress.run([[p] for p in paths], _compressed,
+                        source_name='compress queue',
+                        sink_name='compressed')
+
+
+def ascii_survey_name(survey_name):
+    '''Coerce an accented survey_name to pure ASCII version appending an
+       underscore after any previously accented characters.'''
+    nfkd_form = unicodedata.normalize('NFKD', survey_name)
+    survey_name = u''.join([c if not unicodedata.combining(c)
+                            else '_' for c in nfkd_form])
+    return survey_name.replace(' ', '_').replace('\'', '')
+
+
+def export_survey(cfg, recorder, exports_sqlite_fp, survey_spans, run_timestamp,
+                  survey_id, survey_name, pipeline_cfg=PIPELINE_DEFAULTS):
+    '''Export, compress and optionally delete a single survey (steps 3-8). Each
+       call opens its own source and exports db connections so surveys can be
+       exported by parallel workers. Returns the survey's exports record and
+       whether it was deleted.'''
+    source_db = database.ItinerumDatabase(**cfg['source_db'], pool_cfg=cfg.get('pool'))
+    exports_db = database.ExportsDatabase(exports_sqlite_fp)
+    try:
+        return _export_survey(cfg, recorder, source_db, exports_db, survey_spans,
+                              run_timestamp, survey_id, survey_name, pipeline_cfg)
+    finally:
+        source_db.close()
+        exports_db.close()
+
+
+def sqlite_output(cfg, survey_name):
+    '''Return the path of a survey's .sqlite export, removing any previous one.'''
+    dest_sqlite_fn = '{}.sqlite'.format(survey_name)
+    dest_sqlite_fp = os.path.join(cfg['archive']['output_dir'], dest_sqlite_fn)
+    if os.path.exists(dest_sqlite_fp):
+        os.remove(dest_sqlite_fp)
+    logger.info('Export {survey} to {fn}'.format(survey=survey_name,
+                                                 fn=dest_sqlite_fp))
+    return dest_sqlite_fp
+
+
+def csv_output(cfg, survey_name):
+    '''Create an empty directory for a survey's .csv exports and return its path.'''
+    csv_dir_fn = '{survey}-csv'.format(survey=survey_name)
+    csv_dir = os.path.join(cfg['archive']['output_dir'], csv_dir_fn)
+    logger.info('Export {survey} as .csv files to {dir}'.format(survey=survey_name,
+                                                                dir=csv_dir))
+    if os.path.exists(csv_dir):
+        shutil.rmtree(csv_dir)
+    os.mkdir(csv_dir)
+    return csv_dir
+
+
+def _export_survey(cfg, recorder, source_db, exports_db, survey_spans, run_timestamp,
+                   survey_id, survey_name, pipeline_cfg):
+    # step 3: archive inactive surveys to .sqlite
+    dest_sqlite_fp = sqlite_output(cfg, survey_name)
+    dest_db = fileio.SQLiteDatabase(dest_sqlite_fp)
+    survey_stats = []
+    with recorder.stage('sqlite', survey_id, survey_name) as stage:
+        counter = pipeline.ByteCounter()
+        for table_name, json_cols, float_cols in SQLITE_TABLES:
+            table_stats = copy_psql_sqlite(source_db, dest_db, table_name, survey_id,
+                                           json_cols=json_cols, float_cols=float_cols,
+                                           pipeline_cfg=pipeline_cfg, counter=counter)
+            stage.rows += table_stats[-1].rows
+            stage.table_rows[table_name] = table_stats[-1].rows
+            survey_stats += table_stats
+        stage.bytes_read = counter.bytes
+        stage.bytes_written = fileio.path_size(dest_sqlite_fp)
+        table_rows = dict(stage.table_rows)
+
+    # step 4: copy inactive surveys to temp postgresql tables, dump
+    #         inactive surveys to .psql files and drop temp tables
+    artifacts = [dump_psql(cfg, recorder, source_db, survey_id, survey_name)]
+
+    # step 5: archive inactive surveys to .csv                 
+    csv_dir = csv_output(cfg, survey_name)
+    logger.info('Export survey_responses.csv')
+    with recorder.stage('csv_survey_responses', survey_id, survey_name) as stage:
+        counter = pipeline.ByteCounter()
+        stage.rows = dump_csv_survey_responses(source_db, csv_dir, survey_id, survey_name,
+                                               counter=counter)
+        stage.bytes_read = counter.bytes
+        stage.bytes_written = fileio.path_size(os.path.join(csv_dir, 'survey_responses.csv'))
+        csv_rows = stage.rows
+    logger.info('Export coordinates.csv')
+    with recorder.stage('csv_coordinates', survey_id, survey_name) as stage:
+        counter = pipeline.ByteCounter()
+        coordinates_stats = dump_csv_coordinates(source_db, csv_dir, survey_id, survey_name,
+                                                 pipeline_cfg=pipeline_cfg, counter=counter)
+        stage.rows = coordinates_stats[-1].rows
+        stage.bytes_read = counter.bytes
+        stage.bytes_written = fileio.path_size(os.path.join(csv_dir, 'coordinates.csv'))
+        survey_stats += coordinates_stats
+        csv_rows += stage.rows
+    if cfg['archive'].get('tracks'):
+        logger.info('Export {survey}.tracks'.format(survey=survey_name))
+        with recorder.stage('tracks', survey_id, survey_name) as stage:
+            entry = write_tracks(tracks_output(cfg, survey_name),
+                                 source_db.fetch_coordinate_tracks(survey_id),
+                                 source_db.uuids(survey_id))
+            artifacts.append(entry)
+            stage.rows = entry['rows']
+            stage.bytes_written = entry['compressed_bytes']
+            stage.compressed_bytes = stage.bytes_written
+            stage.artifact_bytes['tracks'] = stage.bytes_written
+    logger.info('Export prompt_responses.csv')
+    with recorder.stage('csv_prompts', survey_id, survey_name) as stage:
+        counter = pipeline.ByteCounter()
+        stage.rows = dump_csv_prompts(source_db, csv_dir, survey_id, survey_name, counter=counter)
+        stage.bytes_read = counter.bytes
+        stage.bytes_written = fileio.path_size(os.path.join(csv_dir, 'prompt_responses.csv'))
+        csv_rows += stage.rows
+    logger.info('Export cancelled_prompts.csv')
+    with recorder.stage('csv_cancelled_prompts', survey_id, survey_name) as stage:
+        counter = pipeline.ByteCounter()
+        stage.rows = dump_csv_cancelled_prompts(source_db, csv_dir, survey_id, survey_name,
+                                                counter=counter)
+        stage.bytes_read = counter.bytes
+        stage.bytes_written = fileio.path_size(os.path.join(csv_dir, 'cancelled_prompts.csv'))
+        csv_rows += stage.rows
+
+    return _finish_survey(cfg, recorder, source_db, exports_db, survey_spans, run_timestamp,
+                          survey_id, survey_name, dest_db, dest_sqlite_fp, csv_dir,
+                          pipeline_cfg, survey_stats, table_rows, csv_rows, artifacts)
+
+
+def _finish_survey(cfg, recorder, source_db, exports_db, survey_spans, run_timestamp,
+                   survey_id, survey_name, dest_db, dest_sqlite_fp, csv_dir,
+                   pipeline_cfg, survey_stats, table_rows, csv_rows, artifacts):
+    '''Record, compress and optionally delete an exported survey (steps 6-8).
+       `table_rows` are the rows written to each .sqlite table, `csv_rows` the
+       rows of the .csv files and `artifacts` the manifest entries of the files
+       already written, which are recorded with the compressed archives.'''
+    # spatial and temporal indexes on the .sqlite coordinates, built before it is compressed
+    if cfg['archive'].get('sqlite_indexes'):
+        logger.info('Index .sqlite coordinates')
+        with recorder.stage('sqlite_index', survey_id, survey_name) as stage:
+            stage.bytes_read = fileio.path_size(dest_sqlite_fp)
+            stage.rows = dest_db.index_coordinates()
+            stage.bytes_written = fileio.path_size(dest_sqlite_fp)
+
+    # step 6: write record to data-archiver master .sqlite to track export with
+    #         survey start, survey end, and total records included in export as
+    #         well as datetime of completed export
+    logger.info('Update master database with export record')
+    record_cols = ['timestamp', 'survey_id', 'survey_name', 'survey_start', 'survey_end']
+    record_cols += ['count_' + t for t in COPY_TABLES]
+
+    start_time, end_time = survey_spans[survey_id]
+    record = [run_timestamp, survey_id, survey_name, start_time, end_time]
+    record += [table_rows.get(t, 0) for t in COPY_TABLES]
+    exports_db.upsert('exports', record_cols, record)
+
+    # seekable copies of the .csv files, written before their directory is compressed
+    if cfg['archive'].get('seekable'):
+        seekable_cfg = cfg['archive']['seekable']
+        logger.info('Write seekable .csv.gz files and index')
+        with recorder.stage('seekable', survey_id, survey_name) as stage:
+            seekable_dir = os.path.join(cfg['archive']['output_dir'],
+                                        '{survey}-seekable'.format(survey=survey_name))
+            stage.bytes_read = fileio.path_size(csv_dir)
+            stage.rows = seekable.build(csv_dir, seekable_dir, manifest=artifacts,
+                                        **(seekable_cfg if isinstance(seekable_cfg, dict) else {}))
+            stage.bytes_written = fileio.path_size(seekable_dir)
+            stage.compressed_bytes = stage.bytes_written
+            stage.artifact_bytes['seekable'] = stage.bytes_written
+
+    # step 7: compress .csv dir and .sqlite database
+    logger.info('Compress output files and directories')
+    with recorder.stage('compress', survey_id, survey_name) as stage:
+        stage.bytes_read = fileio.path_size(dest_sqlite_fp) + fileio.path_size(csv_dir)
+        compressed = []
+        survey_stats += compress_outputs([dest_sqlite_fp, csv_dir], pipeline_cfg,
+                                         artifacts=compressed)
+        stage.rows = len(compressed)
+        for entry in compressed:
+            if entry['artifact'].endswith('.sqlite.gz'):
+                entry['rows'] = sum(table_rows.values())
+            else:
+                entry['rows'] = csv_rows
+            artifact = entry['artifact'][len(survey_name):].lstrip('.-')
+            stage.artifact_bytes[artifact] = entry['compressed_bytes']
+        stage.bytes_written = sum(stage.artifact_bytes.values())
+        stage.compressed_bytes = stage.bytes_written
+    pipeline.log_stats(survey_name, survey_stats)
+
+    # record the checksum, sizes and rows of every file written for the survey
+    exports_db.clear_artifacts(survey_name)
+    exports_db.upsert_many('artifacts', checksums.ARTIFACT_COLS,
+                           [[run_timestamp, survey_id, survey_name] +
+                            [entry[col] for col in checksums.ARTIFACT_COLS[3:]]
+                            for entry in artifacts + compressed])
+
+    # step 8: delete backed-up survey rows and relevant indexes from database
+    logger.info('Delete archived survey records from source database')
+    deleted = False
+    if cfg['delete'] is True:
+        with recorder.stage('delete', survey_id, survey_name) as stage:
+            stage.rows = delete_survey(cfg, source_db, exports_db, survey_id)
+        deleted = True
+    recorder.save(exports_db)
+    return record, deleted
+
+
+def split_by_survey(rows, survey_ids):
+    '''Split `rows` ordered by survey_id into a (survey_id, rows) group for
+       each of `survey_ids` in ascending order, with no rows for surveys
+       missing from `rows`. Each group must be consumed before the next.'''
+    groups = itertools.groupby(rows, key=lambda row: row['survey_id'])
+    group_id, group = next(groups, (None, None))
+    for survey_id in sorted(survey_ids):
+        if survey_id == group_id:
+            yield survey_id, group
+            group_id, group = next(groups, (None, None))
+        else:
+            yield survey_id, iter([])
+
+
+def batch_surveys(cfg, surveys):
+    '''Split the planned surveys (largest first) into batches of small surveys
+       for `export_batch` and the surveys to export one at a time.'''
+    batch_cfg = cfg['archive'].get('batch')
+    if not batch_cfg:
+        return [], list(surveys)
+    batch_cfg = dict(BATCH_DEFAULTS, **(batch_cfg if isinstance(batch_cfg, dict) else {}))
+    small = [s for s in surveys if s.rows <= batch_cfg['max_rows']]
+    if len(small) < batch_cfg['min_surveys']:
+        return [], list(surveys)
+    batches = [small[idx:idx + batch_cfg['max_surveys']]
+               for idx in range(0, len(small), batch_cfg['max_surveys'])]
+    return batches, [s for s in surveys if s.rows > batch_cfg['max_rows']]
+
+
+def export_batch(cfg, recorder, exports_sqlite_fp, survey_spans, run_timestamp,
+                 surveys, pipeline_cfg=PIPELINE_DEFAULTS):
+    '''Export, compress and optionally delete a batch of small surveys (steps
+       3-8), given as (survey_id, survey_name) pairs. Each source table is read
+       once for the whole batch instead of once per survey. Returns a list of
+       each survey's exports record and whether it was deleted.'''
+    source_db = database.ItinerumDatabase(**cfg['source_db'], pool_cfg=cfg.get('pool'))
+    exports_db = database.ExportsDatabase(exports_sqlite_fp)
+    try:
+        return _export_batch(cfg, recorder, source_db, exports_db, survey_spans,
+                             run_timestamp, surveys, pipeline_cfg)
+    finally:
+        source_db.close()
+        exports_db.close()
+
+
+def _export_batch(cfg, recorder, source_db, exports_db, survey_spans, run_timestamp,
+                  surveys, pipeline_cfg):
+    survey_names = dict(surveys)
+    survey_ids = sorted(survey_names)
+    logger.info('Export {num} surveys as a batch: {names}'.format(
+        num=len(survey_ids), names=', '.join(survey_names[i] for i in survey_ids)))
+
+    # step 3: archive the batch to one .sqlite per survey, reading each table
+    #         once ordered by survey so rows go to one survey's db at a time
+    dest_sqlite_fps = {i: sqlite_output(cfg, survey_names[i]) for i in survey_ids}
+    dest_dbs = {i: fileio.SQLiteDatabase(dest_sqlite_fps[i]) for i in survey_ids}
+    table_rows = {i: {} for i in survey_ids}
+    with recorder.stage('batch_sqlite') as stage:
+        counter = pipeline.ByteCounter()
+        for table_name, json_cols, float_cols in SQLITE_TABLES:
+            cols = source_db.table_schema(table_name)
+            rows = counter.count_rows(source_db.select_all_by_surveys(table_name, survey_ids))
+            for survey_id, survey_rows in split_by_survey(rows, survey_ids):
+                sqlite_rows = [database.format_sqlite_row(row, json_cols, float_cols)
+                               for row in survey_rows]
+                dest_dbs[survey_id].generate_table(table_name, cols)
+                inserted = dest_dbs[survey_id].insert_many(table_name, cols, sqlite_rows)
+                table_rows[survey_id][table_name] = inserted
+                stage.rows += inserted
+                stage.table_rows[table_name] = stage.table_rows.get(table_name, 0) + inserted
+        stage.bytes_read = counter.bytes
+        stage.bytes_written = sum(fileio.path_size(fp) for fp in dest_sqlite_fps.values())
+
+    # step 4: pg_dump works on per-survey copy tables, so dumps stay per survey
+    artifacts = {i: [dump_psql(cfg, recorder, source_db, i, survey_names[i])] for i in survey_ids}
+
+    # step 5: archive the batch to .csv, reading each query once; headers and
+    #         uuids are fetched first so no other query commits while the
+    #         server-side cursors are open
+    csv_dirs = {i: csv_output(cfg, survey_names[i]) for i in survey_ids}
+    headers = {i: survey_responses_header(source_db, i) for i in survey_ids}
+    uuid_lookup = source_db.uuids_by_surveys(survey_ids)
+    csv_rows = {i: 0 for i in survey_ids}
+    with recorder.stage('batch_csv') as stage:
+        counter = pipeline.ByteCounter()
+        responses = counter.count_rows(source_db.fetch_survey_responses_by_surveys(survey_ids))
+        for survey_id, survey_responses in split_by_survey(responses, survey_ids):
+            csv_rows[survey_id] += write_csv_survey_responses(csv_dirs[survey_id], headers[survey_id],
+                                                              survey_responses)
+        points = counter.count_rows(source_db.fetch_coordinates_by_surveys(survey_ids))
+        for survey_id, survey_points in split_by_survey(points, survey_ids):
+            if cfg['archive'].get('tracks'):
+                survey_points = list(survey_points)
+                tracks = sorted(survey_points, key=trackfile.track_order)
+                entry = write_tracks(tracks_output(cfg, survey_names[survey_id]), tracks, uuid_lookup)
+                artifacts[survey_id].append(entry)
+                stage.rows += entry['rows']
+                stage.bytes_written += entry['compressed_bytes']
+            csv_rows[survey_id] += write_csv_coordinates(csv_dirs[survey_id], survey_points, uuid_lookup)
+        # uuids are unique across surveys, so one lookup serves the whole batch
+        answered_prompt_times = {}
+        prompts = counter.count_rows(source_db.fetch_prompt_responses_by_surveys(survey_ids))
+        for survey_id, survey_prompts in split_by_survey(prompts, survey_ids):
+            survey_prompts = list(survey_prompts)
+            answered_prompt_times.update(_prompt_timestamps_by_uuid(survey_prompts))
+            csv_rows[survey_id] += write_csv_prompts(csv_dirs[survey_id], survey_prompts)
+        cancelled_prompts = counter.count_rows(
+            source_db.fetch_cancelled_prompt_responses_by_surveys(survey_ids))
+        for survey_id, survey_cancelled in split_by_survey(cancelled_prompts, survey_ids):
+            csv_rows[survey_id] += write_csv_cancelled_prompts(csv_dirs[survey_id], survey_cancelled,
+                                                               answered_prompt_times)
+        stage.rows += sum(csv_rows.values())
+        stage.bytes_read = counter.bytes
+        stage.bytes_written += sum(fileio.path_size(d) for d in csv_dirs.values())
+
+    # steps 6-8: record, compress and delete each survey
+    return [_finish_survey(cfg, recorder, source_db, exports_db, survey_spans, run_timestamp,
+                           survey_id, survey_names[survey_id], dest_dbs[survey_id],
+                           dest_sqlite_fps[survey_id], csv_dirs[survey_id], pipeline_cfg, [],
+                           table_rows[survey_id], csv_rows[survey_id], artifacts[survey_id])
+            for survey_id in survey_ids]
+
+
+def print_plan(cfg, source_db, exports_db):
+    '''Print the planned schedule of the inactive surveys without exporting.'''
+    surveys_latest_activity = source_db.latest_signups_by_survey()
+    inactive_surveys = [(survey_id, ascii_survey_name(survey_name))
+                        for survey_id, survey_name, _ in
+                        filter_inactive_surveys(cfg, surveys_latest_activity)]
+    export_plan = planner.plan(source_db, exports_db, inactive_surveys,
+                               cfg['archive']['output_dir'],
+                               workers=cfg['archive'].get('workers', 1),
+                               method=cfg['archive'].get('plan_estimates', 'stats'))
+    print('\n'.join(export_plan.summary()))
+    batches, _ = batch_surveys(cfg, export_plan.surveys)
+    if batches:
+        print('Batched: {num} surveys in {batches} batches'.format(
+            num=sum(len(batch) for batch in batches), batches=len(batches)))
 
 
 def main():
     run_timestamp = int(time.time())
 
+    args = parse_args()
     cfg = load_config(CFG_FN)
-    source_db = database.ItinerumDatabase(**cfg['source_db'])
+    source_db = database.ItinerumDatabase(**cfg['source_db'], pool_cfg=cfg.get('pool'))
     exports_sqlite_fp = './exports.sqlite'
     exports_db = database.ExportsDatabase(exports_sqlite_fp)
     exports_db.create_active_table()
     exports_db.create_exports_table()
+    exports_db.create_delete_progress_table()
+    exports_db.create_survey_spans_table()
+    exports_db.create_export_metrics_table()
+    exports_db.create_artifacts_table()
+    if args.plan:
+        print_plan(cfg, source_db, exports_db)
+        return
+    pipeline_cfg = dict(PIPELINE_DEFAULTS, **cfg.get('pipeline', {}))
+    if pipeline_cfg.get('memory_budget_mb'):
+        # the memory budget is shared by all export workers
+        pipeline_cfg['memory_budget_mb'] /= float(cfg['archive'].get('workers', 1))
+    profile_cfg = dict(cfg.get('profile', {}))
+    profiler = None
+    if profile_cfg.pop('enabled', False) or args.profile:
+        profiler = profiling.StageProfiler(cfg['archive']['output_dir'], run_timestamp,
+                                           **profile_cfg)
+    recorder = metrics.MetricsRecorder(run_timestamp, profiler=profiler)
+    exporter = None
+    if cfg.get('prometheus', {}).get('textfile'):
+        exporter = prometheus.TextfileExporter(recorder, **cfg['prometheus'])
+        exporter.start()
 
     # create output directory
     if not os.path.exists(cfg['archive']['output_dir']):
         logger.info('Creating output directory: %s' % cfg['archive']['output_dir'])
         os.mkdir(cfg['archive']['output_dir'])
 
+    deleted_surveys = 0
+    # finish batched deletes interrupted on a previous run before any partially
+    # deleted survey could be mistaken for an inactive one and exported again
+    if cfg['delete'] is True:
+        for survey_id in exports_db.fetch_interrupted_deletes():
+            logger.info('Resume interrupted delete of survey {id}'.format(id=survey_id))
+            with recorder.stage('delete', survey_id=survey_id) as stage:
+                stage.rows = delete_survey(cfg, source_db, exports_db, survey_id)
+            deleted_surveys += 1
+
     # step 1: fetch latest users for each survey and write to a timestamped
     #         .csv file
     logger.info('Finding most recent user by survey: %s' % cfg['archive']['output_dir'])
-    surveys_latest_activity = source_db.latest_signups_by_survey()
     latest_signups_fn = 'surveys-latest_users.csv'
     latest_signups_fp = os.path.join(cfg['archive']['output_dir'], latest_signups_fn)
-    header = ['survey id', 'survey name', 'last sign-up']
-    fileio.write_csv(latest_signups_fp, header, surveys_latest_activity)
+    with recorder.stage('latest_signups') as stage:
+        surveys_latest_activity = source_db.latest_signups_by_survey()
+        header = ['survey id', 'survey name', 'last sign-up']
+        fileio.write_csv(latest_signups_fp, header, surveys_latest_activity)
+        stage.rows = len(surveys_latest_activity)
+        stage.bytes_written = fileio.path_size(latest_signups_fp)
+    with recorder.stage('time_spans') as stage:
+        survey_spans = survey_time_spans(source_db, exports_db,
+                                         [row['survey_id'] for row in surveys_latest_activity])
+        stage.rows = len(survey_spans)
 
     # step 2: filter for surveys that have not been updated since config
-    #         inactivity date
-    inactive_surveys = filter_inactive_surveys(cfg, surveys_latest_activity)
-    copy_tables = ['mobile_users', 'mobile_survey_responses', 'mobile_coordinates',
-                   'mobile_prompt_responses', 'mobile_cancelled_prompt_responses']
+    #         inactivity date and plan their exports largest-first across workers
+    inactive_surveys = [(survey_id, ascii_survey_name(survey_name))
+                        for survey_id, survey_name, _ in
+                        filter_inactive_surveys(cfg, surveys_latest_activity)]
+    workers = cfg['archive'].get('workers', 1)
+    with recorder.stage('plan') as stage:
+        export_plan = planner.plan(source_db, exports_db, inactive_surveys,
+                                   cfg['archive']['output_dir'],
+                                   workers=workers,
+                                   method=cfg['archive'].get('plan_estimates', 'stats'))
+        stage.rows = len(inactive_surveys)
+    for line in export_plan.summary():
+        logger.info(line)
+    if not export_plan.fits_disk:
+        logger.error('Not enough free disk space in {dir} to export {num} surveys. Exiting...'.format(
+            dir=cfg['archive']['output_dir'], num=len(inactive_surveys)))
+        sys.exit(1)
+
+    # steps 3-8: export, compress and delete each survey, dispatching the
+    #            largest first to the next free worker; with `archive.batch`,
+    #            the small surveys are exported in batches after them
     email_records = []
-    for survey_id, survey_name, _ in inactive_surveys:
-        # coerce accented survey_name to pure ASCII version appending
-        # an underscore after any previously accented characters
-        nfkd_form = unicodedata.normalize('NFKD', survey_name)
-        survey_name = u''.join([c if not unicodedata.combining(c)
-                                else '_' for c in nfkd_form])
-        survey_name = survey_name.replace(' ', '_').replace('\'', '')
-
-        # step 3: archive inactive surveys to .sqlite
-        dest_sqlite_fn = '{}.sqlite'.format(survey_name)
-        dest_sqlite_fp = os.path.join(cfg['archive']['output_dir'], dest_sqlite_fn)
-        if os.path.exists(dest_sqlite_fp):
-            os.remove(dest_sqlite_fp)
-        logger.info('Export {survey} to {fn}'.format(survey=survey_name,
-                                                     fn=dest_sqlite_fp))
-        dest_db = fileio.SQLiteDatabase(dest_sqlite_fp)
-        copy_psql_sqlite(source_db, dest_db, 'mobile_users', survey_id)
-        copy_psql_sqlite(source_db, dest_db, 'mobile_survey_responses', survey_id,
-            json_cols=['response'])
-        copy_psql_sqlite(source_db, dest_db, 'mobile_coordinates', survey_id,
-            float_cols=[
-                'latitude', 'longitude', 'altitude', 'speed', 'direction', 'h_accuracy',
-                'v_accuracy', 'acceleration_x', 'acceleration_y', 'acceleration_z']
-        )
-        copy_psql_sqlite(source_db, dest_db, 'mobile_prompt_responses', survey_id,
-            json_cols=['response'], float_cols=['latitude', 'longitude'])
-        copy_psql_sqlite(source_db, dest_db, 'mobile_cancelled_prompt_responses', survey_id,
-            float_cols=['latitude', 'longitude'])
-
-        # step 4: copy inactive surveys to temp postgresql tables, dump
-        #         inactive surveys to .psql files and drop temp tables
-        psql_dump_fn = '{survey}.psql.gz'.format(survey=survey_name)
-        psql_dump_fp = os.path.join(cfg['archive']['output_dir'], psql_dump_fn)
-        logger.info('Export {survey} to {fn}'.format(survey=survey_name,
-                                                     fn=psql_dump_fn))
-        create_psql_copy_table(source_db, 'mobile_users', survey_id, survey_name)
-        create_psql_copy_table(source_db, 'mobile_survey_responses', survey_id, survey_name)
-        create_psql_copy_table(source_db, 'mobile_coordinates', survey_id, survey_name)
-        create_psql_copy_table(source_db, 'mobile_prompt_responses', survey_id, survey_name)
-        create_psql_copy_table(source_db, 'mobile_cancelled_prompt_responses', survey_id, survey_name)
-        fileio.dump_psql_copy_tables(psql_dump_fp, survey_name, **cfg['source_db'])
-        drop_psql_copy_tables(source_db, survey_name, copy_tables)
-
-        # step 5: archive inactive surveys to .csv                 
-        csv_dir_fn = '{survey}-csv'.format(survey=survey_name)
-        csv_dir = os.path.join(cfg['archive']['output_dir'], csv_dir_fn)
-        logger.info('Export {survey} as .csv files to {dir}'.format(survey=survey_name,
-                                                                    dir=csv_dir))
-        if os.path.exists(csv_dir):
-            shutil.rmtree(csv_dir)
-        os.mkdir(csv_dir)
-
-        logger.info('Export survey_responses.csv')
-        dump_csv_survey_responses(source_db, csv_dir, survey_id, survey_name)
-        logger.info('Export coordinates.csv')
-        dump_csv_coordinates(source_db, csv_dir, survey_id, survey_name)
-        logger.info('Export prompt_responses.csv')
-        dump_csv_prompts(source_db, csv_dir, survey_id, survey_name)
-        logger.info('Export cancelled_prompts.csv')
-        dump_csv_cancelled_prompts(source_db, csv_dir, survey_id, survey_name)
-
-        # step 6: write record to data-archiver master .sqlite to track export with
-        #         survey start, survey end, and total records included in export as
-        #         well as datetime of completed export
-        logger.info('Update master database with export record')
-        record_cols = ['timestamp', 'survey_id', 'survey_name', 'survey_start', 'survey_end']
-        record_cols += ['count_' + t for t in copy_tables]
-        
-        start_time = source_db.start_time(survey_id)
-        if start_time:
-            start_time = int(start_time.timestamp())
-        end_time = source_db.end_time(survey_id)
-        if end_time:
-            end_time = int(end_time.timestamp())
-        record = [run_timestamp, survey_id, survey_name, start_time, end_time]
-        record += [dest_db.count(t) for t in copy_tables]
-        exports_db.upsert('exports', record_cols, record)
-        email_records.append(record)
-
-        # step 7: compress .csv dir and .sqlite database
-        logger.info('Compress output files and directories')
-        fileio.create_archive(dest_sqlite_fp)
-        fileio.create_archive(csv_dir)
-
-        # step 8: delete backed-up survey rows and relevant indexes from database
-        logger.info('Delete archived survey records from source database')
-        if cfg['delete'] is True:
-            source_db.delete_survey(survey_id)
+    batches, single_surveys = batch_surveys(cfg, export_plan.surveys)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(export_survey, cfg, recorder, exports_sqlite_fp, survey_spans,
+                                   run_timestamp, survey.survey_id, survey.survey_name,
+                                   pipeline_cfg)
+                   for survey in single_surveys]
+        batch_futures = [executor.submit(export_batch, cfg, recorder, exports_sqlite_fp,
+                                         survey_spans, run_timestamp,
+                                         [(s.survey_id, s.survey_name) for s in batch],
+                                         pipeline_cfg)
+                         for batch in batches]
+        for future in futures:
+            record, deleted = future.result()
+            email_records.append(record)
+            deleted_surveys += int(deleted)
+        for future in batch_futures:
+            for record, deleted in future.result():
+                email_records.append(record)
+                deleted_surveys += int(deleted)
 
     # step 9: record active surveys information in exports db
     logger.info('Record active surveys information in exports db')
@@ -309,12 +900,7 @@ def main():
         active_cols = ['survey_name', 'survey_start', 'survey_last_update']
         active_rows = []
         for survey_id, survey_name, _ in active_surveys:
-            start_time = source_db.start_time(survey_id)
-            if start_time:
-                start_time = int(start_time.timestamp())
-            end_time = source_db.end_time(survey_id)
-            if end_time:
-                end_time = int(end_time.timestamp())
+            start_time, end_time = survey_spans[survey_id]
             active_rows.append((survey_name, start_time, end_time))
         exports_db.upsert_many('active', active_cols, active_rows)
 
@@ -322,7 +908,10 @@ def main():
     logger.info('Push .zip archives to S3 cold storage: {status}'.format(
         status=cfg['s3']['enabled']))
     if cfg['s3']['enabled'] is True:
-        cold_storage.push_archives_to_s3(cfg)
+        with recorder.stage('cold_storage') as stage:
+            stage.rows, stage.bytes_read, stage.bytes_written = cold_storage.push_archives_to_s3(cfg)
+            stage.compressed_bytes = stage.bytes_written
+    recorder.save(exports_db)
 
     # step 11: generate archive status webpage
     logger.info('Generate webpage with exports status table')
@@ -334,12 +923,24 @@ def main():
     emailer.send_message(export_timestamp=run_timestamp,
                          recipient=cfg['receiver_email']['address'],
                          sender_cfg=cfg['sender_email'],
-                         records=email_records)
+                         records=email_records,
+                         metrics=recorder.records())
 
-    # step 13: vacuum database to reclaim disk space
+    # step 13: vacuum the tables touched by deleted surveys to reclaim disk space;
+    #          `"vacuum": "full"` keeps the database-wide VACUUM FULL. This runs
+    #          after the notification, so its metrics are only kept in exports db
     logger.info('Vacuum database to free space from deleted records')
-    if cfg['vacuum'] is True:
-        source_db.vacuum()
+    if cfg['vacuum'] == 'full':
+        with recorder.stage('vacuum'):
+            source_db.vacuum()
+    elif cfg['vacuum'] is True and deleted_surveys:
+        with recorder.stage('vacuum') as stage:
+            results = source_db.maintain_tables(database.DELETE_SURVEY_TABLES,
+                                                **cfg.get('maintenance', {}))
+            stage.rows = sum(dead for _, _, dead, _ in results)
+    recorder.save(exports_db)
+    if exporter:
+        exporter.stop()
 
 if __name__ == '__main__':
     main()
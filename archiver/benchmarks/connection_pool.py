@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# Compare the per-survey metadata queries (`start_time`, `end_time`, `uuids`,
+# `table_schema`) when each call opens its own connection against borrowing
+# from the shared pool.
+#
+# Run from the `archiver` directory: python3 -m benchmarks.connection_pool
+import json
+import sys
+import time
+
+import psycopg2
+import psycopg2.extras
+
+import database
+
+
+CFG_FN = './config.json'
+ITERATIONS = 20
+
+
+def _connect(cfg):
+    return psycopg2.connect(cursor_factory=psycopg2.extras.DictCursor,
+                            application_name=database.APPLICATION_NAME + '-benchmark',
+                            **cfg['source_db'])
+
+
+def _run_queries(source_db, survey_id):
+    source_db.start_time(survey_id)
+    source_db.end_time(survey_id)
+    source_db.uuids(survey_id)
+    source_db.table_schema('mobile_coordinates')
+
+
+def bench_unpooled(cfg, survey_ids):
+    '''Reproduce the old behaviour of one `psycopg2.connect` per database object.'''
+    source_db = database.ItinerumDatabase.__new__(database.ItinerumDatabase)
+    t0 = time.time()
+    for _ in range(ITERATIONS):
+        for survey_id in survey_ids:
+            source_db._db_conn = _connect(cfg)
+            source_db._db_cur = source_db._db_conn.cursor()
+            _run_queries(source_db, survey_id)
+            source_db._db_conn.close()
+    source_db._db_conn = None
+    return time.time() - t0
+
+
+def bench_pooled(cfg, survey_ids):
+    t0 = time.time()
+    for _ in range(ITERATIONS):
+        for survey_id in survey_ids:
+            source_db = database.ItinerumDatabase(**cfg['source_db'], pool_cfg=cfg.get('pool'))
+            _run_queries(source_db, survey_id)
+            source_db.close()
+    return time.time() - t0
+
+
+def main():
+    with open(CFG_FN, 'r') as cfg_f:
+        cfg = json.load(cfg_f)
+    source_db = database.ItinerumDatabase(**cfg['source_db'], pool_cfg=cfg.get('pool'))
+    survey_ids = [row['survey_id'] for row in source_db.latest_signups_by_survey()]
+    source_db.close()
+    if not survey_ids:
+        print('No surveys found in source database.')
+        sys.exit(1)
+
+    calls = ITERATIONS * len(survey_ids)
+    unpooled = bench_unpooled(cfg, survey_ids)
+    pooled = bench_pooled(cfg, survey_ids)
+    print('surveys: {n} / iterations: {i}'.format(n=len(survey_ids), i=ITERATIONS))
+    print('unpooled: {t:.2f}s ({per:.2f}ms per survey)'.format(t=unpooled, per=unpooled / calls * 1000))
+    print('pooled:   {t:.2f}s ({per:.2f}ms per survey)'.format(t=pooled, per=pooled / calls * 1000))
+    print('connection overhead removed: {t:.2f}s'.format(t=unpooled - pooled))
+
+
+if __name__ == '__main__':
+    main()
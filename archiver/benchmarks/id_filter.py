@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# Compare the ways users_by_date restricts its queries to a set of mobile ids:
+# the original inlined `IN (...)` list, a bound array (`= ANY(...)`) and a temp
+# table. Each fetch query is run under EXPLAIN ANALYZE and reports the SQL size,
+# planning and execution time from PostgreSQL and the client round-trip time,
+# which also covers sending and parsing the query text.
+#
+# Run from the `archiver` directory:
+#   python3 -m benchmarks.id_filter --config bench_config.json --survey <name> \
+#       --cutoff-date 2018-03-01T00:00:00Z
+import argparse
+import json
+import os
+import time
+
+import dateutil.parser
+
+from benchmarks.micro import ARCHIVER_DIR, _load_module
+
+
+STRATEGIES = ['in_list', 'array', 'temp_table']
+QUERIES = [
+    ('select_all.mobile_coordinates', lambda db, ids: list(db.select_all('mobile_coordinates', ids))),
+    ('fetch_survey_responses', lambda db, ids: db.fetch_survey_responses(ids)),
+    ('fetch_coordinates', lambda db, ids: db.fetch_coordinates(ids)),
+    ('fetch_prompt_responses', lambda db, ids: db.fetch_prompt_responses(ids)),
+    ('fetch_cancelled_prompt_responses', lambda db, ids: db.fetch_cancelled_prompt_responses(ids))
+]
+
+
+def explain_database(users_database):
+    class ExplainDatabase(users_database.ItinerumDatabase):
+        '''Run fetch queries under EXPLAIN ANALYZE while `explain` is set,
+           recording the last plan's timings instead of returning rows.'''
+
+        explain = False
+        last = None
+
+        def _stream_query(self, query, params=None, **kwargs):
+            if not self.explain:
+                return super()._stream_query(query, params, **kwargs)
+            t0 = time.time()
+            self._db_cur.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + query, params)
+            plan, = self._db_cur.fetchone()
+            self.last = {
+                'sql_bytes': len(self._db_cur.query),
+                'planning_ms': round(plan[0]['Planning Time'], 3),
+                'execution_ms': round(plan[0]['Execution Time'], 3),
+                'round_trip_ms': round((time.time() - t0) * 1000, 3)
+            }
+            return iter([])
+    return ExplainDatabase
+
+
+def bench_strategy(db_class, cfg, strategy, mobile_ids, repeats=3):
+    id_filter_cfg = dict(cfg.get('id_filter', {}), strategy=strategy)
+    db = db_class(**cfg['source_db'], id_filter_cfg=id_filter_cfg)
+    results = []
+    try:
+        if strategy == 'temp_table':
+            t0 = time.time()
+            db._load_temp_mobile_ids(mobile_ids)
+            results.append({'strategy': strategy, 'query': 'load_temp_table',
+                            'round_trip_ms': round((time.time() - t0) * 1000, 3)})
+        for name, fetch in QUERIES:
+            best = None
+            for _ in range(repeats):
+                db.explain = True
+                fetch(db, mobile_ids)
+                db.explain = False
+                if best is None or db.last['round_trip_ms'] < best['round_trip_ms']:
+                    best = db.last
+            results.append(dict(best, strategy=strategy, query=name))
+    finally:
+        db.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark users_by_date mobile id filters.')
+    parser.add_argument('--config', default='./bench_config.json')
+    parser.add_argument('--survey', required=True)
+    parser.add_argument('--cutoff-date', default='2018-03-01T00:00:00Z')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', help='write the JSON report to this file')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as cfg_f:
+        cfg = json.load(cfg_f)
+    users_database = _load_module('users_by_date_database',
+                                  os.path.join(ARCHIVER_DIR, 'users_by_date', 'database.py'))
+    db_class = explain_database(users_database)
+
+    db = db_class(**cfg['source_db'])
+    mobile_ids = db.latest_signups_in_survey(args.survey, dateutil.parser.parse(args.cutoff_date))
+    db.close()
+
+    report = {'survey': args.survey, 'mobile_ids': len(mobile_ids), 'results': []}
+    for strategy in STRATEGIES:
+        report['results'].extend(bench_strategy(db_class, cfg, strategy, mobile_ids,
+                                                repeats=args.repeats))
+
+    print('{:<36} {:<12} {:>12} {:>12} {:>12} {:>12}'.format(
+        'query', 'strategy', 'SQL bytes', 'plan ms', 'exec ms', 'round trip'))
+    for r in report['results']:
+        print('{:<36} {:<12} {:>12} {:>12} {:>12} {:>12}'.format(
+            r['query'], r['strategy'], r.get('sql_bytes', ''), r.get('planning_ms', ''),
+            r.get('execution_ms', ''), r['round_trip_ms']))
+    if args.output:
+        with open(args.output, 'w') as report_f:
+            json.dump(report, report_f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+# Micro-benchmarks of the per-row formatting and writing functions of both the
+# main archiver and users_by_date on fixed synthetic fixtures. Reports ns/row,
+# peak traced bytes/row and blocks left allocated per row, and compares against
+# a stored baseline.
+#
+# Run from the `archiver` directory:
+#   python3 -m benchmarks.micro                   # compare against the baseline
+#   python3 -m benchmarks.micro --save-baseline   # record a new baseline
+import argparse
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from decimal import Decimal
+import importlib.util
+import json
+import os
+import platform
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import psycopg2.extensions
+import psycopg2.extras
+import pytz
+
+import csv_formatters
+import database
+import fileio
+import pgbinary
+
+
+ARCHIVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_FP = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'micro_baseline.json')
+NUM_ROWS = 20000
+REPEATS = 5
+
+COORDINATE_HEADER = ['uuid', 'latitude', 'longitude', 'altitude', 'speed', 'direction',
+                     'h_accuracy', 'v_accuracy', 'acceleration_x', 'acceleration_y',
+                     'acceleration_z', 'mode_detected', 'point_type', 'timestamp_UTC',
+                     'timestamp_epoch']
+PROMPT_HEADER = ['uuid', 'prompt_uuid', 'prompt_num', 'response', 'displayed_at_UTC',
+                 'displayed_at_epoch', 'recorded_at_UTC', 'recorded_at_epoch',
+                 'edited_at_UTC', 'edited_at_epoch', 'latitude', 'longitude']
+CANCELLED_HEADER = ['uuid', 'prompt_uuid', 'latitude', 'longitude', 'displayed_at_UTC',
+                    'displayed_at_epoch', 'cancelled_at_UTC', 'cancelled_at_epoch',
+                    'is_travelling']
+LOCATION_COLS = ['location_home', 'location_work', 'location_study']
+TIMESTAMP_COLS = ['created_at', 'modified_at']
+SQLITE_COORDINATE_COLS = [('id', 'INTEGER'), ('survey_id', 'INTEGER'), ('mobile_id', 'INTEGER'),
+                          ('latitude', 'REAL'), ('longitude', 'REAL'), ('altitude', 'REAL'),
+                          ('speed', 'REAL'), ('direction', 'REAL'), ('h_accuracy', 'REAL'),
+                          ('v_accuracy', 'REAL'), ('acceleration_x', 'REAL'),
+                          ('acceleration_y', 'REAL'), ('acceleration_z', 'REAL'),
+                          ('mode_detected', 'INTEGER'), ('point_type', 'INTEGER'),
+                          ('timestamp', 'DATETIME')]
+
+
+def _load_module(name, fp):
+    spec = importlib.util.spec_from_file_location(name, fp)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class _DictCursor(object):
+    '''Just enough of a cursor for psycopg2's DictRow to be built offline.'''
+    def __init__(self, cols):
+        self.index = OrderedDict((col, idx) for idx, col in enumerate(cols))
+        self.description = cols
+
+
+def _dict_rows(cols, values):
+    cursor = _DictCursor(cols)
+    rows = []
+    for row_values in values:
+        row = psycopg2.extras.DictRow(cursor)
+        row[:] = row_values
+        rows.append(row)
+    return rows
+
+
+def _decimal(rng, lo, hi, places=6):
+    return Decimal('{:.{p}f}'.format(rng.uniform(lo, hi), p=places))
+
+
+def build_fixtures(num_rows=NUM_ROWS, seed=0):
+    rng = random.Random(seed)
+    tz = pytz.timezone('America/Montreal')
+    start = tz.localize(datetime(2018, 5, 1, 8, 0, 0, 123456))
+    uuids = ['{:032x}'.format(rng.getrandbits(128)) for _ in range(50)]
+
+    coordinates = []
+    for idx in range(num_rows):
+        ts = start + timedelta(seconds=idx * 5)
+        coordinates.append({
+            'id': idx, 'mobile_id': idx % 50, 'uuid': uuids[idx % 50],
+            'latitude': _decimal(rng, 45.4, 45.6, 7), 'longitude': _decimal(rng, -73.7, -73.5, 7),
+            'altitude': _decimal(rng, 0, 120), 'speed': _decimal(rng, 0, 30),
+            'direction': _decimal(rng, 0, 360), 'h_accuracy': rng.uniform(3, 65),
+            'v_accuracy': rng.uniform(3, 30), 'acceleration_x': _decimal(rng, -1, 1),
+            'acceleration_y': _decimal(rng, -1, 1), 'acceleration_z': _decimal(rng, 8, 11),
+            'mode_detected': rng.choice([None, 1, 2, 3]), 'point_type': rng.choice([0, 1, 2]),
+            'timestamp_UTC': ts, 'timestamp_epoch': int(ts.timestamp())
+        })
+
+    prompts = []
+    for idx in range(num_rows):
+        displayed_at = start + timedelta(seconds=(idx // 2) * 600)
+        prompts.append({
+            'uuid': uuids[idx % 50], 'prompt_uuid': '{:032x}'.format(idx // 2),
+            'prompt_num': idx % 2,
+            'response': [rng.choice(['walk', 'bike', 'car', 'transit’s'])],
+            'latitude': _decimal(rng, 45.4, 45.6, 10), 'longitude': _decimal(rng, -73.7, -73.5, 10),
+            'displayed_at_UTC': displayed_at, 'displayed_at_epoch': int(displayed_at.timestamp()),
+            'recorded_at_UTC': displayed_at + timedelta(seconds=20),
+            'recorded_at_epoch': int(displayed_at.timestamp()) + 20,
+            'edited_at_UTC': None, 'edited_at_epoch': None
+        })
+
+    cancelled = []
+    for idx in range(num_rows):
+        displayed_at = start + timedelta(seconds=idx * 600)
+        cancelled.append({
+            'uuid': uuids[idx % 50], 'prompt_uuid': '{:032x}'.format(idx),
+            'latitude': _decimal(rng, 45.4, 45.6, 10), 'longitude': _decimal(rng, -73.7, -73.5, 10),
+            'displayed_at_UTC': displayed_at, 'displayed_at_epoch': int(displayed_at.timestamp()),
+            'cancelled_at_UTC': displayed_at + timedelta(seconds=60),
+            'cancelled_at_epoch': int(displayed_at.timestamp()) + 60,
+            'is_travelling': rng.choice([True, False])
+        })
+
+    user_cols = ['id', 'survey_id', 'mobile_id', 'response', 'uuid', 'model', 'itinerum_version',
+                 'os', 'os_version', 'created_at', 'modified_at']
+    user_values = []
+    for idx in range(num_rows):
+        created_at = start + timedelta(minutes=idx)
+        user_values.append([idx, 1, idx, {
+            'member_type': rng.choice(['student', 'staff']),
+            'travel_mode_study': rng.choice(['walk', 'bike', 'car']),
+            'travel_mode_alt_study': ['walk', 'transit'],
+            'age': rng.randint(18, 80),
+            'location_home': {'latitude': 45.5, 'longitude': -73.56},
+            'location_study': '45.50 -73.57',
+            'location_work': None
+        }, uuids[idx % 50], 'iPhone9,3', '99j', 'ios', '11.4.1', created_at, created_at])
+    users = _dict_rows(user_cols, user_values)
+    questions = ['member_type', 'travel_mode_study', 'travel_mode_alt_study', 'age']
+    survey_header = csv_formatters.survey_response_header(
+        ['uuid', 'model', 'itinerum_version', 'os', 'os_version', 'created_at', 'modified_at'],
+        questions, TIMESTAMP_COLS, LOCATION_COLS, ['id', 'survey_id', 'mobile_id', 'response'])
+
+    sqlite_rows = [[p['id'], 1, p['mobile_id'], float(p['latitude']), float(p['longitude']),
+                    float(p['altitude']), float(p['speed']), float(p['direction']),
+                    p['h_accuracy'], p['v_accuracy'], float(p['acceleration_x']),
+                    float(p['acceleration_y']), float(p['acceleration_z']),
+                    p['mode_detected'], p['point_type'], p['timestamp_UTC']]
+                   for p in coordinates]
+    csv_rows = [csv_formatters.coordinate_row(COORDINATE_HEADER, dict(p)) for p in coordinates]
+
+    return {
+        'coordinates': coordinates,
+        'prompts': prompts,
+        'cancelled': cancelled,
+        'users': users,
+        'survey_header': survey_header,
+        'sqlite_rows': sqlite_rows,
+        'csv_rows': csv_rows
+    }
+
+
+def _measure(setup, run, num_rows, repeats=REPEATS):
+    '''Best-of-`repeats` ns/row of `run(setup())`, excluding setup time, plus the
+       peak traced bytes/row and blocks still allocated per row of one run.'''
+    best = None
+    for _ in range(repeats):
+        args = setup()
+        t0 = time.perf_counter()
+        run(args)
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+
+    args = setup()
+    tracemalloc.start()
+    before = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    tracemalloc.reset_peak()
+    result = run(args)
+    _, peak = tracemalloc.get_traced_memory()
+    after = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    tracemalloc.stop()
+    del result
+    return {
+        'ns_per_row': round(best / num_rows * 1e9, 1),
+        'peak_bytes_per_row': round(peak / float(num_rows), 1),
+        'blocks_per_row': round((after - before) / float(num_rows), 2)
+    }
+
+
+def bench_formatters(label, formatters, fixtures):
+    results = OrderedDict()
+    coordinates, prompts, cancelled = fixtures['coordinates'], fixtures['prompts'], fixtures['cancelled']
+    n = len(coordinates)
+
+    results[label + '._format_UTC_timestamp'] = _measure(
+        lambda: [p['timestamp_UTC'] for p in coordinates],
+        lambda timestamps: [formatters._format_UTC_timestamp(ts) for ts in timestamps], n)
+    results[label + '.coordinate_row'] = _measure(
+        lambda: [dict(p) for p in coordinates],
+        lambda points: [formatters.coordinate_row(COORDINATE_HEADER, p) for p in points], n)
+    results[label + '.group_prompt_responses'] = _measure(
+        lambda: prompts,
+        lambda rows: formatters.group_prompt_responses(rows), len(prompts))
+    results[label + '.prompt_response_row'] = _measure(
+        lambda: formatters.group_prompt_responses(prompts),
+        lambda rows: [formatters.prompt_response_row(PROMPT_HEADER, r) for r in rows], len(prompts))
+    results[label + '.cancelled_prompt_row'] = _measure(
+        lambda: [dict(c) for c in cancelled],
+        lambda rows: [formatters.cancelled_prompt_row(CANCELLED_HEADER, c) for c in rows], len(cancelled))
+    results[label + '.survey_response_row'] = _measure(
+        lambda: fixtures['users'],
+        lambda users: [formatters.survey_response_row(fixtures['survey_header'], u,
+                                                      TIMESTAMP_COLS, LOCATION_COLS)
+                       for u in users], len(fixtures['users']))
+    return results
+
+
+def bench_fileio(label, module, fixtures, tmp_dir):
+    results = OrderedDict()
+    csv_rows = fixtures['csv_rows']
+    sqlite_rows = fixtures['sqlite_rows']
+
+    results[label + '.write_csv'] = _measure(
+        lambda: os.path.join(tmp_dir, 'coordinates.csv'),
+        lambda fp: module.write_csv(fp, COORDINATE_HEADER, csv_rows), len(csv_rows))
+    # other tables are also written to a `_latin1.csv` copy
+    results[label + '.write_csv_latin1'] = _measure(
+        lambda: os.path.join(tmp_dir, 'prompt_responses.csv'),
+        lambda fp: module.write_csv(fp, COORDINATE_HEADER, csv_rows), len(csv_rows))
+
+    def _sqlite_setup():
+        fp = os.path.join(tmp_dir, 'bench.sqlite')
+        if os.path.exists(fp):
+            os.remove(fp)
+        db = module.SQLiteDatabase(fp)
+        db.generate_table('mobile_coordinates', SQLITE_COORDINATE_COLS)
+        return db
+    results[label + '.SQLiteDatabase.insert_many'] = _measure(
+        _sqlite_setup,
+        lambda db: db.insert_many('mobile_coordinates', SQLITE_COORDINATE_COLS, sqlite_rows),
+        len(sqlite_rows))
+    return results
+
+
+def bench_decode(fixtures):
+    '''Decode the text wire values of mobile_prompt_responses rows into SQLite
+       rows: the default casts (json.loads, Decimal) into a DictRow formatted by
+       `format_sqlite_row` against the `raw_types` casters into a tuple.'''
+    results = OrderedDict()
+    cols = ['id', 'response', 'latitude', 'longitude']
+    wire = [(str(idx), json.dumps(p['response']), str(p['latitude']), str(p['longitude']))
+            for idx, p in enumerate(fixtures['prompts'])]
+    cursor = _DictCursor(cols)
+
+    def _dict_path(rows):
+        formatted = []
+        for _id, response, lat, lng in rows:
+            row = psycopg2.extras.DictRow(cursor)
+            row[:] = [int(_id), json.loads(response), Decimal(lat), Decimal(lng)]
+            formatted.append(database.format_sqlite_row(row, ['response'], ['latitude', 'longitude']))
+        return formatted
+
+    def _raw_path(rows):
+        numeric, json_text = database.NUMERIC_FLOAT, database.JSON_TEXT
+        return [(int(_id), json_text(response, None), numeric(lat, None), numeric(lng, None))
+                for _id, response, lat, lng in rows]
+
+    results['decode.dict_rows+format_sqlite_row'] = _measure(lambda: wire, _dict_path, len(wire))
+    results['decode.raw_types_tuples'] = _measure(lambda: wire, _raw_path, len(wire))
+    return results
+
+
+def _binary_copy_stream(rows, codes):
+    '''Encode rows as PostgreSQL would send them for `COPY ... (FORMAT binary)`.'''
+    data = bytearray(pgbinary.SIGNATURE + struct.pack('>ii', 0, 0))
+    for row in rows:
+        data += struct.pack('>h', len(row))
+        for value, code in zip(row, codes):
+            if value is None:
+                data += struct.pack('>i', -1)
+                continue
+            field = pgbinary.FIELD_STRUCTS[code]
+            data += struct.pack('>i', field.size) + field.pack(value)
+    data += struct.pack('>h', -1)
+    return bytes(data)
+
+
+def bench_binary_copy(fixtures, tmp_dir, block_size=1 << 20):
+    '''Copy mobile_coordinates rows from their wire encoding into SQLite: text
+       values through psycopg2's casters into DictRows formatted by
+       `format_sqlite_row` (the `select_all_chunks` path; timestamps are taken
+       already parsed, which favours it) against `pgbinary.BinaryCopyDecoder`
+       fed in `block_size` blocks.'''
+    results = OrderedDict()
+    cols = [name for name, _ in SQLITE_COORDINATE_COLS]
+    float_cols = ['latitude', 'longitude', 'altitude', 'speed', 'direction', 'h_accuracy',
+                  'v_accuracy', 'acceleration_x', 'acceleration_y', 'acceleration_z']
+    numeric_casters = {
+        'INTEGER': psycopg2.extensions.INTEGER,
+        'REAL': psycopg2.extensions.DECIMAL
+    }
+    casters = [numeric_casters.get(dtype) for _, dtype in SQLITE_COORDINATE_COLS]
+    text_wire = [[None if v is None else (v if caster is None else str(v))
+                  for v, caster in zip(row, casters)]
+                 for row in fixtures['sqlite_rows']]
+
+    codes = ['i', 'i', 'i'] + ['d'] * 10 + ['i', 'i', 't', 'z']
+    epoch = pgbinary.POSTGRES_EPOCH
+    binary_rows = [row[:-1] + [(row[-1] - epoch) // timedelta(microseconds=1), 0]
+                   for row in fixtures['sqlite_rows']]
+    binary_wire = _binary_copy_stream(binary_rows, codes)
+
+    def _sqlite_setup():
+        fp = os.path.join(tmp_dir, 'bench.sqlite')
+        if os.path.exists(fp):
+            os.remove(fp)
+        db = fileio.SQLiteDatabase(fp)
+        db.generate_table('mobile_coordinates', SQLITE_COORDINATE_COLS)
+        return db
+
+    def _text_path(db):
+        cursor = _DictCursor(cols)
+        rows = []
+        for values in text_wire:
+            row = psycopg2.extras.DictRow(cursor)
+            row[:] = [v if caster is None or v is None else caster(v, None)
+                      for v, caster in zip(values, casters)]
+            rows.append(database.format_sqlite_row(row, None, float_cols))
+        db.insert_many('mobile_coordinates', SQLITE_COORDINATE_COLS, rows)
+
+    def _binary_path(db):
+        decoder = pgbinary.BinaryCopyDecoder(codes)
+        rows = []
+        for start in range(0, len(binary_wire), block_size):
+            rows.extend(decoder.feed(binary_wire[start:start + block_size]))
+        db.insert_many('mobile_coordinates', SQLITE_COORDINATE_COLS, rows)
+
+    n = len(text_wire)
+    results['copy.coordinates.dict_rows+format_sqlite_row'] = _measure(_sqlite_setup, _text_path, n)
+    results['copy.coordinates.binary_copy'] = _measure(_sqlite_setup, _binary_path, n)
+    return results
+
+
+def run():
+    users_by_date_dir = os.path.join(ARCHIVER_DIR, 'users_by_date')
+    users_formatters = _load_module('users_by_date_csv_formatters',
+                                    os.path.join(users_by_date_dir, 'csv_formatters.py'))
+    users_fileio = _load_module('users_by_date_fileio', os.path.join(users_by_date_dir, 'fileio.py'))
+
+    fixtures = build_fixtures()
+    tmp_dir = tempfile.mkdtemp(prefix='archiver-micro-')
+    results = OrderedDict()
+    try:
+        results.update(bench_formatters('csv_formatters', csv_formatters, fixtures))
+        results.update(bench_formatters('users_by_date.csv_formatters', users_formatters, fixtures))
+        results.update(bench_fileio('fileio', fileio, fixtures, tmp_dir))
+        results.update(bench_fileio('users_by_date.fileio', users_fileio, fixtures, tmp_dir))
+        results.update(bench_decode(fixtures))
+        results.update(bench_binary_copy(fixtures, tmp_dir))
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def report(results, baseline=None):
+    print('{:<50} {:>12} {:>14} {:>12} {:>10}'.format('function', 'ns/row', 'peak B/row',
+                                                       'blocks/row', 'vs base'))
+    for name, r in results.items():
+        ratio = ''
+        if baseline and name in baseline['results']:
+            ratio = '{:.2f}x'.format(r['ns_per_row'] / baseline['results'][name]['ns_per_row'])
+        print('{:<50} {:>12} {:>14} {:>12} {:>10}'.format(name, r['ns_per_row'],
+                                                           r['peak_bytes_per_row'],
+                                                           r['blocks_per_row'], ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmark per-row archiver functions.')
+    parser.add_argument('--baseline', default=BASELINE_FP)
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args()
+
+    results = run()
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as baseline_f:
+            baseline = json.load(baseline_f)
+    report(results, None if args.save_baseline else baseline)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_f:
+            json.dump({
+                'python': sys.version.split()[0],
+                'platform': platform.platform(),
+                'num_rows': NUM_ROWS,
+                'timestamp': int(time.time()),
+                'results': results
+            }, baseline_f, indent=4)
+        print('Saved baseline to {fp}'.format(fp=args.baseline))
+
+
+if __name__ == '__main__':
+    main()
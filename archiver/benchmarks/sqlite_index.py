@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# Time bounding box and time window queries on the `.sqlite` archive's
+# mobile_coordinates before and after `SQLiteDatabase.index_coordinates` (R*Tree
+# over latitude/longitude, integer `epoch` indexed with `mobile_id`, ANALYZE),
+# and report the indexing time and the growth of the file. The bare table is
+# queried as researchers would without the indexes: latitude/longitude ranges
+# and `timestamp` text comparisons.
+#
+# Run from the `archiver` directory, on a synthetic archive (2M points by
+# default) or on a copy of an exported survey:
+#   python3 -m benchmarks.sqlite_index [--users 200 --points 10000]
+#   python3 -m benchmarks.sqlite_index --sqlite output/<survey>.sqlite
+import argparse
+from datetime import datetime, timedelta
+import json
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import time
+
+import pytz
+
+from benchmarks.tracks import synthetic_tracks
+import fileio
+
+
+COLUMNS = [('id', 'INTEGER'), ('survey_id', 'INTEGER'), ('mobile_id', 'INTEGER'),
+           ('latitude', 'REAL'), ('longitude', 'REAL'), ('altitude', 'REAL'), ('speed', 'REAL'),
+           ('direction', 'REAL'), ('h_accuracy', 'REAL'), ('v_accuracy', 'REAL'),
+           ('acceleration_x', 'REAL'), ('acceleration_y', 'REAL'), ('acceleration_z', 'REAL'),
+           ('mode_detected', 'INTEGER'), ('point_type', 'INTEGER'), ('timestamp', 'DATETIME')]
+BOX_DEGREES = 0.005
+WINDOW = timedelta(hours=6)
+# (name, query on the bare table, query using the indexes); parameters are
+# (min_lat, max_lat, min_lon, max_lon, mobile_id, start, end) by name
+QUERIES = [
+    ('bbox', '''
+        SELECT id, latitude, longitude, timestamp
+        FROM mobile_coordinates
+        WHERE latitude BETWEEN :min_lat AND :max_lat
+        AND longitude BETWEEN :min_lon AND :max_lon;
+    ''', '''
+        SELECT c.id, c.latitude, c.longitude, c.timestamp
+        FROM mobile_coordinates_rtree r
+        JOIN mobile_coordinates c ON c.rowid = r.id
+        WHERE r.max_lat >= :min_lat AND r.min_lat <= :max_lat
+        AND r.max_lon >= :min_lon AND r.min_lon <= :max_lon
+        AND c.latitude BETWEEN :min_lat AND :max_lat
+        AND c.longitude BETWEEN :min_lon AND :max_lon;
+    '''),
+    ('user_window', '''
+        SELECT id, latitude, longitude, timestamp
+        FROM mobile_coordinates
+        WHERE mobile_id = :mobile_id
+        AND timestamp BETWEEN :start_text AND :end_text;
+    ''', '''
+        SELECT id, latitude, longitude, timestamp
+        FROM mobile_coordinates
+        WHERE mobile_id = :mobile_id
+        AND epoch BETWEEN :start AND :end;
+    '''),
+    ('bbox_window', '''
+        SELECT id, latitude, longitude, timestamp
+        FROM mobile_coordinates
+        WHERE latitude BETWEEN :min_lat AND :max_lat
+        AND longitude BETWEEN :min_lon AND :max_lon
+        AND timestamp BETWEEN :start_text AND :end_text;
+    ''', '''
+        SELECT c.id, c.latitude, c.longitude, c.timestamp
+        FROM mobile_coordinates_rtree r
+        JOIN mobile_coordinates c ON c.rowid = r.id
+        WHERE r.max_lat >= :min_lat AND r.min_lat <= :max_lat
+        AND r.max_lon >= :min_lon AND r.min_lon <= :max_lon
+        AND c.latitude BETWEEN :min_lat AND :max_lat
+        AND c.longitude BETWEEN :min_lon AND :max_lon
+        AND c.epoch BETWEEN :start AND :end;
+    ''')
+]
+
+
+def synthetic_sqlite(fp, users=200, points=10000):
+    '''Write a mobile_coordinates table like `copy_psql_sqlite` does, one
+       synthetic user at a time.'''
+    dest_db = fileio.SQLiteDatabase(fp)
+    dest_db.generate_table('mobile_coordinates', COLUMNS)
+    next_id = 1
+    for mobile_id in range(users):
+        rows = []
+        for _, point in synthetic_tracks(users=1, points=points, seed=mobile_id):
+            rows.append([next_id, 1, mobile_id] +
+                        [float(point[name]) if point[name] is not None and sqlite_type == 'REAL'
+                         else point[name] for name, sqlite_type in COLUMNS[3:-1]] +
+                        [str(point['timestamp_UTC'])])
+            next_id += 1
+        dest_db.insert_many('mobile_coordinates', COLUMNS, rows)
+    del dest_db
+
+
+def _utc_text(epoch):
+    return str(datetime.fromtimestamp(epoch, tz=pytz.UTC))
+
+
+def query_params(conn, num, seed=0):
+    '''Random boxes around recorded points and time windows of a user's trace.'''
+    rng = random.Random(seed)
+    max_rowid, = conn.execute('SELECT MAX(rowid) FROM mobile_coordinates;').fetchone()
+    params = []
+    while len(params) < num:
+        row = conn.execute('''SELECT mobile_id, latitude, longitude,
+                                     CAST(ROUND((julianday(timestamp) - 2440587.5) * 86400) AS INTEGER)
+                              FROM mobile_coordinates WHERE rowid = ?;''',
+                           [rng.randint(1, max_rowid)]).fetchone()
+        if not row or row[1] is None or row[2] is None:
+            continue
+        mobile_id, lat, lon, epoch = row
+        start = epoch - int(WINDOW.total_seconds() / 2)
+        end = start + int(WINDOW.total_seconds())
+        params.append({
+            'min_lat': lat - BOX_DEGREES / 2, 'max_lat': lat + BOX_DEGREES / 2,
+            'min_lon': lon - BOX_DEGREES / 2, 'max_lon': lon + BOX_DEGREES / 2,
+            'mobile_id': mobile_id, 'start': start, 'end': end,
+            'start_text': _utc_text(start), 'end_text': _utc_text(end)
+        })
+    return params
+
+
+def time_queries(conn, params, indexed):
+    results = {}
+    for name, bare_sql, indexed_sql in QUERIES:
+        sql = indexed_sql if indexed else bare_sql
+        timings, rows = [], []
+        for p in params:
+            t0 = time.perf_counter()
+            found = conn.execute(sql, p).fetchall()
+            timings.append(time.perf_counter() - t0)
+            rows.append(sorted(r[0] for r in found))
+        results[name] = {'ms': round(statistics.median(timings) * 1000, 3), 'ids': rows}
+    return results
+
+
+def run(fp, num_queries=20):
+    conn = sqlite3.connect(fp)
+    points, = conn.execute('SELECT COUNT(*) FROM mobile_coordinates;').fetchone()
+    params = query_params(conn, num_queries)
+    bare = time_queries(conn, params, indexed=False)
+    conn.close()
+
+    bare_bytes = os.path.getsize(fp)
+    dest_db = fileio.SQLiteDatabase(fp)
+    t0 = time.perf_counter()
+    dest_db.index_coordinates()
+    index_seconds = time.perf_counter() - t0
+    del dest_db
+
+    conn = sqlite3.connect(fp)
+    indexed = time_queries(conn, params, indexed=True)
+    conn.close()
+    return {
+        'points': points,
+        'index_seconds': round(index_seconds, 2),
+        'bare_bytes': bare_bytes,
+        'indexed_bytes': os.path.getsize(fp),
+        'queries': {
+            name: {
+                'bare_ms': bare[name]['ms'],
+                'indexed_ms': indexed[name]['ms'],
+                'mean_rows': round(statistics.mean(len(ids) for ids in bare[name]['ids']), 1),
+                # timestamps stored in a non-UTC offset compare differently as text
+                'same_rows': bare[name]['ids'] == indexed[name]['ids']
+            } for name, _, _ in QUERIES
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the .sqlite coordinates indexes.')
+    parser.add_argument('--sqlite', help='index a copy of an exported survey .sqlite')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--points', type=int, default=10000, help='points per synthetic user')
+    parser.add_argument('--queries', type=int, default=20, help='random queries of each kind')
+    parser.add_argument('--output', help='write the JSON report to this file')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='archiver-sqlite-index-')
+    try:
+        fp = os.path.join(tmp_dir, 'survey.sqlite')
+        if args.sqlite:
+            shutil.copyfile(args.sqlite, fp)
+        else:
+            synthetic_sqlite(fp, users=args.users, points=args.points)
+        report = run(fp, num_queries=args.queries)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    print('{:<12} {:>12} {:>12} {:>10} {:>10}'.format('query', 'bare ms', 'indexed ms', 'rows', 'same'))
+    for name, r in report['queries'].items():
+        print('{:<12} {:>12} {:>12} {:>10} {:>10}'.format(name, r['bare_ms'], r['indexed_ms'],
+                                                          r['mean_rows'], str(r['same_rows'])))
+    print('{points} points indexed in {seconds}s; {bare:.1f} MB -> {indexed:.1f} MB'.format(
+        points=report['points'], seconds=report['index_seconds'],
+        bare=report['bare_bytes'] / 1e6, indexed=report['indexed_bytes'] / 1e6))
+    if args.output:
+        with open(args.output, 'w') as report_f:
+            json.dump(report, report_f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
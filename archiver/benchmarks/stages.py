@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# End-to-end benchmark of the archiver stages against a synthetic dataset,
+# reporting seconds, rows/s, MB/s and peak RSS per stage as JSON so runs can be
+# compared across commits.
+#
+# Run from the `archiver` directory (requires the PostgreSQL client tools):
+#   python3 -m benchmarks.stages --config bench_config.json --generate --output bench.json
+import argparse
+from contextlib import contextmanager
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import archiver
+import database
+import fileio
+from profiling import PeakRSS
+from benchmarks import synthetic
+
+
+USERS_BY_DATE_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                    'users_by_date', 'user_archiver.py')
+COPY_TABLES = ['mobile_users', 'mobile_survey_responses', 'mobile_coordinates',
+               'mobile_prompt_responses', 'mobile_cancelled_prompt_responses']
+
+
+def _csv_rows(fp):
+    with open(fp, 'r') as csv_f:
+        return max(sum(1 for _ in csv_f) - 1, 0)
+
+
+@contextmanager
+def measure(results, stage, survey=None):
+    '''Time a stage; the caller fills in `rows` and `bytes` on the yielded dict.'''
+    result = {'stage': stage, 'survey': survey, 'rows': 0, 'bytes': 0}
+    with PeakRSS() as rss:
+        t0 = time.time()
+        yield result
+        elapsed = time.time() - t0
+    result['seconds'] = round(elapsed, 4)
+    result['rows_per_sec'] = round(result['rows'] / elapsed, 1) if elapsed else None
+    result['mb_per_sec'] = round(result['bytes'] / 1e6 / elapsed, 3) if elapsed else None
+    result['peak_rss_mb'] = round(rss.peak / 1e6, 1)
+    results.append(result)
+
+
+def bench_survey(results, cfg, source_db, output_dir, survey_id, survey_name, delete=False):
+    pipeline_cfg = dict(archiver.PIPELINE_DEFAULTS, **cfg.get('pipeline', {}))
+
+    dest_sqlite_fp = os.path.join(output_dir, '{}.sqlite'.format(survey_name))
+    with measure(results, 'sqlite', survey_name) as result:
+        dest_db = fileio.SQLiteDatabase(dest_sqlite_fp)
+        for table_name, json_cols, float_cols in [
+                ('mobile_users', None, None),
+                ('mobile_survey_responses', ['response'], None),
+                ('mobile_coordinates', None, ['latitude', 'longitude', 'altitude', 'speed',
+                                              'direction', 'h_accuracy', 'v_accuracy',
+                                              'acceleration_x', 'acceleration_y',
+                                              'acceleration_z']),
+                ('mobile_prompt_responses', ['response'], ['latitude', 'longitude']),
+                ('mobile_cancelled_prompt_responses', None, ['latitude', 'longitude'])]:
+            stats = archiver.copy_psql_sqlite(source_db, dest_db, table_name, survey_id,
+                                              json_cols=json_cols, float_cols=float_cols,
+                                              pipeline_cfg=pipeline_cfg)
+            result['rows'] += stats[-1].rows
+        result['bytes'] = fileio.path_size(dest_sqlite_fp)
+
+    psql_dump_fp = os.path.join(output_dir, '{}.psql.gz'.format(survey_name))
+    with measure(results, 'psql_dump', survey_name) as result:
+        for table_name in COPY_TABLES:
+            archiver.create_psql_copy_table(source_db, table_name, survey_id, survey_name)
+        fileio.dump_psql_copy_tables(psql_dump_fp, survey_name, **cfg['source_db'])
+        archiver.drop_psql_copy_tables(source_db, survey_name, COPY_TABLES)
+        result['bytes'] = fileio.path_size(psql_dump_fp)
+
+    csv_dir = os.path.join(output_dir, '{}-csv'.format(survey_name))
+    os.mkdir(csv_dir)
+    for stage, fn, csv_fn in [
+            ('csv_survey_responses', archiver.dump_csv_survey_responses, 'survey_responses.csv'),
+            ('csv_coordinates', archiver.dump_csv_coordinates, 'coordinates.csv'),
+            ('csv_prompts', archiver.dump_csv_prompts, 'prompt_responses.csv'),
+            ('csv_cancelled_prompts', archiver.dump_csv_cancelled_prompts, 'cancelled_prompts.csv')]:
+        with measure(results, stage, survey_name) as result:
+            fn(source_db, csv_dir, survey_id, survey_name)
+            fp = os.path.join(csv_dir, csv_fn)
+            result['rows'] = _csv_rows(fp)
+            result['bytes'] = fileio.path_size(fp)
+
+    with measure(results, 'compress', survey_name) as result:
+        result['bytes'] = fileio.path_size(dest_sqlite_fp) + fileio.path_size(csv_dir)
+        archiver.compress_outputs([dest_sqlite_fp, csv_dir], pipeline_cfg)
+
+    if delete:
+        with measure(results, 'delete', survey_name) as result:
+            source_db.delete_survey(survey_id, **cfg.get('delete_batches', {}))
+
+
+def bench_copy_paths(results, cfg, source_db, output_dir, survey_id, survey_name):
+    '''Copy mobile_coordinates into SQLite through each fetch path of
+       `copy_psql_sqlite` to compare them on the same survey.'''
+    pipeline_cfg = dict(archiver.PIPELINE_DEFAULTS, **cfg.get('pipeline', {}))
+    float_cols = ['latitude', 'longitude', 'altitude', 'speed', 'direction', 'h_accuracy',
+                  'v_accuracy', 'acceleration_x', 'acceleration_y', 'acceleration_z']
+    for path, options in [('select_all_chunks', {'raw_types': False, 'binary_copy': False}),
+                          ('raw_types', {'raw_types': True, 'binary_copy': False}),
+                          ('binary_copy', {'raw_types': False, 'binary_copy': True})]:
+        dest_sqlite_fp = os.path.join(output_dir, '{}-{}.sqlite'.format(survey_name, path))
+        with measure(results, 'sqlite_coordinates.' + path, survey_name) as result:
+            dest_db = fileio.SQLiteDatabase(dest_sqlite_fp)
+            stats = archiver.copy_psql_sqlite(source_db, dest_db, 'mobile_coordinates', survey_id,
+                                              float_cols=float_cols,
+                                              pipeline_cfg=dict(pipeline_cfg, **options))
+            result['rows'] = stats[-1].rows
+            result['bytes'] = fileio.path_size(dest_sqlite_fp)
+        os.remove(dest_sqlite_fp)
+
+
+def bench_users_by_date(results, cfg, output_dir, survey_name, cutoff_date):
+    '''Run users_by_date in a child process with its own config.json.'''
+    with measure(results, 'users_by_date', survey_name) as result:
+        run_dir = tempfile.mkdtemp()
+        user_cfg = {
+            'source_db': cfg['source_db'],
+            'archive': {
+                'survey_name': survey_name,
+                'cutoff_date': cutoff_date,
+                'output_dir': os.path.abspath(output_dir)
+            }
+        }
+        with open(os.path.join(run_dir, 'config.json'), 'w') as cfg_f:
+            json.dump(user_cfg, cfg_f)
+        proc = subprocess.Popen([sys.executable, USERS_BY_DATE_SCRIPT], cwd=run_dir)
+        _, status, rusage = os.wait4(proc.pid, 0)
+        shutil.rmtree(run_dir)
+        if status != 0:
+            raise RuntimeError('users_by_date exited with status {s}'.format(s=status))
+        for fn in os.listdir(output_dir):
+            if '_users' in fn:
+                result['bytes'] += fileio.path_size(os.path.join(output_dir, fn))
+    result['child_peak_rss_mb'] = round(rusage.ru_maxrss * 1024 / 1e6, 1)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark archiver stages on a synthetic dataset.')
+    parser.add_argument('--config', default='./bench_config.json',
+                        help='JSON config with a `source_db` section for a disposable database')
+    parser.add_argument('--generate', action='store_true',
+                        help='(re)generate the synthetic dataset before benchmarking')
+    parser.add_argument('--surveys', type=int, default=5)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--coordinates', type=int, default=2000)
+    parser.add_argument('--prompts', type=int, default=20)
+    parser.add_argument('--cancelled', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--delete', action='store_true', help='also benchmark delete_survey')
+    parser.add_argument('--copy-paths', action='store_true',
+                        help='also compare the SQLite fetch paths on mobile_coordinates')
+    parser.add_argument('--cutoff-date', default='2018-03-01T00:00:00Z',
+                        help='users_by_date sign-up cutoff')
+    parser.add_argument('--output', help='write the JSON report to this file')
+    parser.add_argument('--force', action='store_true')
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    with open(args.config, 'r') as cfg_f:
+        cfg = json.load(cfg_f)
+    report = {
+        'commit': git_commit(),
+        'timestamp': int(time.time()),
+        'dataset': None,
+        'stages': []
+    }
+
+    if args.generate:
+        conn = synthetic.connect(cfg, force=args.force)
+        report['dataset'] = synthetic.generate(conn, surveys=args.surveys, users=args.users,
+                                               coordinates=args.coordinates, prompts=args.prompts,
+                                               cancelled=args.cancelled, seed=args.seed)
+        conn.close()
+
+    output_dir = tempfile.mkdtemp(prefix='archiver-bench-')
+    source_db = database.ItinerumDatabase(**cfg['source_db'], pool_cfg=cfg.get('pool'))
+    results = report['stages']
+    try:
+        with measure(results, 'latest_signups') as result:
+            surveys = source_db.latest_signups_by_survey()
+            result['rows'] = len(surveys)
+        with measure(results, 'time_spans') as result:
+            spans = source_db.time_spans([row['survey_id'] for row in surveys])
+            result['rows'] = len(spans)
+
+        for survey_id, survey_name, _ in surveys:
+            if args.copy_paths:
+                bench_copy_paths(results, cfg, source_db, output_dir, survey_id, survey_name)
+            bench_survey(results, cfg, source_db, output_dir, survey_id, survey_name,
+                         delete=args.delete)
+            if not args.delete:
+                bench_users_by_date(results, cfg, output_dir, survey_name, args.cutoff_date)
+    finally:
+        source_db.close()
+        shutil.rmtree(output_dir)
+
+    report_json = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, 'w') as report_f:
+            report_f.write(report_json)
+    print(report_json)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+# Build the Itinerum tables the archiver reads and deletes from in a disposable
+# PostgreSQL database and fill them with synthetic surveys.
+#
+# Run from the `archiver` directory:
+#   python3 -m benchmarks.synthetic --config bench_config.json --surveys 5 --users 200
+import argparse
+import io
+import json
+import math
+import random
+import sys
+import uuid
+from datetime import datetime, timedelta
+
+import psycopg2
+import pytz
+
+
+SCHEMA_SQL = '''
+    DROP TABLE IF EXISTS tokens_password_reset, tokens_researcher_invite, web_users,
+        statistics_mobile_users, statistics_surveys, survey_subway_stops, prompt_questions,
+        survey_questions, mobile_cancelled_prompt_responses, mobile_prompt_responses,
+        mobile_coordinates, mobile_survey_responses, mobile_users, surveys CASCADE;
+
+    CREATE TABLE surveys (
+        id SERIAL PRIMARY KEY,
+        name CHARACTER VARYING(255) UNIQUE NOT NULL,
+        created_at TIMESTAMP WITH TIME ZONE
+    );
+    CREATE TABLE mobile_users (
+        id SERIAL PRIMARY KEY,
+        survey_id INTEGER REFERENCES surveys ON DELETE CASCADE,
+        uuid CHARACTER VARYING(36) UNIQUE NOT NULL,
+        model CHARACTER VARYING(160),
+        itinerum_version CHARACTER VARYING(16),
+        os CHARACTER VARYING(16),
+        os_version CHARACTER VARYING(16),
+        created_at TIMESTAMP WITH TIME ZONE,
+        modified_at TIMESTAMP WITH TIME ZONE
+    );
+    CREATE TABLE mobile_survey_responses (
+        id SERIAL PRIMARY KEY,
+        survey_id INTEGER REFERENCES surveys ON DELETE CASCADE,
+        mobile_id INTEGER REFERENCES mobile_users ON DELETE CASCADE,
+        response JSONB
+    );
+    CREATE TABLE mobile_coordinates (
+        id SERIAL PRIMARY KEY,
+        survey_id INTEGER REFERENCES surveys ON DELETE CASCADE,
+        mobile_id INTEGER REFERENCES mobile_users ON DELETE CASCADE,
+        latitude NUMERIC(10, 7),
+        longitude NUMERIC(10, 7),
+        altitude NUMERIC(10, 6),
+        speed NUMERIC(10, 6),
+        direction NUMERIC(10, 6),
+        h_accuracy DOUBLE PRECISION,
+        v_accuracy DOUBLE PRECISION,
+        acceleration_x NUMERIC(10, 6),
+        acceleration_y NUMERIC(10, 6),
+        acceleration_z NUMERIC(10, 6),
+        mode_detected INTEGER,
+        point_type INTEGER,
+        timestamp TIMESTAMP WITH TIME ZONE
+    );
+    CREATE TABLE mobile_prompt_responses (
+        id SERIAL PRIMARY KEY,
+        survey_id INTEGER REFERENCES surveys ON DELETE CASCADE,
+        mobile_id INTEGER REFERENCES mobile_users ON DELETE CASCADE,
+        prompt_uuid CHARACTER VARYING(36),
+        prompt_num INTEGER,
+        response JSONB,
+        latitude NUMERIC(16, 10),
+        longitude NUMERIC(16, 10),
+        displayed_at TIMESTAMP WITH TIME ZONE,
+        recorded_at TIMESTAMP WITH TIME ZONE,
+        edited_at TIMESTAMP WITH TIME ZONE
+    );
+    CREATE TABLE mobile_cancelled_prompt_responses (
+        id SERIAL PRIMARY KEY,
+        survey_id INTEGER REFERENCES surveys ON DELETE CASCADE,
+        mobile_id INTEGER REFERENCES mobile_users ON DELETE CASCADE,
+        prompt_uuid CHARACTER VARYING(36),
+        latitude NUMERIC(16, 10),
+        longitude NUMERIC(16, 10),
+        displayed_at TIMESTAMP WITH TIME ZONE,
+        cancelled_at TIMESTAMP WITH TIME ZONE,
+        is_travelling BOOLEAN
+    );
+    CREATE TABLE survey_questions (
+        id SERIAL PRIMARY KEY,
+        survey_id INTEGER REFERENCES surveys ON DELETE CASCADE,
+        question_num INTEGER,
+        question_label CHARACTER VARYING(255)
+    );
+    CREATE TABLE prompt_questions (
+        id SERIAL PRIMARY KEY,
+        survey_id INTEGER REFERENCES surveys ON DELETE CASCADE,
+        prompt_num INTEGER,
+        prompt_label CHARACTER VARYING(255)
+    );
+    CREATE TABLE survey_subway_stops (
+        id SERIAL PRIMARY KEY,
+        survey_id INTEGER REFERENCES surveys ON DELETE CASCADE,
+        latitude NUMERIC(16, 10),
+        longitude NUMERIC(16, 10)
+    );
+    CREATE TABLE statistics_surveys (
+        id INTEGER PRIMARY KEY REFERENCES surveys ON DELETE CASCADE,
+        total_coordinates INTEGER
+    );
+    CREATE TABLE statistics_mobile_users (
+        id SERIAL PRIMARY KEY,
+        survey_id INTEGER REFERENCES surveys ON DELETE CASCADE,
+        mobile_id INTEGER REFERENCES mobile_users ON DELETE CASCADE,
+        total_coordinates INTEGER
+    );
+    CREATE TABLE web_users (
+        id SERIAL PRIMARY KEY,
+        survey_id INTEGER REFERENCES surveys ON DELETE CASCADE,
+        email CHARACTER VARYING(255)
+    );
+    CREATE TABLE tokens_password_reset (
+        id SERIAL PRIMARY KEY,
+        web_user_id INTEGER REFERENCES web_users ON DELETE CASCADE,
+        token CHARACTER VARYING(60)
+    );
+    CREATE TABLE tokens_researcher_invite (
+        id SERIAL PRIMARY KEY,
+        survey_id INTEGER REFERENCES surveys ON DELETE CASCADE,
+        token CHARACTER VARYING(60)
+    );
+    CREATE INDEX mobile_users_survey_id_idx ON mobile_users (survey_id);
+    CREATE INDEX mobile_survey_responses_mobile_id_idx ON mobile_survey_responses (mobile_id);
+    CREATE INDEX mobile_coordinates_mobile_id_idx ON mobile_coordinates (mobile_id);
+    CREATE INDEX mobile_prompt_responses_survey_id_idx ON mobile_prompt_responses (survey_id);
+    CREATE INDEX mobile_prompt_responses_mobile_id_idx ON mobile_prompt_responses (mobile_id);
+    CREATE INDEX mobile_cancelled_prompt_responses_survey_id_idx ON mobile_cancelled_prompt_responses (survey_id);
+    CREATE INDEX mobile_cancelled_prompt_responses_mobile_id_idx ON mobile_cancelled_prompt_responses (mobile_id);
+'''
+SURVEY_INDEX_SQL = '''
+    CREATE INDEX survey{id}_multi_idx ON mobile_coordinates (survey_id, id)
+    WHERE survey_id = {id};
+'''
+QUESTIONS = ['member_type', 'travel_mode_study', 'travel_mode_alt_study', 'age', 'gender',
+             'location_home', 'location_study', 'location_work']
+MODES = ['walk', 'bike', 'car', 'transit', 'other']
+DEVICES = [('iPhone9,3', 'ios', '11.4.1'), ('Pixel 2', 'android', '8.1.0'),
+           ('SM-G930W8', 'android', '7.0'), ('iPhone10,4', 'ios', '12.0')]
+CITY_CENTER = (45.5017, -73.5673)
+
+
+def _copy(cur, table, cols, rows):
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join('\\N' if v is None else str(v) for v in row))
+        buf.write('\n')
+    buf.seek(0)
+    cur.copy_expert('COPY {table} ({cols}) FROM STDIN;'.format(table=table,
+                                                               cols=', '.join(cols)),
+                    buf)
+
+
+def _lognormal_count(rng, mean):
+    '''Long-tailed count with the given mean so a few users or surveys dominate.'''
+    if mean <= 0:
+        return 0
+    sigma = 1.
+    return max(1, int(rng.lognormvariate(math.log(mean) - sigma ** 2 / 2, sigma)))
+
+
+def _track(rng, start, num_points):
+    '''Random walk around the city center with irregular sampling intervals.'''
+    lat, lon = CITY_CENTER[0] + rng.gauss(0, 0.05), CITY_CENTER[1] + rng.gauss(0, 0.05)
+    ts = start
+    for _ in range(num_points):
+        ts += timedelta(seconds=rng.choice([1, 1, 1, 5, 10, 30, 300, 3600]))
+        lat += rng.gauss(0, 0.0002)
+        lon += rng.gauss(0, 0.0002)
+        yield ts, lat, lon
+
+
+def generate(conn, surveys=5, users=200, coordinates=2000, prompts=20, cancelled=5, seed=0):
+    '''Create the schema and generate `surveys` surveys with on average `users`
+       users each; every user has on average `coordinates` points, `prompts`
+       prompt responses and `cancelled` cancelled prompts. Returns row counts.'''
+    rng = random.Random(seed)
+    counts = {}
+    with conn.cursor() as cur:
+        cur.execute(SCHEMA_SQL)
+        start = datetime(2018, 1, 1, tzinfo=pytz.utc)
+        for survey_num in range(1, surveys + 1):
+            survey_start = start + timedelta(days=rng.randint(0, 365))
+            cur.execute('''INSERT INTO surveys (name, created_at) VALUES (%s, %s) RETURNING id;''',
+                        ['bench_survey_{n}'.format(n=survey_num), survey_start])
+            survey_id, = cur.fetchone()
+            cur.execute(SURVEY_INDEX_SQL.format(id=survey_id))
+            _copy(cur, 'survey_questions', ['survey_id', 'question_num', 'question_label'],
+                  [(survey_id, num, label) for num, label in enumerate(QUESTIONS, start=1)])
+            _copy(cur, 'prompt_questions', ['survey_id', 'prompt_num', 'prompt_label'],
+                  [(survey_id, 0, 'mode'), (survey_id, 1, 'purpose')])
+            _copy(cur, 'statistics_surveys', ['id', 'total_coordinates'], [(survey_id, 0)])
+            cur.execute('''INSERT INTO web_users (survey_id, email) VALUES (%s, %s) RETURNING id;''',
+                        [survey_id, 'admin@bench_survey_{n}.test'.format(n=survey_num)])
+            web_user_id, = cur.fetchone()
+            _copy(cur, 'tokens_password_reset', ['web_user_id', 'token'],
+                  [(web_user_id, uuid.UUID(int=rng.getrandbits(128)).hex)])
+            _copy(cur, 'tokens_researcher_invite', ['survey_id', 'token'],
+                  [(survey_id, uuid.UUID(int=rng.getrandbits(128)).hex)])
+
+            num_users = _lognormal_count(rng, users)
+            user_rows = []
+            for _ in range(num_users):
+                model, os_name, os_version = rng.choice(DEVICES)
+                created_at = survey_start + timedelta(seconds=rng.randint(0, 90 * 86400))
+                user_rows.append((survey_id, str(uuid.UUID(int=rng.getrandbits(128))), model,
+                                  '99j', os_name, os_version, created_at, created_at))
+            _copy(cur, 'mobile_users', ['survey_id', 'uuid', 'model', 'itinerum_version', 'os',
+                                        'os_version', 'created_at', 'modified_at'], user_rows)
+            cur.execute('''SELECT id, created_at FROM mobile_users WHERE survey_id=%s ORDER BY id;''',
+                        [survey_id])
+            mobile_users = cur.fetchall()
+
+            responses, points, answered, cancels = [], [], [], []
+            for mobile_id, created_at in mobile_users:
+                home = {'latitude': CITY_CENTER[0] + rng.gauss(0, 0.05),
+                        'longitude': CITY_CENTER[1] + rng.gauss(0, 0.05)}
+                responses.append((survey_id, mobile_id, json.dumps({
+                    'member_type': rng.choice(['student', 'staff', 'faculty']),
+                    'travel_mode_study': rng.choice(MODES),
+                    'travel_mode_alt_study': [rng.choice(MODES), rng.choice(MODES)],
+                    'age': rng.randint(18, 80),
+                    'gender': rng.choice(['female', 'male', 'other']),
+                    'location_home': home,
+                    'location_study': {'latitude': home['latitude'] + 0.01,
+                                       'longitude': home['longitude'] + 0.01},
+                    'location_work': None})))
+
+                track = list(_track(rng, created_at, _lognormal_count(rng, coordinates)))
+                for ts, lat, lon in track:
+                    points.append((survey_id, mobile_id, round(lat, 7), round(lon, 7),
+                                   round(rng.uniform(0, 120), 6), round(rng.uniform(0, 30), 6),
+                                   round(rng.uniform(0, 360), 6), round(rng.uniform(3, 65), 1),
+                                   round(rng.uniform(3, 30), 1), round(rng.gauss(0, 1), 6),
+                                   round(rng.gauss(0, 1), 6), round(rng.gauss(9.8, 1), 6),
+                                   rng.choice([None, 0, 1, 2, 3]), rng.choice([0, 1, 2]), ts.isoformat()))
+
+                for ts, lat, lon in rng.sample(track, min(len(track), _lognormal_count(rng, prompts))):
+                    prompt_uuid = str(uuid.UUID(int=rng.getrandbits(128)))
+                    for prompt_num, answer in enumerate([[rng.choice(MODES)], ['work', 'home']]):
+                        answered.append((survey_id, mobile_id, prompt_uuid, prompt_num, json.dumps(answer),
+                                         round(lat, 10), round(lon, 10), ts.isoformat(),
+                                         (ts + timedelta(seconds=20)).isoformat(), None))
+                for ts, lat, lon in rng.sample(track, min(len(track), _lognormal_count(rng, cancelled))):
+                    cancels.append((survey_id, mobile_id, str(uuid.UUID(int=rng.getrandbits(128))),
+                                    round(lat, 10), round(lon, 10), ts.isoformat(),
+                                    (ts + timedelta(seconds=rng.randint(5, 600))).isoformat(),
+                                    rng.choice(['t', 'f'])))
+
+            _copy(cur, 'mobile_survey_responses', ['survey_id', 'mobile_id', 'response'], responses)
+            _copy(cur, 'mobile_coordinates', ['survey_id', 'mobile_id', 'latitude', 'longitude', 'altitude',
+                                              'speed', 'direction', 'h_accuracy', 'v_accuracy',
+                                              'acceleration_x', 'acceleration_y', 'acceleration_z',
+                                              'mode_detected', 'point_type', 'timestamp'], points)
+            _copy(cur, 'mobile_prompt_responses', ['survey_id', 'mobile_id', 'prompt_uuid', 'prompt_num',
+                                                   'response', 'latitude', 'longitude', 'displayed_at',
+                                                   'recorded_at', 'edited_at'], answered)
+            _copy(cur, 'mobile_cancelled_prompt_responses', ['survey_id', 'mobile_id', 'prompt_uuid',
+                                                             'latitude', 'longitude', 'displayed_at',
+                                                             'cancelled_at', 'is_travelling'], cancels)
+            _copy(cur, 'statistics_mobile_users', ['survey_id', 'mobile_id', 'total_coordinates'],
+                  [(survey_id, mobile_id, 0) for mobile_id, _ in mobile_users])
+            conn.commit()
+
+            for table, rows in [('mobile_users', user_rows), ('mobile_survey_responses', responses),
+                                ('mobile_coordinates', points), ('mobile_prompt_responses', answered),
+                                ('mobile_cancelled_prompt_responses', cancels)]:
+                counts[table] = counts.get(table, 0) + len(rows)
+        cur.execute('ANALYZE;')
+    conn.commit()
+    return counts
+
+
+def connect(cfg, force=False):
+    if 'bench' not in cfg['source_db']['dbname'] and not force:
+        print('Refusing to overwrite tables in a database without "bench" in its name; '
+              'pass --force to use {db}.'.format(db=cfg['source_db']['dbname']))
+        sys.exit(1)
+    return psycopg2.connect(**cfg['source_db'])
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Generate a synthetic Itinerum dataset.')
+    parser.add_argument('--config', default='./bench_config.json',
+                        help='JSON config with a `source_db` section for a disposable database')
+    parser.add_argument('--surveys', type=int, default=5)
+    parser.add_argument('--users', type=int, default=200, help='mean users per survey')
+    parser.add_argument('--coordinates', type=int, default=2000, help='mean coordinates per user')
+    parser.add_argument('--prompts', type=int, default=20, help='mean prompt responses per user')
+    parser.add_argument('--cancelled', type=int, default=5, help='mean cancelled prompts per user')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--force', action='store_true')
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    with open(args.config, 'r') as cfg_f:
+        cfg = json.load(cfg_f)
+    conn = connect(cfg, force=args.force)
+    counts = generate(conn, surveys=args.surveys, users=args.users, coordinates=args.coordinates,
+                      prompts=args.prompts, cancelled=args.cancelled, seed=args.seed)
+    print(json.dumps(counts, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# Compare the .tracks coordinates archive (`trackfile`) against coordinates.csv
+# compressed like the `-csv.tar.gz` export: archive size, encode time and the
+# time to stream the rows back (csv.reader over gzip yields strings, the
+# TrackReader typed rows), plus the largest rounding error of each column.
+#
+# Run from the `archiver` directory, on synthetic GPS tracks or on the
+# coordinates of an exported survey:
+#   python3 -m benchmarks.tracks [--users 50 --points 2000]
+#   python3 -m benchmarks.tracks --sqlite output/<survey>.sqlite
+import argparse
+import csv
+from datetime import datetime, timedelta
+from decimal import Decimal
+import gzip
+import json
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import dateutil.parser
+import pytz
+
+import csv_formatters
+import trackfile
+
+
+def synthetic_tracks(users=50, points=2000, seed=0):
+    '''Random-walk GPS tracks with irregular sampling, grouped by user in time
+       order, as rows from `fetch_coordinate_tracks`.'''
+    rng = random.Random(seed)
+    start = datetime(2018, 5, 1, 8, 0, 0, tzinfo=pytz.UTC)
+    tracks = []
+    for mobile_id in range(users):
+        uuid = '{:032x}'.format(rng.getrandbits(128))
+        lat, lon = rng.uniform(45.4, 45.6), rng.uniform(-73.7, -73.5)
+        altitude, speed, direction = rng.uniform(20, 60), 0., rng.uniform(0, 360)
+        ts = start + timedelta(seconds=rng.randint(0, 86400))
+        for _ in range(points):
+            ts += timedelta(seconds=rng.choice([1, 1, 1, 5, 5, 30, 300]),
+                            microseconds=rng.randint(0, 999999))
+            speed = min(max(speed + rng.gauss(0, 0.5), 0.), 30.)
+            direction = (direction + rng.gauss(0, 5)) % 360
+            altitude += rng.gauss(0, 0.3)
+            lat += rng.gauss(0, 0.0002)
+            lon += rng.gauss(0, 0.0002)
+            tracks.append((uuid, {
+                'mobile_id': mobile_id,
+                'latitude': Decimal('{:.6f}'.format(lat)),
+                'longitude': Decimal('{:.6f}'.format(lon)),
+                'altitude': Decimal('{:.2f}'.format(altitude)),
+                'speed': Decimal('{:.2f}'.format(speed)),
+                'direction': Decimal('{:.2f}'.format(direction)),
+                'h_accuracy': Decimal(rng.choice([5, 10, 10, 10, 65])),
+                'v_accuracy': Decimal(rng.choice([3, 4, 6, 10])),
+                'acceleration_x': Decimal('{:.3f}'.format(rng.gauss(0, 0.2))),
+                'acceleration_y': Decimal('{:.3f}'.format(rng.gauss(0, 0.2))),
+                'acceleration_z': Decimal('{:.3f}'.format(rng.gauss(9.8, 0.2))),
+                'mode_detected': rng.choice([None, 1, 1, 1, 2, 3]),
+                'point_type': rng.choice([None, 0, 0, 0, 1]),
+                'timestamp_UTC': ts,
+                'timestamp_epoch': int(round(ts.timestamp()))
+            }))
+    return tracks
+
+
+def sqlite_tracks(fp):
+    '''The coordinates of an exported survey .sqlite, grouped by user in time order.'''
+    conn = sqlite3.connect(fp)
+    conn.row_factory = sqlite3.Row
+    sql = '''SELECT mobile_users.uuid, mobile_coordinates.*
+             FROM mobile_coordinates
+             JOIN mobile_users ON mobile_coordinates.mobile_id = mobile_users.id
+             ORDER BY mobile_coordinates.mobile_id, mobile_coordinates.timestamp, mobile_coordinates.id;'''
+    tracks = []
+    for row in conn.execute(sql):
+        point = dict(row)
+        ts = dateutil.parser.parse(point.pop('timestamp'))
+        point['timestamp_UTC'] = ts
+        point['timestamp_epoch'] = int(round(ts.timestamp()))
+        tracks.append((point.pop('uuid'), point))
+    conn.close()
+    return tracks
+
+
+def _best(fn, repeats):
+    best = None
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def run(tracks, tmp_dir, repeats=3):
+    header = trackfile.HEADER
+    csv_fp = os.path.join(tmp_dir, 'coordinates.csv.gz')
+    tracks_fp = os.path.join(tmp_dir, 'coordinates.tracks')
+
+    def _write_csv():
+        rows = []
+        for uuid, point in tracks:
+            point = dict(point, uuid=uuid)
+            rows.append(csv_formatters.coordinate_row(header, point))
+        with gzip.open(csv_fp, 'wt', compresslevel=9) as csv_f:
+            writer = csv.writer(csv_f)
+            writer.writerow(header)
+            writer.writerows(rows)
+        return rows
+
+    def _write_tracks():
+        with trackfile.TrackWriter(tracks_fp, skip_duplicates=False) as writer:
+            for uuid, point in tracks:
+                writer.add(uuid, point)
+
+    def _read_csv():
+        with gzip.open(csv_fp, 'rt') as csv_f:
+            reader = csv.reader(csv_f)
+            next(reader)
+            return list(reader)
+
+    def _read_tracks():
+        with trackfile.TrackReader(tracks_fp) as reader:
+            return list(reader)
+
+    csv_encode, expected = _best(_write_csv, repeats)
+    tracks_encode, _ = _best(_write_tracks, repeats)
+    csv_decode, _ = _best(_read_csv, repeats)
+    tracks_decode, decoded = _best(_read_tracks, repeats)
+
+    # rounding error of each column against the rows coordinates.csv holds
+    max_error = {}
+    for expected_row, row in zip(expected, decoded):
+        for col, a, b in zip(header, expected_row, row):
+            if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+                max_error[col] = max(max_error.get(col, 0.), abs(a - b))
+            elif a != b:
+                max_error[col] = float('inf')
+
+    n = len(tracks)
+    return {
+        'rows': n,
+        'csv.gz': {
+            'bytes': os.path.getsize(csv_fp),
+            'encode_ns_per_row': round(csv_encode / n * 1e9, 1),
+            'decode_ns_per_row': round(csv_decode / n * 1e9, 1)
+        },
+        'tracks': {
+            'bytes': os.path.getsize(tracks_fp),
+            'encode_ns_per_row': round(tracks_encode / n * 1e9, 1),
+            'decode_ns_per_row': round(tracks_decode / n * 1e9, 1)
+        },
+        'max_error': {col: round(err, 9) for col, err in max_error.items() if err}
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the .tracks coordinates archive.')
+    parser.add_argument('--sqlite', help='read coordinates from an exported survey .sqlite')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--points', type=int, default=2000, help='points per synthetic user')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--output', help='write the JSON report to this file')
+    args = parser.parse_args()
+
+    if args.sqlite:
+        tracks = sqlite_tracks(args.sqlite)
+    else:
+        tracks = synthetic_tracks(args.users, args.points)
+    tmp_dir = tempfile.mkdtemp(prefix='archiver-tracks-')
+    try:
+        report = run(tracks, tmp_dir, repeats=args.repeats)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    print('{:<10} {:>14} {:>16} {:>16}'.format('format', 'bytes', 'encode ns/row', 'decode ns/row'))
+    for fmt in ['csv.gz', 'tracks']:
+        r = report[fmt]
+        print('{:<10} {:>14} {:>16} {:>16}'.format(fmt, r['bytes'], r['encode_ns_per_row'],
+                                                   r['decode_ns_per_row']))
+    print('{rows} rows, .tracks is {ratio:.1f}x smaller; max rounding error: {err}'.format(
+        rows=report['rows'], ratio=report['csv.gz']['bytes'] / float(report['tracks']['bytes']),
+        err=json.dumps(report['max_error'])))
+    if args.output:
+        with open(args.output, 'w') as report_f:
+            json.dump(report, report_f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
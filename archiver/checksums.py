@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# SHA-256 checksums and sizes of archive artifacts computed while they are
+# written, recorded to the `artifacts` manifest of `exports.sqlite` so files
+# can be listed and verified later without reading them back.
+import hashlib
+
+
+ARTIFACT_COLS = ['timestamp', 'survey_id', 'survey_name', 'artifact', 'rows', 'bytes',
+                 'compressed_bytes', 'sha256']
+
+
+class HashingWriter(object):
+    '''Wrap a binary file opened for writing to hash and count the bytes
+       written through it. With `hashed=False`, bytes are only counted (e.g.
+       the uncompressed side of a gzip stream).'''
+
+    def __init__(self, f, hashed=True):
+        self._f = f
+        self._sha256 = hashlib.sha256() if hashed else None
+        self.bytes = 0
+
+    def write(self, data):
+        self._f.write(data)
+        self.bytes += len(data)
+        if self._sha256:
+            self._sha256.update(data)
+        return len(data)
+
+    def tell(self):
+        # artifacts are written sequentially from the start of a new file
+        return self.bytes
+
+    def flush(self):
+        self._f.flush()
+
+    @property
+    def closed(self):
+        return self._f.closed
+
+    def close(self):
+        self._f.close()
+
+    @property
+    def sha256(self):
+        return self._sha256.hexdigest() if self._sha256 else None
+
+
+def manifest_entry(artifact, rows, size, compressed_bytes, sha256):
+    '''An artifact's manifest record: `size` is its uncompressed size and
+       `compressed_bytes` the size of the file on disk.'''
+    return {
+        'artifact': artifact,
+        'rows': rows,
+        'bytes': size,
+        'compressed_bytes': compressed_bytes,
+        'sha256': sha256
+    }
@@ -12,6 +12,9 @@ import database
 ## GLOBALS
 EXPORTS_DATA_DIR = './output'
 WORKING_DATA_DIR = './temp'
+ARCHIVE_EXTENSIONS = ('.gz', '.tracks')
+# artifacts every exported survey has; others (e.g. .tracks) are optional
+CORE_ARTIFACTS = ['{survey}.sqlite.gz', '{survey}.psql.gz', '{survey}-csv.tar.gz']
 
 exports_db = database.ExportsDatabase('./exports.sqlite')
 
@@ -23,20 +26,29 @@ def fetch_surveys_to_push():
     return [s for s, in exports_db._db_cur.fetchall()]
 
 
-# group completed exports into a single .zip archive in temp dir
+# group completed exports into a single .zip archive in temp dir, listing each
+# survey's files from the artifacts manifest; surveys exported before the
+# manifest was recorded are found by scanning the exports directory
 def create_archive_file_groups(survey_names):
     archive_groups = {}
-    for filename in os.listdir(EXPORTS_DATA_DIR):
-        base_name = filename.split('.')[0].split('-')[0]
-        if base_name in survey_names and filename.endswith('.gz'):
-            archive_groups.setdefault(base_name, []).append(filename)
+    for survey_name, artifact, _, _ in exports_db.fetch_artifacts(survey_names):
+        # files within directories (e.g. <survey>-seekable/) are uploaded separately
+        if '/' not in artifact:
+            archive_groups.setdefault(survey_name, []).append(artifact)
+    unlisted = set(survey_names) - set(archive_groups)
+    if unlisted:
+        for filename in os.listdir(EXPORTS_DATA_DIR):
+            base_name = filename.split('.')[0].split('-')[0]
+            if base_name in unlisted and filename.endswith(ARCHIVE_EXTENSIONS):
+                archive_groups.setdefault(base_name, []).append(filename)
     return archive_groups
 
 
 def create_single_file_archive(file_groups):
     archives = []
     for survey_name, group in file_groups.items():
-        if len(group) != 3:
+        core_artifacts = [fn.format(survey=survey_name) for fn in CORE_ARTIFACTS]
+        if not all(fn in group for fn in core_artifacts):
             print(group)
             continue
 
@@ -55,6 +67,21 @@ def create_single_file_archive(file_groups):
     return archives
 
 
+# upload seekable directories as separate objects so that single users can be
+# read from cold storage with range GETs instead of downloading the .zip
+def upload_seekable(archives):
+    s3 = boto3.resource('s3')
+    uploaded_bytes = 0
+    survey_names = [survey_name for survey_name, _, _ in archives]
+    for survey_name, artifact, compressed_bytes, _ in exports_db.fetch_artifacts(survey_names):
+        if not artifact.startswith('{survey}-seekable/'.format(survey=survey_name)):
+            continue
+        fp = os.path.join(EXPORTS_DATA_DIR, artifact)
+        s3.meta.client.upload_file(fp, 'itinerum-cold-storage', artifact)
+        uploaded_bytes += compressed_bytes
+    return uploaded_bytes
+
+
 def upload_s3(cfg, archives):
     s3 = boto3.resource('s3')
     for survey_name, archive_fn, archive_fp in archives:
@@ -79,7 +106,17 @@ def push_archives_to_s3(cfg):
     survey_names = fetch_surveys_to_push()
     file_groups = create_archive_file_groups(survey_names)
     archives = create_single_file_archive(file_groups)
+    seekable_bytes = upload_seekable(archives)
     upload_s3(cfg, archives)
 
+    # tally archives pushed, bytes of exports archived and bytes uploaded
+    exports_bytes = sum(os.path.getsize(os.path.join(EXPORTS_DATA_DIR, fn))
+                        for survey_name, _, _ in archives
+                        for fn in file_groups[survey_name])
+    uploaded_bytes = sum(os.path.getsize(archive_fp) for _, _, archive_fp in archives)
+    exports_bytes += seekable_bytes
+    uploaded_bytes += seekable_bytes
+
     # clean-up temp data dir
     shutil.rmtree(WORKING_DATA_DIR)
+    return len(archives), exports_bytes, uploaded_bytes
@@ -1,18 +1,46 @@
 #!/usr/bin/env python3
 # Kyle Fitzsimmons, 2018
+from contextlib import contextmanager
 from datetime import datetime
+import itertools
 import json
 import logging
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.pool
 import pytz
 import sqlite3
+import threading
+import time
+
+import pgbinary
 
 
 logger = logging.getLogger(__name__)
 
 
+APPLICATION_NAME = 'itinerum-archiver'
 HARDCODED_SERVER_START_TIME = datetime(2017, 5, 1, 0, 0, 0, tzinfo=pytz.UTC)
+BATCHED_DELETE_TABLES = [
+    'mobile_coordinates',
+    'mobile_prompt_responses',
+    'mobile_cancelled_prompt_responses',
+    'mobile_users'
+]
+# tables with rows removed by `delete_survey`, directly or through ON DELETE CASCADE
+DELETE_SURVEY_TABLES = BATCHED_DELETE_TABLES + [
+    'mobile_survey_responses',
+    'prompt_questions',
+    'statistics_mobile_users',
+    'statistics_surveys',
+    'survey_questions',
+    'survey_subway_stops',
+    'surveys',
+    'tokens_password_reset',
+    'tokens_researcher_invite',
+    'web_users'
+]
 POSTGRES_SQLITE_TYPES = {
     'numeric': 'REAL',
     'integer': 'INTEGER',
@@ -22,21 +50,133 @@ POSTGRES_SQLITE_TYPES = {
     'jsonb': 'TEXT',
     'boolean': 'INTEGER'
 }
+# rows fetched per round trip by the server-side cursors of `_stream_query`
+STREAM_ITERSIZE = 10000
+
+
+# cursor-scoped typecasters for `select_all_raw_chunks`: jsonb is passed through
+# as the text PostgreSQL sends instead of being parsed and re-serialized, and
+# numeric is decoded straight to float instead of Decimal (NULLs stay None)
+NUMERIC_FLOAT = psycopg2.extensions.new_type(
+    psycopg2.extensions.DECIMAL.values, 'NUMERIC_FLOAT',
+    lambda value, cur: float(value) if value is not None else None)
+JSON_TEXT = psycopg2.extensions.new_type(
+    (114, 3802), 'JSON_TEXT',
+    lambda value, cur: value)
+
+
+def format_sqlite_row(row, json_cols=None, float_cols=None):
+    '''Serialize json columns to text and numeric columns to float for SQLite.'''
+    if json_cols:
+        for col in json_cols:
+            row[col] = json.dumps(row[col])
+    if float_cols:
+        for col in float_cols:
+            if row[col] is not None:
+                row[col] = float(row[col])
+    return row
+
+
+class ConnectionPool(object):
+    '''Thread-safe pool of connections to a single PostgreSQL database. Borrowing
+       blocks once `maxconn` connections are checked out so parallel workers
+       can never open more than `maxconn` connections against production.'''
+
+    def __init__(self, host, dbname, port, user, password, minconn=1, maxconn=4,
+                 statement_timeout=None, application_name=APPLICATION_NAME,
+                 health_check=True):
+        options = None
+        if statement_timeout:
+            options = '-c statement_timeout={ms}'.format(ms=int(statement_timeout))
+        self._pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn,
+                                                          dbname=dbname,
+                                                          user=user,
+                                                          password=password,
+                                                          host=host,
+                                                          port=port,
+                                                          application_name=application_name,
+                                                          options=options,
+                                                          cursor_factory=psycopg2.extras.DictCursor)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self.health_check = health_check
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        if conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if not self.health_check:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1;')
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def getconn(self):
+        self._slots.acquire()
+        try:
+            conn = self._pool.getconn()
+            if not self._healthy(conn):
+                logger.info('Replacing broken pooled connection')
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        return conn
+
+    def putconn(self, conn):
+        try:
+            self._pool.putconn(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        self._pool.closeall()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(host, dbname, port, user, password, **pool_cfg):
+    '''Return the shared connection pool for a set of credentials, creating it
+       with `pool_cfg` (minconn, maxconn, statement_timeout, application_name,
+       health_check) on first use.'''
+    key = (host, port, dbname, user)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(host, dbname, port, user, password, **pool_cfg)
+        return _pools[key]
 
 
 class PostgreSQLDatabase(object):
 
-    def __init__(self, host, dbname, port, user, password):
-        self._db_conn = psycopg2.connect(dbname=dbname,
-                                         user=user,
-                                         password=password,
-                                         host=host,
-                                         port=port,
-                                         cursor_factory=psycopg2.extras.DictCursor)
+    def __init__(self, host, dbname, port, user, password, pool_cfg=None):
+        self._pool = get_pool(host, dbname, port, user, password, **(pool_cfg or {}))
+        self._db_conn = self._pool.getconn()
         self._db_cur = self._db_conn.cursor()
 
     def __del__(self):
-        self._db_conn.close()
+        self.close()
+
+    def close(self):
+        '''Return the borrowed connection to the shared pool.'''
+        if getattr(self, '_db_conn', None) is not None:
+            self._db_cur.close()
+            self._pool.putconn(self._db_conn)
+            self._db_conn = None
 
     def _query(self, query, params=None):
         return self._db_cur.execute(query, params)
@@ -71,17 +211,22 @@ class PostgreSQLDatabase(object):
         columns = [d[0] for d in self._db_cur.description]
         return columns
 
-    def table_schema(self, table_name):
+    def table_types(self, table_name):
+        '''Return the (name, PostgreSQL type) of each column in table order.'''
         sql = '''
-            SELECT column_name, data_type, character_maximum_length
+            SELECT column_name, data_type
             FROM INFORMATION_SCHEMA.COLUMNS
-            WHERE table_name = '{table}';
+            WHERE table_name = '{table}'
+            ORDER BY ordinal_position;
         '''.format(
             table=table_name
         )
         self._query(sql)
+        return [(name, dtype) for name, dtype in self._db_cur.fetchall()]
+
+    def table_schema(self, table_name):
         columns = []
-        for name, dtype, _ in self._db_cur.fetchall():
+        for name, dtype in self.table_types(table_name):
             sqlite_dtype = POSTGRES_SQLITE_TYPES[dtype]
             columns.append((name, sqlite_dtype))
         return columns
@@ -89,44 +234,108 @@ class PostgreSQLDatabase(object):
     def vacuum(self):
         old_isolation_level = self._db_conn.isolation_level
         self._db_conn.set_isolation_level(0)
+        try:
+            logger.info('Analyze source database for vacuum')
+            sql1 = '''VACUUM FULL ANALYZE;'''
+            self._query(sql1)
+            logger.info('Performing vacuum on source database')
+            sql2 = '''VACUUM FULL;'''
+            self._query(sql2)
+            self._db_conn.commit()
+            logger.info('Source database vacuum complete')
+        finally:
+            self._db_conn.set_isolation_level(old_isolation_level)
 
-        logger.info('Analyze source database for vacuum')
-        sql1 = '''VACUUM FULL ANALYZE;'''
-        self._query(sql1)
-        logger.info('Performing vacuum on source database')
-        sql2 = '''VACUUM FULL;'''
-        self._query(sql2)
+    def dead_tuples(self, table_names):
+        sql = '''
+            SELECT relname, n_live_tup, n_dead_tup
+            FROM pg_stat_user_tables
+            WHERE relname = ANY(%s);
+        '''
+        self._query(sql, [list(table_names)])
+        stats = {name: (live, dead) for name, live, dead in self._db_cur.fetchall()}
         self._db_conn.commit()
-        logger.info('Source database vacuum complete')
+        return stats
+
+    def maintain_tables(self, table_names, rewrite_ratio=0.5, min_dead_tuples=10000):
+        '''Vacuum only the given tables, one at a time. Tables where dead tuples
+           make up at least `rewrite_ratio` of all tuples are rewritten with
+           VACUUM FULL, tables with at least `min_dead_tuples` dead tuples get a
+           plain VACUUM and the rest are skipped. Returns a list of
+           (table, action, dead tuples, seconds) tuples.'''
+        old_isolation_level = self._db_conn.isolation_level
+        stats = self.dead_tuples(table_names)
+        self._db_conn.set_isolation_level(0)
+        try:
+            results = []
+            for table_name in table_names:
+                live, dead = stats.get(table_name, (0, 0))
+                ratio = dead / float(live + dead) if live + dead else 0.
+                if dead and ratio >= rewrite_ratio:
+                    action = 'VACUUM (FULL, ANALYZE)'
+                elif dead >= min_dead_tuples:
+                    action = 'VACUUM (ANALYZE)'
+                else:
+                    logger.info('Skip maintenance of {table}: {dead} dead tuples'.format(
+                        table=table_name, dead=dead))
+                    continue
 
-        self._db_conn.set_isolation_level(old_isolation_level)
+                logger.info('{action} {table}: {dead} dead tuples ({ratio:.0%})'.format(
+                    action=action, table=table_name, dead=dead, ratio=ratio))
+                t0 = time.time()
+                self._query('{action} {table};'.format(action=action, table=table_name))
+                elapsed = time.time() - t0
+                logger.info('{table} maintenance complete in {s:.1f}s'.format(table=table_name,
+                                                                            s=elapsed))
+                results.append((table_name, action, dead, elapsed))
+        finally:
+            self._db_conn.set_isolation_level(old_isolation_level)
+        return results
 
 
 
 class ItinerumDatabase(PostgreSQLDatabase):
-    def __init__(self, host, dbname, port, user, password):
-        super().__init__(host, dbname, port, user, password)
+    def __init__(self, host, dbname, port, user, password, pool_cfg=None):
+        super().__init__(host, dbname, port, user, password, pool_cfg)
+        self._cursor_ids = itertools.count()
+
+    def _stream_query(self, query, params=None, itersize=STREAM_ITERSIZE):
+        '''Run `query` on a named (server-side) cursor and yield its rows,
+           fetching `itersize` at a time so only one batch is held in memory.'''
+        name = 'archiver_stream_{n}'.format(n=next(self._cursor_ids))
+        with self._db_conn.cursor(name=name) as cur:
+            cur.itersize = itersize
+            cur.execute(query, params)
+            for row in cur:
+                yield row
+        self._db_conn.commit()
 
-    def delete_survey(self, survey_id):
+    def delete_survey(self, survey_id, batch_size=None, sleep=0.5, max_sleep=30.,
+                      max_replication_lag=None, max_active_queries=None,
+                      progress=None, checkpoint=None):
+        '''Delete all records of a survey. When `batch_size` is set, the mobile
+           tables are deleted in separate transactions of `batch_size` rows (see
+           `_delete_batches`) instead of one transaction for the whole survey.
+           Returns the number of mobile table rows deleted.'''
         # delete from tables progressively even though CASCADE is in place
         # to less load while dropping from each table individually
-        
-        # delete mobile data
-        sql1 = '''DELETE FROM mobile_coordinates WHERE survey_id={id}'''.format(
-            id=survey_id)
-        self._query(sql1)
-
-        sql2 = '''DELETE FROM mobile_prompt_responses WHERE survey_id={id}'''.format(
-            id=survey_id)
-        self._query(sql2)
-
-        sql3 = '''DELETE FROM mobile_cancelled_prompt_responses WHERE survey_id={id}'''.format(
-            id=survey_id)
-        self._query(sql3)
-
-        sql4 = '''DELETE FROM mobile_users WHERE survey_id={id}'''.format(
-            id=survey_id)
-        self._query(sql4)
+        deleted = 0
+        if batch_size:
+            for table_name in BATCHED_DELETE_TABLES:
+                deleted += self._delete_batches(table_name, survey_id, batch_size,
+                                     sleep=sleep,
+                                     max_sleep=max_sleep,
+                                     max_replication_lag=max_replication_lag,
+                                     max_active_queries=max_active_queries,
+                                     last_id=(progress or {}).get(table_name),
+                                     checkpoint=checkpoint)
+        else:
+            # delete mobile data
+            for table_name in BATCHED_DELETE_TABLES:
+                sql = '''DELETE FROM {table} WHERE survey_id={id}'''.format(
+                    table=table_name, id=survey_id)
+                self._query(sql)
+                deleted += self._db_cur.rowcount
 
         # delete dashboard data
         sql5 = '''
@@ -146,11 +355,118 @@ class ItinerumDatabase(PostgreSQLDatabase):
         self._query(sql6)
 
         multi_idx_name = 'survey{id}_multi_idx'.format(id=survey_id)
-        sql7 = '''DROP INDEX {name};'''.format(name=multi_idx_name)
+        sql7 = '''DROP INDEX IF EXISTS {name};'''.format(name=multi_idx_name)
         self._query(sql7)
 
         self._db_conn.commit()
+        return deleted
 
+    def _delete_batches(self, table_name, survey_id, batch_size, sleep, max_sleep,
+                        max_replication_lag, max_active_queries, last_id=None,
+                        checkpoint=None):
+        '''Delete a survey's rows from a table in ascending id order, committing
+           every `batch_size` rows. Between batches the delay doubles (up to
+           `max_sleep`) while replication lag (bytes) or the number of other
+           active queries exceeds its limit, and decays back to `sleep` once the
+           server recovers. `checkpoint(table_name, last_id)` is called after each
+           commit so an interrupted delete can resume from `last_id`. Returns
+           the number of rows deleted.'''
+        sql = '''SELECT MIN(id), MAX(id), COUNT(*) FROM {table} WHERE survey_id={id};'''.format(
+            table=table_name, id=survey_id)
+        self._query(sql)
+        min_id, max_id, total = self._db_cur.fetchone()
+        self._db_conn.commit()
+        if max_id is None:
+            return 0
+        if last_id is None:
+            last_id = min_id - 1
+        else:
+            logger.info('Resuming delete from {table} after id {id}'.format(table=table_name,
+                                                                           id=last_id))
+        if checkpoint:
+            checkpoint(table_name, last_id)
+
+        boundary_sql = '''
+            SELECT id
+            FROM {table}
+            WHERE survey_id={id}
+            AND id > {last_id}
+            ORDER BY id
+            OFFSET {offset}
+            LIMIT 1;
+        '''
+        delete_sql = '''
+            DELETE FROM {table}
+            WHERE survey_id={id}
+            AND id > {last_id}
+            AND id <= {upper_id};
+        '''
+        deleted = 0
+        delay = sleep
+        t0 = time.time()
+        while last_id < max_id:
+            self._query(boundary_sql.format(table=table_name, id=survey_id,
+                                            last_id=last_id, offset=batch_size - 1))
+            row = self._db_cur.fetchone()
+            upper_id = row[0] if row else max_id
+
+            self._query(delete_sql.format(table=table_name, id=survey_id,
+                                          last_id=last_id, upper_id=upper_id))
+            deleted += self._db_cur.rowcount
+            self._db_conn.commit()
+            last_id = upper_id
+            if checkpoint:
+                checkpoint(table_name, last_id)
+
+            elapsed = time.time() - t0
+            logger.info('Deleted {n}/{total} rows from {table} ({rate:.0f} rows/s, last id {id})'.format(
+                n=deleted, total=total, table=table_name, rate=deleted / max(elapsed, 1e-6), id=last_id))
+
+            if last_id < max_id:
+                if self._under_pressure(max_replication_lag, max_active_queries):
+                    delay = min(max(delay, 0.1) * 2, max_sleep)
+                    logger.info('Throttling delete, sleeping {s:.1f}s'.format(s=delay))
+                else:
+                    delay = max(sleep, delay / 2)
+                time.sleep(delay)
+        return deleted
+
+    def _under_pressure(self, max_replication_lag, max_active_queries):
+        if max_replication_lag is not None:
+            lag = self.replication_lag()
+            if lag is not None and lag > max_replication_lag:
+                return True
+        if max_active_queries is not None:
+            if self.active_queries() > max_active_queries:
+                return True
+        return False
+
+    def active_queries(self):
+        sql = '''
+            SELECT COUNT(*)
+            FROM pg_stat_activity
+            WHERE state = 'active'
+            AND pid <> pg_backend_pid();
+        '''
+        self._query(sql)
+        count, = self._db_cur.fetchone()
+        self._db_conn.commit()
+        return count
+
+    def replication_lag(self):
+        '''Largest replay lag in bytes across connected standbys.'''
+        sql = '''
+            SELECT COALESCE(MAX(pg_wal_lsn_diff(pg_current_wal_lsn(), replay_lsn)), 0)
+            FROM pg_stat_replication;
+        '''
+        try:
+            self._query(sql)
+            lag, = self._db_cur.fetchone()
+            self._db_conn.commit()
+        except psycopg2.Error:
+            self._db_conn.rollback()
+            return None
+        return lag
 
     def end_time(self, survey_id):
         sql = '''
@@ -174,8 +490,14 @@ class ItinerumDatabase(PostgreSQLDatabase):
         return end
 
     def fetch_coordinates(self, survey_id):
-        offset = 0
-        chunk_size = 500000
+        for rows in self.fetch_coordinates_chunks(survey_id):
+            for row in rows:
+                yield row
+
+    def fetch_coordinates_chunks(self, survey_id, chunk_size=500000, sizer=None):
+        '''Yield a survey's coordinates in keyset chunks of `chunk_size` rows,
+           or of the size chosen by a `pipeline.ChunkSizer` when given.'''
+        offset = -1
         sql = '''SELECT mobile_coordinates.id, mobile_coordinates.mobile_id, mobile_coordinates.latitude, mobile_coordinates.longitude,
                         mobile_coordinates.altitude, mobile_coordinates.speed, mobile_coordinates.direction,
                         mobile_coordinates.h_accuracy, mobile_coordinates.v_accuracy, mobile_coordinates.acceleration_x,
@@ -184,26 +506,41 @@ class ItinerumDatabase(PostgreSQLDatabase):
                         DATE_PART('epoch', mobile_coordinates.timestamp)::integer AS timestamp_epoch
                  FROM mobile_coordinates
                  WHERE mobile_coordinates.survey_id={survey_id}
-                 AND id >= {offset}
+                 AND id > {offset}
                  ORDER BY id
                  LIMIT {chunk_size};'''
 
-        last_offset = -1
         while True:
+            if sizer:
+                chunk_size = sizer.size
             slice_sql = sql.format(
                 survey_id=survey_id,
                 offset=offset,
                 chunk_size=chunk_size
             )
+            t0 = time.time()
             self._query(slice_sql)
-            for row in self._db_cur.fetchall():
-                offset = row['id']
-                yield row
-
-            if offset == last_offset:
+            rows = self._db_cur.fetchall()
+            if sizer:
+                sizer.observe(rows, time.time() - t0)
+            if not rows:
                 break
-            last_offset = offset
+            offset = rows[-1]['id']
+            yield rows
 
+    def fetch_coordinate_tracks(self, survey_id):
+        '''Stream a survey's coordinates grouped by user in time order, the
+           order `trackfile.TrackWriter` stores them in.'''
+        sql = '''SELECT mobile_coordinates.mobile_id, mobile_coordinates.latitude, mobile_coordinates.longitude,
+                        mobile_coordinates.altitude, mobile_coordinates.speed, mobile_coordinates.direction,
+                        mobile_coordinates.h_accuracy, mobile_coordinates.v_accuracy, mobile_coordinates.acceleration_x,
+                        mobile_coordinates.acceleration_y, mobile_coordinates.acceleration_z, mobile_coordinates.mode_detected,
+                        mobile_coordinates.point_type, mobile_coordinates.timestamp AS "timestamp_UTC",
+                        DATE_PART('epoch', mobile_coordinates.timestamp)::integer AS timestamp_epoch
+                 FROM mobile_coordinates
+                 WHERE mobile_coordinates.survey_id=%s
+                 ORDER BY mobile_coordinates.mobile_id, mobile_coordinates.timestamp, mobile_coordinates.id;'''
+        return self._stream_query(sql, [survey_id])
 
     def fetch_cancelled_prompt_responses(self, survey_id):
         sql = '''SELECT mobile_users.uuid, mobile_cancelled_prompt_responses.prompt_uuid,
@@ -271,8 +608,12 @@ class ItinerumDatabase(PostgreSQLDatabase):
         return self._db_cur.fetchall()
 
     def select_all(self, table_name, survey_id, json_cols=None, float_cols=None):
+        for rows in self.select_all_chunks(table_name, survey_id):
+            for row in rows:
+                yield format_sqlite_row(row, json_cols, float_cols)
+
+    def select_all_chunks(self, table_name, survey_id, chunk_size=500000, sizer=None):
         offset = 0
-        chunk_size = 500000
         sql = '''
             SELECT *
             FROM {table}
@@ -281,29 +622,157 @@ class ItinerumDatabase(PostgreSQLDatabase):
             ORDER BY id
             LIMIT {chunk_size};
         '''
-        last_offset = -1
         while True:
+            if sizer:
+                chunk_size = sizer.size
             slice_sql = sql.format(
                 table=table_name,
                 id=survey_id,
                 offset=offset,
                 chunk_size=chunk_size
             )
+            t0 = time.time()
             self._query(slice_sql)
-            for row in self._db_cur.fetchall():
-                offset = row['id']
-                if json_cols:
-                    for col in json_cols:
-                        row[col] = json.dumps(row[col])
-                if float_cols:
-                    for col in float_cols:
-                        if row[col] is not None:
-                            row[col] = float(row[col])
-                yield row
-
-            if offset == last_offset:
+            rows = self._db_cur.fetchall()
+            if sizer:
+                sizer.observe(rows, time.time() - t0)
+            if not rows:
                 break
-            last_offset = offset
+            offset = rows[-1]['id']
+            yield rows
+
+    def select_all_raw_chunks(self, table_name, survey_id, columns, chunk_size=500000, sizer=None):
+        '''Like `select_all_chunks`, but yield plain tuples of `columns` (in that
+           order) with jsonb as raw text and numeric as float, ready to be
+           inserted into SQLite without `format_sqlite_row`.'''
+        id_idx = columns.index('id')
+        offset = 0
+        sql = '''
+            SELECT {cols}
+            FROM {table}
+            WHERE survey_id = {id}
+            AND id > {offset}
+            ORDER BY id
+            LIMIT {chunk_size};
+        '''
+        with self._db_conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+            psycopg2.extensions.register_type(NUMERIC_FLOAT, cur)
+            psycopg2.extensions.register_type(JSON_TEXT, cur)
+            while True:
+                if sizer:
+                    chunk_size = sizer.size
+                slice_sql = sql.format(
+                    cols=', '.join(columns),
+                    table=table_name,
+                    id=survey_id,
+                    offset=offset,
+                    chunk_size=chunk_size
+                )
+                t0 = time.time()
+                cur.execute(slice_sql)
+                rows = cur.fetchall()
+                if sizer:
+                    sizer.observe(rows, time.time() - t0)
+                if not rows:
+                    break
+                offset = rows[-1][id_idx]
+                yield rows
+
+    def copy_binary_chunks(self, table_name, survey_id, columns, batch_size=50000,
+                           buffer_size=1 << 20):
+        '''Stream all rows of `survey_id` with a binary COPY and yield them in
+           batches of `batch_size` lists ordered as `columns`, a list of (name,
+           PostgreSQL type). Values are in SQLite form: numeric as float, jsonb
+           as text and timestamps as text in the session time zone, as the
+           default path stores them. The pool's statement timeout is lifted
+           for the COPY.'''
+        select_cols, codes = pgbinary.copy_columns(columns)
+        sql = '''
+            COPY (
+                SELECT {cols}
+                FROM {table}
+                WHERE survey_id = {id}
+                ORDER BY id
+            ) TO STDOUT (FORMAT binary);
+        '''.format(
+            cols=', '.join(select_cols),
+            table=table_name,
+            id=survey_id
+        )
+        return pgbinary.stream_copy(self._db_conn, sql, codes, batch_size=batch_size,
+                                    buffer_size=buffer_size)
+
+    def time_spans(self, survey_ids, since_ids=None):
+        '''Return the first and last coordinate timestamps and the highest
+           coordinate id of every survey in `survey_ids` in a single grouped
+           query, only reading each survey's coordinates with an id above its
+           entry in `since_ids` ({survey_id: coordinate id}, 0 when missing).'''
+        since_ids = since_ids or {}
+        sql = '''
+            SELECT c.survey_id,
+                   MIN(c.timestamp) FILTER (WHERE c.timestamp >= %(init_cutoff)s) AS survey_start,
+                   MAX(c.timestamp) FILTER (WHERE c.timestamp >= %(init_cutoff)s
+                                            AND c.timestamp <= %(now_cutoff)s) AS survey_end,
+                   MAX(c.id) AS max_id
+            FROM mobile_coordinates c
+            JOIN unnest(%(survey_ids)s::integer[], %(since_ids)s::bigint[]) AS s(survey_id, since_id)
+                ON c.survey_id = s.survey_id
+                AND c.id > s.since_id
+            GROUP BY c.survey_id;
+        '''
+        survey_ids = list(survey_ids)
+        params = {
+            'init_cutoff': HARDCODED_SERVER_START_TIME,
+            'now_cutoff': datetime.now(pytz.utc),
+            'survey_ids': survey_ids,
+            'since_ids': [since_ids.get(survey_id) or 0 for survey_id in survey_ids]
+        }
+        self._query(sql, params)
+        return {survey_id: (start, end, max_id)
+                for survey_id, start, end, max_id in self._db_cur.fetchall()}
+
+    def table_sizes(self, table_names):
+        '''Return {table: (estimated rows, heap and TOAST bytes)} from the
+           planner statistics in pg_class, without scanning the tables.'''
+        sql = '''
+            SELECT relname,
+                   GREATEST(reltuples, 0)::bigint,
+                   pg_total_relation_size(oid) - pg_indexes_size(oid)
+            FROM pg_class
+            WHERE relname = ANY(%s)
+            AND relkind = 'r';
+        '''
+        self._query(sql, [list(table_names)])
+        sizes = {name: (rows, size) for name, rows, size in self._db_cur.fetchall()}
+        self._db_conn.commit()
+        return sizes
+
+    def survey_id_stats(self, table_names):
+        '''Return {table: (null_frac, n_distinct, most common survey ids,
+           their frequencies)} of each table's `survey_id` column in pg_stats.'''
+        sql = '''
+            SELECT tablename, null_frac, n_distinct,
+                   most_common_vals::text::bigint[], most_common_freqs
+            FROM pg_stats
+            WHERE tablename = ANY(%s)
+            AND attname = 'survey_id';
+        '''
+        self._query(sql, [list(table_names)])
+        stats = {row[0]: tuple(row[1:]) for row in self._db_cur.fetchall()}
+        self._db_conn.commit()
+        return stats
+
+    def survey_row_counts(self, table_name, survey_ids):
+        sql = '''
+            SELECT survey_id, COUNT(*)
+            FROM {table}
+            WHERE survey_id = ANY(%s)
+            GROUP BY survey_id;
+        '''.format(table=table_name)
+        self._query(sql, [list(survey_ids)])
+        counts = {survey_id: count for survey_id, count in self._db_cur.fetchall()}
+        self._db_conn.commit()
+        return counts
 
     def start_time(self, survey_id):
         sql = '''
@@ -331,6 +800,77 @@ class ItinerumDatabase(PostgreSQLDatabase):
         lookup = {id: uuid for id, uuid in self._db_cur.fetchall()}
         return lookup
 
+    # Batched reads for many small surveys: each source table is read once for
+    # all of `survey_ids` ordered by survey so the rows can be split per survey
+    # with `itertools.groupby` as they stream in.
+    def uuids_by_surveys(self, survey_ids):
+        sql = '''SELECT id, uuid FROM mobile_users WHERE survey_id = ANY(%s);'''
+        self._query(sql, [list(survey_ids)])
+        lookup = {id: uuid for id, uuid in self._db_cur.fetchall()}
+        return lookup
+
+    def select_all_by_surveys(self, table_name, survey_ids):
+        sql = '''
+            SELECT *
+            FROM {table}
+            WHERE survey_id = ANY(%s)
+            ORDER BY survey_id, id;
+        '''.format(table=table_name)
+        return self._stream_query(sql, [list(survey_ids)])
+
+    def fetch_coordinates_by_surveys(self, survey_ids):
+        sql = '''SELECT mobile_coordinates.survey_id, mobile_coordinates.id, mobile_coordinates.mobile_id,
+                        mobile_coordinates.latitude, mobile_coordinates.longitude,
+                        mobile_coordinates.altitude, mobile_coordinates.speed, mobile_coordinates.direction,
+                        mobile_coordinates.h_accuracy, mobile_coordinates.v_accuracy, mobile_coordinates.acceleration_x,
+                        mobile_coordinates.acceleration_y, mobile_coordinates.acceleration_z, mobile_coordinates.mode_detected,
+                        mobile_coordinates.point_type, mobile_coordinates.timestamp AS "timestamp_UTC",
+                        DATE_PART('epoch', mobile_coordinates.timestamp)::integer AS timestamp_epoch
+                 FROM mobile_coordinates
+                 WHERE mobile_coordinates.survey_id = ANY(%s)
+                 ORDER BY mobile_coordinates.survey_id, mobile_coordinates.id;'''
+        return self._stream_query(sql, [list(survey_ids)])
+
+    def fetch_cancelled_prompt_responses_by_surveys(self, survey_ids):
+        sql = '''SELECT mobile_cancelled_prompt_responses.survey_id,
+                        mobile_users.uuid, mobile_cancelled_prompt_responses.prompt_uuid,
+                        mobile_cancelled_prompt_responses.latitude, mobile_cancelled_prompt_responses.longitude,
+                        mobile_cancelled_prompt_responses.displayed_at AS "displayed_at_UTC",
+                        DATE_PART('epoch', mobile_cancelled_prompt_responses.displayed_at)::integer AS displayed_at_epoch,
+                        mobile_cancelled_prompt_responses.cancelled_at AS "cancelled_at_UTC",
+                        DATE_PART('epoch', mobile_cancelled_prompt_responses.cancelled_at)::integer AS cancelled_at_epoch,
+                        mobile_cancelled_prompt_responses.is_travelling
+                 FROM mobile_cancelled_prompt_responses
+                 JOIN mobile_users ON (mobile_cancelled_prompt_responses.mobile_id=mobile_users.id)
+                 WHERE mobile_cancelled_prompt_responses.survey_id = ANY(%s)
+                 ORDER BY mobile_cancelled_prompt_responses.survey_id, mobile_cancelled_prompt_responses.id;'''
+        return self._stream_query(sql, [list(survey_ids)])
+
+    def fetch_survey_responses_by_surveys(self, survey_ids):
+        sql = '''SELECT *
+                 FROM mobile_survey_responses
+                 JOIN mobile_users ON mobile_survey_responses.mobile_id=mobile_users.id
+                 WHERE mobile_users.survey_id = ANY(%s)
+                 ORDER BY mobile_users.survey_id, mobile_users.created_at;'''
+        return self._stream_query(sql, [list(survey_ids)])
+
+    def fetch_prompt_responses_by_surveys(self, survey_ids):
+        sql = '''SELECT mobile_prompt_responses.survey_id,
+                        mobile_users.uuid, mobile_prompt_responses.prompt_uuid, mobile_prompt_responses.response,
+                        mobile_prompt_responses.latitude, mobile_prompt_responses.longitude,
+                        mobile_prompt_responses.displayed_at AS "displayed_at_UTC",
+                        DATE_PART('epoch', mobile_prompt_responses.displayed_at)::integer AS displayed_at_epoch,
+                        mobile_prompt_responses.recorded_at AS "recorded_at_UTC",
+                        DATE_PART('epoch', mobile_prompt_responses.recorded_at)::integer AS recorded_at_epoch,
+                        mobile_prompt_responses.edited_at AS "edited_at_UTC",
+                        DATE_PART('epoch', mobile_prompt_responses.edited_at)::integer AS edited_at_epoch
+                 FROM mobile_prompt_responses
+                 JOIN mobile_users ON (mobile_prompt_responses.mobile_id=mobile_users.id)
+                 WHERE mobile_prompt_responses.survey_id = ANY(%s)
+                 ORDER BY mobile_prompt_responses.survey_id, mobile_prompt_responses.displayed_at,
+                          mobile_prompt_responses.prompt_uuid, mobile_prompt_responses.prompt_num;'''
+        return self._stream_query(sql, [list(survey_ids)])
+
 
 class ExportsDatabase(object):
 
@@ -339,7 +879,13 @@ class ExportsDatabase(object):
         self._db_cur = self._db_conn.cursor()
 
     def __del__(self):
-        self._db_conn.close()
+        self.close()
+
+    def close(self):
+        if getattr(self, '_db_conn', None) is not None:
+            self._db_cur.close()
+            self._db_conn.close()
+            self._db_conn = None
 
     def _query(self, query, params=None):
         if not params:
@@ -376,6 +922,149 @@ class ExportsDatabase(object):
         self._query(sql)
         self._db_conn.commit()
 
+    def create_survey_spans_table(self):
+        sql = '''
+            CREATE TABLE IF NOT EXISTS survey_spans (
+                survey_id INTEGER UNIQUE,
+                survey_start INTEGER,
+                survey_end INTEGER,
+                max_coordinate_id INTEGER
+            );
+        '''
+        self._query(sql)
+        self._db_conn.commit()
+
+    def fetch_survey_spans(self):
+        sql = '''
+            SELECT survey_id, survey_start, survey_end, max_coordinate_id
+            FROM survey_spans;
+        '''
+        self._query(sql)
+        return {row[0]: row[1:] for row in self._db_cur.fetchall()}
+
+    def create_delete_progress_table(self):
+        sql = '''
+            CREATE TABLE IF NOT EXISTS delete_progress (
+                survey_id INTEGER,
+                table_name TEXT,
+                last_id INTEGER,
+                UNIQUE(survey_id, table_name)
+            );
+        '''
+        self._query(sql)
+        self._db_conn.commit()
+
+    def clear_delete_progress(self, survey_id):
+        sql = '''DELETE FROM delete_progress WHERE survey_id=?;'''
+        self._query(sql, [survey_id])
+        self._db_conn.commit()
+
+    def fetch_interrupted_deletes(self):
+        sql = '''SELECT DISTINCT survey_id FROM delete_progress;'''
+        self._query(sql)
+        return [survey_id for survey_id, in self._db_cur.fetchall()]
+
+    def fetch_delete_progress(self, survey_id):
+        sql = '''
+            SELECT table_name, last_id
+            FROM delete_progress
+            WHERE survey_id=?;
+        '''
+        self._query(sql, [survey_id])
+        return dict(self._db_cur.fetchall())
+
+    def create_export_metrics_table(self):
+        sql = '''
+            CREATE TABLE IF NOT EXISTS export_metrics (
+                run_timestamp INTEGER,
+                survey_id INTEGER,
+                survey_name TEXT,
+                stage TEXT,
+                started_at REAL,
+                ended_at REAL,
+                rows INTEGER,
+                bytes_read INTEGER,
+                bytes_written INTEGER,
+                compressed_bytes INTEGER,
+                UNIQUE(run_timestamp, survey_name, stage)
+            );
+        '''
+        self._query(sql)
+        self._db_conn.commit()
+
+    def create_artifacts_table(self):
+        sql = '''
+            CREATE TABLE IF NOT EXISTS artifacts (
+                timestamp INTEGER,
+                survey_id INTEGER,
+                survey_name TEXT,
+                artifact TEXT,
+                rows INTEGER,
+                bytes INTEGER,
+                compressed_bytes INTEGER,
+                sha256 TEXT,
+                UNIQUE(survey_name, artifact)
+            );
+        '''
+        self._query(sql)
+        self._db_conn.commit()
+
+    def clear_artifacts(self, survey_name):
+        '''Remove the manifest entries of a survey's previous export.'''
+        sql = '''DELETE FROM artifacts WHERE survey_name=?;'''
+        self._query(sql, [survey_name])
+        self._db_conn.commit()
+
+    def fetch_artifacts(self, survey_names):
+        '''Return the (survey_name, artifact, compressed_bytes, sha256) manifest
+           entries of the given surveys.'''
+        sql = '''
+            SELECT survey_name, artifact, compressed_bytes, sha256
+            FROM artifacts
+            WHERE survey_name IN ({names})
+            ORDER BY survey_name, artifact;
+        '''.format(names=', '.join(['?'] * len(survey_names)))
+        self._query(sql, list(survey_names))
+        return self._db_cur.fetchall()
+
+    def fetch_export_metrics(self, run_timestamp=None):
+        '''Return the `export_metrics` rows of a run, the latest by default.'''
+        if run_timestamp is None:
+            self._query('''SELECT MAX(run_timestamp) FROM export_metrics;''')
+            run_timestamp, = self._db_cur.fetchone()
+        sql = '''
+            SELECT run_timestamp, survey_id, survey_name, stage, started_at, ended_at,
+                   rows, bytes_read, bytes_written, compressed_bytes
+            FROM export_metrics
+            WHERE run_timestamp=?
+            ORDER BY started_at;
+        '''
+        self._query(sql, [run_timestamp])
+        return self._db_cur.fetchall()
+
+    def fetch_export_rates(self):
+        '''Return (rows per second, compression ratio) of all survey stages
+           recorded in `export_metrics`, or None for either without history.
+           Batch stages cover several surveys and are recorded without a
+           survey name, so their rows and time are added to the surveys' own.'''
+        sql = '''
+            SELECT SUM(CASE WHEN stage IN ('sqlite', 'batch_sqlite') THEN rows ELSE 0 END),
+                   SUM(ended_at - started_at),
+                   SUM(CASE WHEN stage = 'compress' THEN bytes_read ELSE 0 END),
+                   SUM(CASE WHEN stage = 'compress' THEN compressed_bytes ELSE 0 END)
+            FROM export_metrics
+            WHERE survey_name IS NOT NULL
+            OR stage IN ('batch_sqlite', 'batch_csv');
+        '''
+        self._query(sql)
+        rows, seconds, staged_bytes, compressed_bytes = self._db_cur.fetchone()
+        rate, ratio = None, None
+        if rows and seconds:
+            rate = rows / seconds
+        if staged_bytes and compressed_bytes:
+            ratio = compressed_bytes / float(staged_bytes)
+        return rate, ratio
+
     def fetch_active_statuses(self):
         sql = '''
             SELECT survey_name, survey_start, survey_last_update
@@ -5,6 +5,8 @@ from email.mime.text import MIMEText
 from prettytable import PrettyTable
 import smtplib
 
+import metrics
+
 
 def send(recipient, sender_cfg, msg):
     with smtplib.SMTP(host=sender_cfg['host'],
@@ -16,7 +18,24 @@ def send(recipient, sender_cfg, msg):
         smtp.login(sender_cfg['address'], sender_cfg['password'])
         smtp.sendmail(sender_cfg['address'], recipient, msg.as_string())
 
-def send_message(export_timestamp, recipient, sender_cfg, records):
+def metrics_table(records):
+    table = PrettyTable()
+    table.field_names = ['stage', 'surveys', 'seconds', 'rows', 'rows/s', 'MB read',
+                         'MB written', 'MB compressed']
+    for total in metrics.summarize(records):
+        seconds = total['seconds']
+        table.add_row([total['stage'],
+                       total['surveys'],
+                       round(seconds, 1),
+                       total['rows'],
+                       round(total['rows'] / seconds) if seconds else None,
+                       round(total['bytes_read'] / 1e6, 1),
+                       round(total['bytes_written'] / 1e6, 1),
+                       round(total['compressed_bytes'] / 1e6, 1)])
+    return table
+
+
+def send_message(export_timestamp, recipient, sender_cfg, records, metrics=None):
     export_timestamp_UTC = datetime.utcfromtimestamp(export_timestamp).isoformat()
 
     table = PrettyTable()
@@ -45,6 +64,13 @@ def send_message(export_timestamp, recipient, sender_cfg, records):
             'No inactive surveys to backup.'
         ]
 
+    if metrics:
+        lines += [
+            '',
+            'Run time by stage:',
+            str(metrics_table(metrics))
+        ]
+
     msg = MIMEText('\n'.join(lines))
     msg['Subject'] = 'Itinerum data-archiver run: {ts}'.format(ts=export_timestamp_UTC)
     msg['From'] = sender_cfg['address']
@@ -7,7 +7,10 @@ import shutil
 import sqlite3
 import tarfile
 
-from sh import pg_dump
+import sh
+
+import checksums
+from database import APPLICATION_NAME
 
 
 def write_csv(fp, header, rows):
@@ -36,6 +39,9 @@ def write_coordinates_csv(fp, header, rows):
 
 
 def dump_psql_copy_tables(fp, survey_name, *args, **kwargs):
+    '''Dump the survey's temporary copy tables under their original names to
+       a .psql.gz and return its manifest entry, with the rows of its COPY
+       blocks counted and the file hashed as the dump streams through.'''
     tables = ['mobile_users',
               'mobile_coordinates',
               'mobile_prompt_responses',
@@ -43,37 +49,79 @@ def dump_psql_copy_tables(fp, survey_name, *args, **kwargs):
     temp_tables = ['temp_{table}_{survey}'.format(table=t, survey=survey_name)
                    for t in tables]
 
-    with gzip.open(fp, 'wb') as dump_f:
-        def _preprocesser(line):
-            for idx, table in enumerate(tables):
-                line = line.replace(temp_tables[idx], table)
-            dump_f.write(line.encode())
-
-        pg_dump('-h', kwargs['host'],
-                '-U', kwargs['user'],
-                '-p', kwargs['port'],
-                '-t', temp_tables[0],
-                '-t', temp_tables[1],
-                '-t', temp_tables[2],
-                '-t', temp_tables[3],
-                kwargs['dbname'],
-                _out=_preprocesser)
+    dumped_bytes = 0
+    dumped_rows = 0
+    in_copy = False
+    with open(fp, 'wb') as raw_f:
+        hashed_f = checksums.HashingWriter(raw_f)
+        with gzip.GzipFile(filename=os.path.basename(fp)[:-len('.gz')], mode='wb',
+                           fileobj=hashed_f) as dump_f:
+            def _preprocesser(line):
+                nonlocal dumped_bytes, dumped_rows, in_copy
+                if in_copy:
+                    if line.startswith('\\.'):
+                        in_copy = False
+                    else:
+                        dumped_rows += 1
+                elif line.startswith('COPY '):
+                    in_copy = True
+                for idx, table in enumerate(tables):
+                    line = line.replace(temp_tables[idx], table)
+                line = line.encode()
+                dumped_bytes += len(line)
+                dump_f.write(line)
+
+            sh.pg_dump('-h', kwargs['host'],
+                       '-U', kwargs['user'],
+                       '-p', kwargs['port'],
+                       '-t', temp_tables[0],
+                       '-t', temp_tables[1],
+                       '-t', temp_tables[2],
+                       '-t', temp_tables[3],
+                       kwargs['dbname'],
+                       _out=_preprocesser,
+                       _env=dict(os.environ, PGAPPNAME=APPLICATION_NAME + '-pg_dump'))
+    return checksums.manifest_entry(os.path.basename(fp), dumped_rows, dumped_bytes,
+                                    hashed_f.bytes, hashed_f.sha256)
 
 
 def create_archive(fp_or_dir):
+    '''Compress a file to .gz or a directory to .tar.gz, removing the original,
+       and return the archive path and its manifest entry (rows left unset).'''
     if os.path.isfile(fp_or_dir):
         fp = fp_or_dir
         archive_fp = fp + '.gz'
-        with open(fp, 'rb') as f:
-            with gzip.open(archive_fp, 'wb') as archive_f:
-                shutil.copyfileobj(f, archive_f)
-        os.remove(fp)
     else:
         _dir = fp_or_dir
         archive_fp = _dir + '.tar.gz'
-        with tarfile.open(archive_fp, 'w:gz') as tar_f:
-            tar_f.add(_dir, arcname=os.path.basename(_dir))
+    with open(archive_fp, 'wb') as raw_f:
+        hashed_f = checksums.HashingWriter(raw_f)
+        with gzip.GzipFile(filename=os.path.basename(archive_fp)[:-len('.gz')], mode='wb',
+                           fileobj=hashed_f) as archive_f:
+            counted_f = checksums.HashingWriter(archive_f, hashed=False)
+            if os.path.isfile(fp_or_dir):
+                with open(fp, 'rb') as f:
+                    shutil.copyfileobj(f, counted_f)
+            else:
+                with tarfile.open(fileobj=counted_f, mode='w|') as tar_f:
+                    tar_f.add(_dir, arcname=os.path.basename(_dir))
+    if os.path.isfile(fp_or_dir):
+        os.remove(fp)
+    else:
         shutil.rmtree(_dir)
+    return archive_fp, checksums.manifest_entry(os.path.basename(archive_fp), None, counted_f.bytes,
+                                                hashed_f.bytes, hashed_f.sha256)
+
+
+def path_size(fp_or_dir):
+    '''Total size in bytes of a file or of all files within a directory.'''
+    if os.path.isfile(fp_or_dir):
+        return os.path.getsize(fp_or_dir)
+    total = 0
+    for root, _, filenames in os.walk(fp_or_dir):
+        for fn in filenames:
+            total += os.path.getsize(os.path.join(root, fn))
+    return total
 
 
 class SQLiteDatabase(object):
@@ -108,6 +156,7 @@ class SQLiteDatabase(object):
         self._query(sql)
 
     def insert_many(self, table_name, columns, rows):
+        '''Insert `rows` in chunks and return the number of rows inserted.'''
         sql = '''
             INSERT INTO {table} ({cols}) VALUES ({vals});
         '''.format(
@@ -129,3 +178,33 @@ class SQLiteDatabase(object):
                 chunk = []
         self._db_cur.executemany(sql, chunk)
         self._db_conn.commit()
+        return i * chunk_size + len(chunk)
+
+    def index_coordinates(self, table_name='mobile_coordinates'):
+        '''Add an integer `epoch` column (UTC seconds of `timestamp`, rounded
+           like `timestamp_epoch` in coordinates.csv) indexed with `mobile_id`,
+           an R*Tree `<table>_rtree` of the points keyed by the table's rowid,
+           and ANALYZE statistics for the query planner. Returns the number of
+           points added to the R*Tree.'''
+        sqls = [
+            '''ALTER TABLE {table} ADD COLUMN epoch INTEGER;''',
+            '''
+                UPDATE {table}
+                SET epoch = CAST(ROUND((julianday(timestamp) - 2440587.5) * 86400) AS INTEGER);
+            ''',
+            '''CREATE INDEX {table}_mobile_id_epoch_idx ON {table} (mobile_id, epoch);''',
+            '''CREATE VIRTUAL TABLE {table}_rtree USING rtree(id, min_lat, max_lat, min_lon, max_lon);''',
+            '''
+                INSERT INTO {table}_rtree
+                SELECT rowid, latitude, latitude, longitude, longitude
+                FROM {table}
+                WHERE latitude IS NOT NULL
+                AND longitude IS NOT NULL;
+            '''
+        ]
+        for sql in sqls:
+            self._query(sql.format(table=table_name))
+        points = self._db_cur.rowcount
+        self._query('ANALYZE;')
+        self._db_conn.commit()
+        return points
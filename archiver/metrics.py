@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# Per-stage timing, row and byte accounting of archiver runs.
+from contextlib import contextmanager, nullcontext
+import threading
+import time
+
+
+METRICS_COLS = ['run_timestamp', 'survey_id', 'survey_name', 'stage', 'started_at', 'ended_at',
+                'rows', 'bytes_read', 'bytes_written', 'compressed_bytes']
+
+
+class StageMetrics(object):
+    def __init__(self, run_timestamp, stage, survey_id=None, survey_name=None):
+        self.run_timestamp = run_timestamp
+        self.stage = stage
+        self.survey_id = survey_id
+        self.survey_name = survey_name
+        self.started_at = None
+        self.ended_at = None
+        self.rows = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.compressed_bytes = 0
+        # finer-grained counts that are exported to Prometheus but not saved
+        self.table_rows = {}
+        self.artifact_bytes = {}
+
+    @property
+    def seconds(self):
+        return (self.ended_at or time.time()) - self.started_at
+
+    def record(self):
+        return [getattr(self, col) for col in METRICS_COLS]
+
+
+class MetricsRecorder(object):
+    '''Collect timing, row and byte counts of every archiver stage of a run;
+       completed stages are written to the `export_metrics` table of the
+       exports db with `save`. With a `profiling.StageProfiler`, each stage is
+       also profiled. Stages still in progress are listed in `running`.'''
+
+    def __init__(self, run_timestamp, profiler=None):
+        self.run_timestamp = run_timestamp
+        self.profiler = profiler
+        self.stages = []
+        self.running = []
+        self._unsaved = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, survey_id=None, survey_name=None):
+        metrics = StageMetrics(self.run_timestamp, name, survey_id, survey_name)
+        profile = self.profiler.stage(name, survey_name) if self.profiler else nullcontext()
+        metrics.started_at = time.time()
+        with self._lock:
+            self.running.append(metrics)
+        try:
+            with profile:
+                yield metrics
+        finally:
+            metrics.ended_at = time.time()
+            with self._lock:
+                self.running.remove(metrics)
+                self.stages.append(metrics)
+                self._unsaved.append(metrics)
+
+    def save(self, exports_db):
+        with self._lock:
+            unsaved, self._unsaved = self._unsaved, []
+        if unsaved:
+            exports_db.upsert_many('export_metrics', METRICS_COLS, [m.record() for m in unsaved])
+
+    def records(self):
+        with self._lock:
+            return [m.record() for m in self.stages]
+
+    def snapshot(self):
+        '''Return lists of the completed and the running stages.'''
+        with self._lock:
+            return list(self.stages), list(self.running)
+
+
+def summarize(records):
+    '''Total `export_metrics` rows by stage, in order of first appearance, as
+       dicts of stage, surveys, seconds, rows, bytes_read, bytes_written and
+       compressed_bytes.'''
+    totals = {}
+    for record in records:
+        row = dict(zip(METRICS_COLS, record))
+        total = totals.setdefault(row['stage'], {
+            'stage': row['stage'],
+            'surveys': 0,
+            'seconds': 0.,
+            'rows': 0,
+            'bytes_read': 0,
+            'bytes_written': 0,
+            'compressed_bytes': 0
+        })
+        if row['survey_name']:
+            total['surveys'] += 1
+        total['seconds'] += (row['ended_at'] or row['started_at']) - row['started_at']
+        for col in ['rows', 'bytes_read', 'bytes_written', 'compressed_bytes']:
+            total[col] += row[col] or 0
+    return list(totals.values())
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+# Decode the PostgreSQL binary COPY format (`COPY ... TO STDOUT (FORMAT binary)`)
+# into tuples ready for SQLite. numeric and jsonb are cast in the COPY query to
+# float8 and text so that every field is either fixed-width or UTF-8 text; rows
+# without NULLs in all fixed-width tables are unpacked with a single struct call.
+# Each timestamptz is followed by its UTC offset in the session time zone, so
+# it is formatted exactly as the datetime psycopg2 would return.
+from datetime import datetime, timedelta, timezone
+import queue
+import struct
+import threading
+
+import pytz
+
+
+SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+HEADER = struct.Struct('>11sii')
+INT16 = struct.Struct('>h')
+INT32 = struct.Struct('>i')
+# PostgreSQL type (as in `database.POSTGRES_SQLITE_TYPES`) -> (cast applied in the
+# COPY query, field code); `t` is a timestamp of int64 microseconds since 2000-01-01,
+# copied with a `z` field of its int32 UTC offset seconds
+COPY_TYPES = {
+    'numeric': ('float8', 'd'),
+    'integer': (None, 'i'),
+    'double precision': (None, 'd'),
+    'timestamp with time zone': (None, 't'),
+    'character varying': (None, 's'),
+    'jsonb': ('text', 's'),
+    'boolean': (None, '?')
+}
+FIELD_FORMATS = {'d': 'd', 'i': 'i', 't': 'q', 'z': 'i', '?': '?'}
+FIELD_STRUCTS = {code: struct.Struct('>' + fmt) for code, fmt in FIELD_FORMATS.items()}
+POSTGRES_EPOCH = datetime(2000, 1, 1, tzinfo=pytz.UTC)
+TIMESTAMP_INFINITY = 2 ** 63 - 1
+TIMESTAMP_NEG_INFINITY = -2 ** 63
+# psycopg2 returns +/-infinity timestamptz as the datetime limits in UTC
+TIMESTAMP_LIMITS = {
+    TIMESTAMP_INFINITY: datetime.max.replace(tzinfo=timezone.utc).isoformat(' '),
+    TIMESTAMP_NEG_INFINITY: datetime.min.replace(tzinfo=timezone.utc).isoformat(' ')
+}
+_DONE = object()
+
+
+def copy_columns(columns):
+    '''Return the SELECT list and field codes for `columns`, a list of
+       (name, PostgreSQL type).'''
+    select_cols = []
+    codes = []
+    for name, pg_type in columns:
+        cast, code = COPY_TYPES[pg_type]
+        select_cols.append('{col}::{cast}'.format(col=name, cast=cast) if cast else name)
+        codes.append(code)
+        if code == 't':
+            select_cols.append('EXTRACT(TIMEZONE FROM {col})::integer'.format(col=name))
+            codes.append('z')
+    return select_cols, codes
+
+
+_timezones = {}
+
+
+def format_timestamp(microseconds, offset):
+    '''Format a binary timestamptz and its session UTC offset in seconds as
+       sqlite3's datetime adapter does the datetime psycopg2 returns.'''
+    if microseconds in TIMESTAMP_LIMITS:
+        return TIMESTAMP_LIMITS[microseconds]
+    tz = _timezones.get(offset)
+    if tz is None:
+        tz = _timezones.setdefault(offset, timezone(timedelta(seconds=offset)))
+    return (POSTGRES_EPOCH + timedelta(microseconds=microseconds)).astimezone(tz).isoformat(' ')
+
+
+class BinaryCopyDecoder(object):
+    '''Incrementally decode a binary COPY stream: `feed` any amount of data and
+       get back the complete rows it contained, with the remainder buffered
+       until the next call. Timestamps are returned as text, without their
+       offset fields.'''
+
+    def __init__(self, codes):
+        self.codes = codes
+        self.finished = False
+        self._buffer = bytearray()
+        self._header = False
+        # from the last, so popping an offset leaves the earlier indexes in place
+        self._timestamps = [idx for idx, code in reversed(list(enumerate(codes))) if code == 't']
+        self._fixed = None
+        if all(code in FIELD_FORMATS for code in codes):
+            fmt = '>h' + ''.join('i' + FIELD_FORMATS[code] for code in codes)
+            self._fixed = struct.Struct(fmt)
+            self._lengths = tuple(FIELD_STRUCTS[code].size for code in codes)
+
+    def _read_header(self, buf, end):
+        if end < HEADER.size:
+            return None
+        signature, _, extension_len = HEADER.unpack_from(buf, 0)
+        if signature != SIGNATURE:
+            raise ValueError('Not a PostgreSQL binary COPY stream')
+        if end < HEADER.size + extension_len:
+            return None
+        self._header = True
+        return HEADER.size + extension_len
+
+    def _decode_row(self, buf, pos, end):
+        '''Decode the row at `pos` field by field, returning (row, next pos) or
+           (None, pos) if the row is incomplete or the trailer was reached.'''
+        start = pos
+        if pos + 2 > end:
+            return None, start
+        num_fields, = INT16.unpack_from(buf, pos)
+        pos += 2
+        if num_fields == -1:
+            self.finished = True
+            return None, pos
+        if num_fields != len(self.codes):
+            raise ValueError('Expected {n} fields, got {m}'.format(n=len(self.codes), m=num_fields))
+
+        row = []
+        for code in self.codes:
+            if pos + 4 > end:
+                return None, start
+            length, = INT32.unpack_from(buf, pos)
+            pos += 4
+            if length == -1:
+                row.append(None)
+                continue
+            if pos + length > end:
+                return None, start
+            if code == 's':
+                row.append(str(buf[pos:pos + length], 'utf-8'))
+            else:
+                row.append(FIELD_STRUCTS[code].unpack_from(buf, pos)[0])
+            pos += length
+        return row, pos
+
+    def feed(self, data):
+        self._buffer += data
+        rows = []
+        with memoryview(self._buffer) as buf:
+            end = len(buf)
+            pos = 0
+            if not self._header:
+                pos = self._read_header(buf, end)
+                if pos is None:
+                    return rows
+            fixed = self._fixed
+            while not self.finished:
+                if fixed and pos + fixed.size <= end:
+                    values = fixed.unpack_from(buf, pos)
+                    # any NULL shifts the layout and shows up as a length mismatch
+                    if values[1::2] == self._lengths:
+                        rows.append(list(values[2::2]))
+                        pos += fixed.size
+                        continue
+                row, pos = self._decode_row(buf, pos, end)
+                if row is None:
+                    break
+                rows.append(row)
+        del self._buffer[:pos]
+
+        if self._timestamps:
+            for row in rows:
+                for idx in self._timestamps:
+                    offset = row.pop(idx + 1)
+                    if row[idx] is not None:
+                        row[idx] = format_timestamp(row[idx], offset)
+        return rows
+
+
+class _BufferedWriter(object):
+    '''File-like target for `copy_expert` that hands the COPY data to a queue
+       in blocks of at least `buffer_size` bytes.'''
+
+    def __init__(self, out_q, buffer_size, stop):
+        self.out_q = out_q
+        self.buffer_size = buffer_size
+        self.stop = stop
+        self._buffer = bytearray()
+
+    def _put(self, data):
+        while not self.stop.is_set():
+            try:
+                self.out_q.put(data, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        raise RuntimeError('binary COPY reader was closed')
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= self.buffer_size:
+            self._put(bytes(self._buffer))
+            self._buffer = bytearray()
+
+    def flush(self):
+        if self._buffer:
+            self._put(bytes(self._buffer))
+            self._buffer = bytearray()
+
+
+def stream_copy(conn, sql, codes, batch_size=50000, buffer_size=1 << 20, queue_size=4):
+    '''Run a binary COPY TO STDOUT on `conn` in a background thread and yield
+       decoded rows in batches of `batch_size` as the data arrives. At most
+       `queue_size` blocks of `buffer_size` bytes are held between the two.'''
+    blocks = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def _copy():
+        writer = _BufferedWriter(blocks, buffer_size, stop)
+        result = _DONE
+        try:
+            with conn.cursor() as cur:
+                # one statement copies a whole table: lift the pool's statement
+                # timeout for the COPY only
+                cur.execute('SET LOCAL statement_timeout = 0;')
+                cur.copy_expert(sql, writer, size=buffer_size)
+                cur.execute('SET LOCAL statement_timeout TO DEFAULT;')
+            writer.flush()
+        except Exception as e:
+            result = e
+        blocks.put(result)
+
+    thread = threading.Thread(target=_copy, name='binary-copy')
+    thread.daemon = True
+    thread.start()
+
+    decoder = BinaryCopyDecoder(codes)
+    batch = []
+    try:
+        while True:
+            block = blocks.get()
+            if block is _DONE:
+                break
+            if isinstance(block, Exception):
+                raise block
+            batch.extend(decoder.feed(block))
+            while len(batch) >= batch_size:
+                yield batch[:batch_size]
+                batch = batch[batch_size:]
+        if not decoder.finished:
+            raise ValueError('binary COPY stream ended without a trailer')
+        if batch:
+            yield batch
+    finally:
+        # unblock and wait for the COPY thread if the reader stops early
+        stop.set()
+        while thread.is_alive():
+            try:
+                blocks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        thread.join()
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+import logging
+import queue
+import sys
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class StageStats(object):
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.batches = 0
+        self.rows = 0
+        self.busy = 0.
+        self.elapsed = 0.
+        self._lock = threading.Lock()
+
+    def add(self, rows, busy):
+        with self._lock:
+            self.batches += 1
+            self.rows += rows
+            self.busy += busy
+
+    @property
+    def throughput(self):
+        '''Rows per second of pipeline wall-clock time.'''
+        if not self.elapsed:
+            return 0.
+        return self.rows / self.elapsed
+
+    @property
+    def utilization(self):
+        '''Fraction of the available worker time spent processing batches
+           instead of waiting on a neighbouring stage.'''
+        if not self.elapsed:
+            return 0.
+        return self.busy / (self.elapsed * self.workers)
+
+
+class PipelineAborted(Exception):
+    pass
+
+
+class Pipeline(object):
+    '''Run a fetch -> transform(s) -> sink chain of batches on separate threads
+       joined by bounded queues. The source iterator runs on its own thread, each
+       stage on `workers` threads and the sink on the calling thread, receiving
+       batches in their original order. At most `max_inflight` batches exist at
+       once, so a slow stage applies backpressure all the way to the source.'''
+
+    def __init__(self, name, queue_size=4, max_inflight=None):
+        self.name = name
+        self.queue_size = queue_size
+        self.max_inflight = max_inflight or queue_size * 2
+        self._stages = []
+
+    def add_stage(self, name, fn, workers=1):
+        self._stages.append((name, fn, max(1, int(workers))))
+        return self
+
+    def _put(self, q, item):
+        while not self._abort.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        raise PipelineAborted()
+
+    def _get(self, q):
+        while not self._abort.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        raise PipelineAborted()
+
+    def _fail(self, exc):
+        if self._error is None:
+            self._error = exc
+        self._abort.set()
+
+    def _produce(self, source, out_q, next_workers, stats):
+        try:
+            it = iter(source)
+            seq = 0
+            while True:
+                while not self._inflight.acquire(timeout=0.1):
+                    if self._abort.is_set():
+                        raise PipelineAborted()
+                t0 = time.time()
+                try:
+                    batch = next(it)
+                except StopIteration:
+                    self._inflight.release()
+                    break
+                stats.add(len(batch), time.time() - t0)
+                self._put(out_q, (seq, batch))
+                seq += 1
+            for _ in range(next_workers):
+                self._put(out_q, _DONE)
+        except PipelineAborted:
+            pass
+        except Exception as e:
+            self._fail(e)
+
+    def _work(self, fn, in_q, out_q, next_workers, stats, finished):
+        try:
+            while True:
+                item = self._get(in_q)
+                if item is _DONE:
+                    break
+                seq, batch = item
+                t0 = time.time()
+                batch = fn(batch)
+                stats.add(len(batch), time.time() - t0)
+                self._put(out_q, (seq, batch))
+
+            # the last worker of a stage to finish notifies the next stage
+            with finished['lock']:
+                finished['count'] += 1
+                last = finished['count'] == stats.workers
+            if last:
+                for _ in range(next_workers):
+                    self._put(out_q, _DONE)
+        except PipelineAborted:
+            pass
+        except Exception as e:
+            self._fail(e)
+
+    def run(self, source, sink, source_name='fetch', sink_name='write'):
+        '''Feed batches from `source` through every stage into `sink` and return
+           the list of per-stage `StageStats`.'''
+        self._abort = threading.Event()
+        self._error = None
+        self._inflight = threading.BoundedSemaphore(self.max_inflight)
+
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self._stages) + 1)]
+        source_stats = StageStats(source_name, 1)
+        stage_stats = [StageStats(name, workers) for name, _, workers in self._stages]
+        sink_stats = StageStats(sink_name, 1)
+        next_workers = [workers for _, _, workers in self._stages] + [1]
+
+        threads = [threading.Thread(target=self._produce,
+                                    args=(source, queues[0], next_workers[0], source_stats))]
+        for idx, (name, fn, workers) in enumerate(self._stages):
+            finished = {'lock': threading.Lock(), 'count': 0}
+            for _ in range(workers):
+                threads.append(threading.Thread(target=self._work,
+                                                args=(fn, queues[idx], queues[idx + 1],
+                                                      next_workers[idx + 1], stage_stats[idx],
+                                                      finished)))
+        t0 = time.time()
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        # drain the last queue on the calling thread, restoring source order
+        pending = {}
+        next_seq = 0
+        try:
+            while True:
+                item = self._get(queues[-1])
+                if item is _DONE:
+                    break
+                seq, batch = item
+                pending[seq] = batch
+                while next_seq in pending:
+                    batch = pending.pop(next_seq)
+                    t1 = time.time()
+                    sink(batch)
+                    sink_stats.add(len(batch), time.time() - t1)
+                    self._inflight.release()
+                    next_seq += 1
+        except PipelineAborted:
+            pass
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self._abort.set()
+            for t in threads:
+                t.join()
+
+        if self._error is not None:
+            raise self._error
+
+        stats = [source_stats] + stage_stats + [sink_stats]
+        elapsed = time.time() - t0
+        for s in stats:
+            s.elapsed = elapsed
+        return stats
+
+
+class ChunkSizer(object):
+    '''Choose the number of rows fetched per keyset query from a memory
+       budget and the measured row width and round-trip time. The size grows
+       while queries return in well under `target_seconds` (so fixed per-query
+       latency is amortized) and shrinks when they take much longer, but never
+       beyond what fits `buffers` chunks (fetched, queued and being formatted)
+       in `memory_budget_mb`.'''
+
+    def __init__(self, name, memory_budget_mb, buffers=1, initial_rows=10000, min_rows=1000,
+                 max_rows=1000000, target_seconds=1.0, sample_rows=100):
+        self.name = name
+        self.budget_bytes = memory_budget_mb * 1024 * 1024
+        self.buffers = max(1, buffers)
+        self.min_rows = min_rows
+        self.max_rows = max_rows
+        self.target_seconds = target_seconds
+        self.sample_rows = sample_rows
+        self.size = initial_rows
+        self.row_bytes = None
+        self.fetches = 0
+        self.rows = 0
+        self.seconds = 0.
+
+    def _measure_row_bytes(self, rows):
+        return estimate_bytes(rows, size=deep_size, sample_rows=self.sample_rows) / float(len(rows))
+
+    @property
+    def memory_cap(self):
+        '''Largest chunk for which `buffers` chunks fit in the budget.'''
+        if not self.row_bytes:
+            return self.max_rows
+        return int(self.budget_bytes / (self.row_bytes * self.buffers))
+
+    def observe(self, rows, seconds):
+        '''Record a fetched chunk and its round-trip time and pick the next size.'''
+        if not rows:
+            return
+        self.fetches += 1
+        self.rows += len(rows)
+        self.seconds += seconds
+
+        row_bytes = self._measure_row_bytes(rows)
+        # smooth the width since rows vary along the keyset (e.g. jsonb sizes)
+        self.row_bytes = row_bytes if self.row_bytes is None else 0.7 * self.row_bytes + 0.3 * row_bytes
+
+        size = self.size
+        reason = 'round trip {s:.2f}s'.format(s=seconds)
+        if len(rows) >= self.size:
+            if seconds < self.target_seconds / 2.:
+                size = self.size * 2
+            elif seconds > self.target_seconds * 2.:
+                size = self.size // 2
+        if size > self.memory_cap:
+            size = self.memory_cap
+            reason = 'memory budget of {mb:.0f} MB'.format(mb=self.budget_bytes / 1024. / 1024.)
+        size = max(self.min_rows, min(size, self.max_rows))
+        if size != self.size:
+            logger.info('{name}: chunk size {old} -> {new} rows ({width:.0f} B/row, {reason})'.format(
+                name=self.name, old=self.size, new=size, width=self.row_bytes, reason=reason))
+            self.size = size
+
+    def log_summary(self):
+        if not self.fetches:
+            return
+        logger.info('{name}: {rows} rows in {fetches} fetches, final chunk size {size} rows '
+                    '(~{width:.0f} B/row, {s:.2f}s per fetch)'.format(
+                        name=self.name,
+                        rows=self.rows,
+                        fetches=self.fetches,
+                        size=self.size,
+                        width=self.row_bytes,
+                        s=self.seconds / self.fetches))
+
+
+def deep_size(value):
+    '''Memory held by a fetched row or value, including the contents of the
+       dicts, lists and tuples within it such as parsed jsonb.'''
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(k) + deep_size(v) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(deep_size(v) for v in value)
+    return size
+
+
+def text_bytes(row):
+    '''Width in bytes of a fetched row's values as text, about what the row
+       takes on the wire or as a COPY line.'''
+    return sum(len(str(v).encode()) for v in row if v is not None)
+
+
+def estimate_bytes(rows, size=text_bytes, sample_rows=100):
+    '''Estimate the total `size` of `rows` from an even sample of at most
+       `sample_rows` of them.'''
+    if not rows:
+        return 0
+    step = max(1, len(rows) // sample_rows)
+    sample = rows[::step]
+    return int(sum(size(row) for row in sample) * len(rows) / float(len(sample)))
+
+
+class ByteCounter(object):
+    '''Count the text bytes of the rows fetched for a stage: chunks passed
+       through `count` and lists passed to `add` are estimated from a sample
+       of their rows, rows streamed through `count_rows` are each measured.'''
+
+    def __init__(self):
+        self.bytes = 0
+
+    def add(self, rows):
+        self.bytes += estimate_bytes(rows)
+        return rows
+
+    def count(self, chunks):
+        for chunk in chunks:
+            self.bytes += estimate_bytes(chunk)
+            yield chunk
+
+    def count_rows(self, rows):
+        for row in rows:
+            self.bytes += text_bytes(row)
+            yield row
+
+
+def rebatch(chunks, size):
+    '''Split each fetched chunk of rows into batches of at most `size` rows.'''
+    for chunk in chunks:
+        for idx in range(0, len(chunk), size):
+            yield chunk[idx:idx + size]
+
+
+def log_stats(label, stats):
+    for s in stats:
+        logger.info('{label} {stage}: {rows} rows in {batches} batches, '
+                    '{tput:.0f} rows/s, {util:.0%} utilization ({workers} workers)'.format(
+                        label=label,
+                        stage=s.name,
+                        rows=s.rows,
+                        batches=s.batches,
+                        tput=s.throughput,
+                        util=s.utilization,
+                        workers=s.workers))
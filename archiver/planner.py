@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# Plan an archiver run before exporting: estimate the rows and bytes of each
+# inactive survey, check the projected staging and archive space against the
+# free disk of the output directory and schedule surveys largest-first (LPT)
+# across the export workers.
+import heapq
+import os
+import shutil
+
+from prettytable import PrettyTable
+
+
+PLAN_TABLES = ['mobile_users', 'mobile_survey_responses', 'mobile_coordinates',
+               'mobile_prompt_responses', 'mobile_cancelled_prompt_responses']
+# uncompressed .sqlite and .csv outputs are each assumed to be about the size
+# of the source heap; the .psql.gz dump and the final archives are compressed
+STAGING_FACTOR = 2.0
+DEFAULT_COMPRESSION_RATIO = 0.2
+DEFAULT_ROWS_PER_SECOND = 20000.
+
+
+class SurveyEstimate(object):
+    def __init__(self, survey_id, survey_name):
+        self.survey_id = survey_id
+        self.survey_name = survey_name
+        self.table_rows = {}
+        self.table_bytes = {}
+        self.seconds = 0.
+        self.worker = None
+        self.start = None
+        self.end = None
+
+    @property
+    def rows(self):
+        return sum(self.table_rows.values())
+
+    @property
+    def source_bytes(self):
+        return sum(self.table_bytes.values())
+
+
+class Plan(object):
+    def __init__(self, surveys, workers, free_bytes, compression_ratio, rows_per_second):
+        self.surveys = surveys
+        self.workers = workers
+        self.free_bytes = free_bytes
+        self.compression_ratio = compression_ratio
+        self.rows_per_second = rows_per_second
+
+    def staging_bytes(self, survey):
+        return survey.source_bytes * (STAGING_FACTOR + self.compression_ratio)
+
+    def archive_bytes(self, survey):
+        return survey.source_bytes * (STAGING_FACTOR + 1) * self.compression_ratio
+
+    @property
+    def required_bytes(self):
+        '''All final archives plus the uncompressed outputs of the largest
+           surveys that can be staged at once, one per worker.'''
+        staging = sorted((self.staging_bytes(s) for s in self.surveys), reverse=True)
+        return (sum(self.archive_bytes(s) for s in self.surveys)
+                + sum(staging[:self.workers]))
+
+    @property
+    def fits_disk(self):
+        return self.required_bytes <= self.free_bytes
+
+    @property
+    def makespan(self):
+        return max([s.end for s in self.surveys] or [0.])
+
+    def table(self):
+        table = PrettyTable()
+        table.field_names = ['order', 'survey', 'worker', 'rows', 'source MB', 'staging MB',
+                             'start (s)', 'end (s)']
+        for idx, survey in enumerate(self.surveys):
+            table.add_row([idx + 1,
+                           survey.survey_name,
+                           survey.worker,
+                           survey.rows,
+                           round(survey.source_bytes / 1e6, 1),
+                           round(self.staging_bytes(survey) / 1e6, 1),
+                           round(survey.start),
+                           round(survey.end)])
+        return table
+
+    def summary(self):
+        return [
+            str(self.table()),
+            'Estimated makespan: {s:.0f}s on {w} workers at {rate:.0f} rows/s'.format(
+                s=self.makespan, w=self.workers, rate=self.rows_per_second),
+            'Estimated disk required: {req:.1f} MB of {free:.1f} MB free{warning}'.format(
+                req=self.required_bytes / 1e6, free=self.free_bytes / 1e6,
+                warning='' if self.fits_disk else ' (INSUFFICIENT)')
+        ]
+
+
+def _stats_fraction(survey_id, stats, total_rows):
+    '''Fraction of a table's rows belonging to `survey_id` from the pg_stats
+       most common values, spreading the remainder evenly over the other ids.'''
+    null_frac, n_distinct, common_ids, common_freqs = stats
+    common = dict(zip(common_ids or [], common_freqs or []))
+    if survey_id in common:
+        return common[survey_id]
+    if not n_distinct:
+        return 0.
+    # negative n_distinct is the number of distinct values over the number of rows
+    if n_distinct < 0:
+        n_distinct = -n_distinct * total_rows
+    others = n_distinct - len(common)
+    if others <= 0:
+        return 0.
+    return max(1. - (null_frac or 0.) - sum(common.values()), 0.) / others
+
+
+def estimate_surveys(source_db, surveys, method='stats'):
+    '''Estimate the rows and heap bytes of each (survey_id, survey_name) per
+       table, either from pg_class/pg_stats (`stats`, no table scans) or from
+       grouped counts (`count`) scaled by each table's average row size.'''
+    survey_ids = [survey_id for survey_id, _ in surveys]
+    sizes = source_db.table_sizes(PLAN_TABLES)
+    id_stats = source_db.survey_id_stats(PLAN_TABLES) if method == 'stats' else {}
+
+    estimates = [SurveyEstimate(survey_id, survey_name) for survey_id, survey_name in surveys]
+    for table_name in PLAN_TABLES:
+        total_rows, total_bytes = sizes.get(table_name, (0, 0))
+        row_bytes = total_bytes / float(total_rows) if total_rows else 0.
+        if method == 'count':
+            counts = source_db.survey_row_counts(table_name, survey_ids)
+        else:
+            stats = id_stats.get(table_name)
+            counts = {}
+            for survey_id in survey_ids:
+                fraction = _stats_fraction(survey_id, stats, total_rows) if stats else 0.
+                counts[survey_id] = int(total_rows * fraction)
+
+        for estimate in estimates:
+            rows = counts.get(estimate.survey_id, 0)
+            estimate.table_rows[table_name] = rows
+            estimate.table_bytes[table_name] = int(rows * row_bytes)
+    return estimates
+
+
+def schedule(estimates, workers):
+    '''Longest-processing-time-first list scheduling: sort by estimated
+       duration and give each survey to the worker that frees up first. Sets
+       `worker`, `start` and `end` on each estimate and returns them in
+       dispatch order.'''
+    ordered = sorted(estimates, key=lambda s: s.seconds, reverse=True)
+    loads = [(0., worker) for worker in range(1, workers + 1)]
+    heapq.heapify(loads)
+    for estimate in ordered:
+        load, worker = heapq.heappop(loads)
+        estimate.worker = worker
+        estimate.start = load
+        estimate.end = load + estimate.seconds
+        heapq.heappush(loads, (estimate.end, worker))
+    return ordered
+
+
+def plan(source_db, exports_db, surveys, output_dir, workers=1, method='stats'):
+    '''Estimate, schedule and check disk space for exporting `surveys`, a list
+       of (survey_id, survey_name). Throughput and compression ratio come from
+       previous runs in `export_metrics` when available.'''
+    rows_per_second, compression_ratio = exports_db.fetch_export_rates()
+    rows_per_second = rows_per_second or DEFAULT_ROWS_PER_SECOND
+    compression_ratio = compression_ratio or DEFAULT_COMPRESSION_RATIO
+
+    estimates = estimate_surveys(source_db, surveys, method=method)
+    for estimate in estimates:
+        estimate.seconds = estimate.rows / rows_per_second
+    ordered = schedule(estimates, workers)
+
+    # the output directory is only created once exporting starts
+    disk_path = os.path.abspath(output_dir)
+    while not os.path.exists(disk_path):
+        disk_path = os.path.dirname(disk_path)
+    free_bytes = shutil.disk_usage(disk_path).free
+    return Plan(ordered, workers, free_bytes, compression_ratio, rows_per_second)
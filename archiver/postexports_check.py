@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 # Kyle Fitzsimmons, 2018
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import sys
 
@@ -9,75 +10,106 @@ import database
 
 ## GLOBALS
 CFG_FN = './config.json'
+ID_TABLES = [
+    'surveys',
+    'statistics_surveys'
+]
+SURVEY_ID_TABLES = [
+    'mobile_cancelled_prompt_responses',
+    'mobile_coordinates',
+    'mobile_prompt_responses',
+    'mobile_survey_responses',
+    'mobile_users',
+    'prompt_questions',
+    'statistics_mobile_users',
+    'survey_questions',
+    'survey_subway_stops',
+    'tokens_researcher_invite',
+    'web_users'
+]
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def _check(db, sql, survey_name):
-    db._query(sql)
-    result, = db._db_cur.fetchone()
-    try:
-        assert result == 0
-    except AssertionError:
-        logging.info('Records exist for: {name}'.format(name=survey_name))
-        logging.info(sql)
-        logging.info('Exiting...')
-        sys.exit(1)
+def _surveys_with_records(pool, table, col, survey_ids):
+    '''Return the ids from `survey_ids` that still have at least one row in
+       `table`, probing each id with an indexed EXISTS instead of counting.'''
+    sql = '''
+        SELECT s.id
+        FROM UNNEST(%s) AS s(id)
+        WHERE EXISTS (
+            SELECT 1 FROM {table} WHERE {col} = s.id
+        );
+    '''.format(
+        table=table,
+        col=col)
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql, [survey_ids])
+            found = [_id for _id, in cur.fetchall()]
+        conn.rollback()
+    return table, found
+
+
+def check_records(pool, surveys, workers):
+    '''Check every table for leftover rows of all archived surveys at once,
+       running the per-table queries concurrently.'''
+    survey_ids = list(surveys.keys())
+    jobs = [(table, 'id') for table in ID_TABLES]
+    jobs += [(table, 'survey_id') for table in SURVEY_ID_TABLES]
+
+    leftovers = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_surveys_with_records, pool, table, col, survey_ids)
+                   for table, col in jobs]
+        for future in futures:
+            table, found = future.result()
+            for _id in found:
+                leftovers.setdefault(surveys[_id], []).append(table)
+    return leftovers
+
+
+def check_indexes(pool, surveys):
+    index_names = {'survey{id}_multi_idx'.format(id=_id): name
+                   for _id, name in surveys.items()}
+    index_sql = '''SELECT indexname FROM pg_indexes WHERE indexname = ANY(%s);'''
+    leftovers = {}
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(index_sql, [list(index_names.keys())])
+            for indexname, in cur.fetchall():
+                leftovers.setdefault(index_names[indexname], []).append(indexname)
+        conn.rollback()
+    return leftovers
 
 
-def check_records(db, _id, survey_name):
-    id_tables = [
-        'surveys',
-        'statistics_surveys'
-    ]
-
-    survey_id_tables = [
-        'mobile_cancelled_prompt_responses',
-        'mobile_coordinates',
-        'mobile_prompt_responses',
-        'mobile_survey_responses',
-        'mobile_users',
-        'prompt_questions',
-        'statistics_mobile_users',
-        'survey_questions',
-        'survey_subway_stops',
-        'tokens_researcher_invite',
-        'web_users'
-    ]
-
-    for table in id_tables:
-        count_sql = '''SELECT COUNT(*) FROM {table} WHERE id={id};'''.format(
-            table=table,
-            id=_id)
-        _check(db, count_sql, survey_name)
-
-    for table in survey_id_tables:
-        count_sql = '''SELECT COUNT(*) FROM {table} WHERE survey_id={id};'''.format(
-            table=table,
-            id=_id)
-        _check(db, count_sql, survey_name)
-
-
-def check_indexes(db, _id, survey_name):
-    multi_idx_name = 'survey{id}_multi_idx'.format(id=_id)
-    index_sql = '''SELECT COUNT(*) FROM pg_indexes WHERE indexname='{name}';'''.format(
-        name=multi_idx_name)
-    _check(db, index_sql, survey_name)
-
-    
 def main():
     cfg = load_config(CFG_FN)
     exports_sqlite_fp = './exports.sqlite'
     exports_db = database.ExportsDatabase(exports_sqlite_fp)
-    source_db = database.ItinerumDatabase(**cfg['source_db'])    
-
-    for _, name, _id, start, end, _ in exports_db.fetch_archived_statuses():
-        logger.info('Checking successful delete of {name} survey records...'.format(
-            name=name))
-        check_records(source_db, _id, name)
-        check_indexes(source_db, _id, name)
-
+    pool_cfg = cfg.get('pool') or {}
+    pool = database.get_pool(**cfg['source_db'], **pool_cfg)
+
+    surveys = {_id: name for _, name, _id, start, end, _ in exports_db.fetch_archived_statuses()}
+    if not surveys:
+        logger.info('No archived surveys to check.')
+        return
+    logger.info('Checking successful delete of {num} archived surveys...'.format(
+        num=len(surveys)))
+
+    leftovers = check_records(pool, surveys, workers=pool_cfg.get('maxconn', 4))
+    for name, indexes in check_indexes(pool, surveys).items():
+        leftovers.setdefault(name, []).extend(indexes)
+
+    for name, tables in sorted(leftovers.items()):
+        logger.info('Records exist for {name}: {tables}'.format(name=name,
+                                                               tables=', '.join(tables)))
+    if leftovers:
+        logger.info('{num} archived surveys have leftover records. Exiting...'.format(
+            num=len(leftovers)))
+        sys.exit(1)
+    logger.info('No leftover records found.')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+# Opt-in profiling of archiver stages: cProfile statistics, tracemalloc
+# allocation snapshots, sampled stacks in collapsed (flamegraph) format and
+# peak RSS are written per stage to `<output_dir>/profiles/<run>/<survey>/`.
+import cProfile
+from collections import Counter
+from contextlib import contextmanager
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+
+logger = logging.getLogger(__name__)
+
+
+class PeakRSS(object):
+    '''Sample this process's resident set size in a background thread to find
+       the peak of a single stage (ru_maxrss only reports the lifetime peak).'''
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._page_size = resource.getpagesize()
+
+    def _rss(self):
+        try:
+            with open('/proc/self/statm', 'r') as statm_f:
+                return int(statm_f.read().split()[1]) * self._page_size
+        except (IOError, OSError):
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self._rss()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name='profiling-rss')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._rss())
+
+
+class StackSampler(object):
+    '''Periodically sample the stacks of all threads (other than the profiling
+       threads themselves) and count them as collapsed stacks
+       (`thread;outer;...;inner count`), the input format of flamegraph.pl and
+       speedscope. Unlike cProfile this also covers the pipeline worker threads.'''
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+
+    def _collapse(self, thread_name, frame):
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append('{fn}:{func}'.format(fn=os.path.basename(code.co_filename),
+                                              func=code.co_name))
+            frame = frame.f_back
+        names.append(thread_name)
+        return ';'.join(reversed(names))
+
+    def _sample(self):
+        while not self._stop.is_set():
+            thread_names = {t.ident: t.name for t in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                name = thread_names.get(thread_id, str(thread_id))
+                if name.startswith('profiling-'):
+                    continue
+                self.stacks[self._collapse(name, frame)] += 1
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._sample, name='profiling-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def write(self, fp):
+        with open(fp, 'w') as collapsed_f:
+            for stack, count in self.stacks.most_common():
+                collapsed_f.write('{stack} {count}\n'.format(stack=stack, count=count))
+
+
+class StageProfiler(object):
+    '''Profile archiver stages, writing for each stage:
+         <stage>.pstats        cProfile statistics of the calling thread
+         <stage>.tracemalloc   top `top_n` allocation sites still held at the
+                               end of the stage
+         <stage>.collapsed     sampled stacks of all threads
+       into `<output_dir>/profiles/<run>/<survey>/` (`run` for stages that
+       are not tied to a survey). Peak RSS and traced memory of every stage are
+       summarized in `<output_dir>/profiles/<run>/summary.json`. When surveys
+       are exported by parallel workers, tracemalloc and the stack samples of
+       concurrent stages also include the other workers' activity.'''
+
+    def __init__(self, output_dir, run_timestamp, top_n=25, sample_interval=0.01,
+                 traceback_frames=10):
+        self.run_dir = os.path.join(output_dir, 'profiles', str(run_timestamp))
+        self.top_n = top_n
+        self.sample_interval = sample_interval
+        self.traceback_frames = traceback_frames
+        self.summary = []
+        self._lock = threading.Lock()
+        self._active = 0
+        self._started_tracemalloc = False
+
+    def _stage_dir(self, survey_name):
+        stage_dir = os.path.join(self.run_dir, survey_name or 'run')
+        os.makedirs(stage_dir, exist_ok=True)
+        return stage_dir
+
+    def _write_tracemalloc(self, fp, snapshot):
+        stats = snapshot.statistics('traceback')[:self.top_n]
+        with open(fp, 'w') as tracemalloc_f:
+            for stat in stats:
+                tracemalloc_f.write('{size:.1f} KiB in {count} blocks\n'.format(
+                    size=stat.size / 1024., count=stat.count))
+                for line in stat.traceback.format():
+                    tracemalloc_f.write(line + '\n')
+                tracemalloc_f.write('\n')
+
+    @contextmanager
+    def stage(self, name, survey_name=None):
+        stage_dir = self._stage_dir(survey_name)
+        base_fp = os.path.join(stage_dir, name)
+
+        with self._lock:
+            if not self._active and not tracemalloc.is_tracing():
+                tracemalloc.start(self.traceback_frames)
+                self._started_tracemalloc = True
+            self._active += 1
+        tracemalloc.reset_peak()
+        profile = cProfile.Profile()
+        t0 = time.time()
+        rss = PeakRSS()
+        sampler = StackSampler(self.sample_interval)
+        # profiles are written even when the stage fails
+        try:
+            with rss, sampler:
+                profile.enable()
+                try:
+                    yield
+                finally:
+                    profile.disable()
+        finally:
+            elapsed = time.time() - t0
+            snapshot = tracemalloc.take_snapshot()
+            _, traced_peak = tracemalloc.get_traced_memory()
+            with self._lock:
+                self._active -= 1
+                if not self._active and self._started_tracemalloc:
+                    tracemalloc.stop()
+                    self._started_tracemalloc = False
+
+            profile.dump_stats(base_fp + '.pstats')
+            self._write_tracemalloc(base_fp + '.tracemalloc', snapshot)
+            sampler.write(base_fp + '.collapsed')
+            with self._lock:
+                self.summary.append({
+                    'stage': name,
+                    'survey': survey_name,
+                    'seconds': round(elapsed, 3),
+                    'peak_rss_mb': round(rss.peak / 1e6, 1),
+                    'traced_peak_mb': round(traced_peak / 1e6, 1)
+                })
+            logger.info('Profiled {stage} ({survey}): {s:.1f}s, peak RSS {rss:.1f} MB'.format(
+                stage=name, survey=survey_name or 'run', s=elapsed, rss=rss.peak / 1e6))
+            self.write_summary()
+
+    def write_summary(self):
+        if not os.path.exists(self.run_dir):
+            os.makedirs(self.run_dir)
+        with self._lock:
+            with open(os.path.join(self.run_dir, 'summary.json'), 'w') as summary_f:
+                json.dump(self.summary, summary_f, indent=4)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# Write archiver run metrics in the Prometheus text exposition format for the
+# node_exporter textfile collector. The file is rewritten atomically at the
+# end of the run and periodically while stages are running.
+import logging
+import os
+import tempfile
+import threading
+import time
+
+
+DEFAULT_BUCKETS = [1, 5, 15, 60, 300, 900, 1800, 3600, 7200, 14400]
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    if not labels:
+        return ''
+    pairs = ['{k}="{v}"'.format(k=k, v=_escape(v)) for k, v in sorted(labels.items())]
+    return '{' + ','.join(pairs) + '}'
+
+
+class TextfileExporter(object):
+    '''Render the stages of a `metrics.MetricsRecorder` as Prometheus metrics:
+         archiver_rows_exported{survey,table}        rows copied per table
+         archiver_artifact_bytes{survey,artifact}    size of each output file
+         archiver_stage_duration_seconds{stage}      histogram of stage times
+         archiver_stage_rows / _bytes_written{stage} totals by stage
+         archiver_stage_running_seconds{stage,survey} elapsed time of stages
+                                                     still in progress
+         archiver_upload_bytes_per_second            cold storage throughput
+         archiver_delete_rows_per_second{survey}     delete_survey rate
+       plus the run start time and duration.'''
+
+    def __init__(self, recorder, textfile, interval=30, buckets=None):
+        self.recorder = recorder
+        self.textfile = textfile
+        self.interval = interval
+        self.buckets = sorted(buckets or DEFAULT_BUCKETS)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _metric(self, lines, name, metric_type, help_text, samples):
+        lines.append('# HELP {name} {help}'.format(name=name, help=help_text))
+        lines.append('# TYPE {name} {type}'.format(name=name, type=metric_type))
+        for suffix, labels, value in samples:
+            lines.append('{name}{suffix}{labels} {value}'.format(
+                name=name, suffix=suffix, labels=_labels(**labels), value=value))
+
+    def _histogram_samples(self, stages):
+        durations = {}
+        for stage in stages:
+            durations.setdefault(stage.stage, []).append(stage.seconds)
+
+        samples = []
+        for name, seconds in sorted(durations.items()):
+            for bucket in self.buckets:
+                samples.append(('_bucket', {'stage': name, 'le': bucket},
+                                sum(1 for s in seconds if s <= bucket)))
+            samples.append(('_bucket', {'stage': name, 'le': '+Inf'}, len(seconds)))
+            samples.append(('_sum', {'stage': name}, round(sum(seconds), 3)))
+            samples.append(('_count', {'stage': name}, len(seconds)))
+        return samples
+
+    def render(self, finished=False):
+        stages, running = self.recorder.snapshot()
+        now = time.time()
+        lines = []
+        self._metric(lines, 'archiver_run_start_timestamp_seconds', 'gauge',
+                     'Unix time the archiver run started.',
+                     [('', {}, self.recorder.run_timestamp)])
+        self._metric(lines, 'archiver_run_duration_seconds', 'gauge',
+                     'Seconds since the archiver run started.',
+                     [('', {}, round(now - self.recorder.run_timestamp, 3))])
+        self._metric(lines, 'archiver_run_finished', 'gauge',
+                     '1 once the archiver run has completed.',
+                     [('', {}, int(finished))])
+
+        table_rows = []
+        artifact_bytes = []
+        for stage in stages:
+            survey = stage.survey_name or ''
+            for table, rows in sorted(stage.table_rows.items()):
+                table_rows.append(('', {'survey': survey, 'table': table}, rows))
+            for artifact, size in sorted(stage.artifact_bytes.items()):
+                artifact_bytes.append(('', {'survey': survey, 'artifact': artifact}, size))
+        self._metric(lines, 'archiver_rows_exported', 'gauge',
+                     'Rows exported per survey and source table.', table_rows)
+        self._metric(lines, 'archiver_artifact_bytes', 'gauge',
+                     'Size in bytes of each archive artifact written.', artifact_bytes)
+
+        self._metric(lines, 'archiver_stage_duration_seconds', 'histogram',
+                     'Duration of completed archiver stages.',
+                     self._histogram_samples(stages))
+
+        totals = {}
+        for stage in stages:
+            rows, written = totals.get(stage.stage, (0, 0))
+            totals[stage.stage] = (rows + stage.rows, written + stage.bytes_written)
+        self._metric(lines, 'archiver_stage_rows', 'gauge',
+                     'Rows processed by completed stages of this run.',
+                     [('', {'stage': name}, rows) for name, (rows, _) in sorted(totals.items())])
+        self._metric(lines, 'archiver_stage_bytes_written', 'gauge',
+                     'Bytes written by completed stages of this run.',
+                     [('', {'stage': name}, written)
+                      for name, (_, written) in sorted(totals.items())])
+        self._metric(lines, 'archiver_stage_running_seconds', 'gauge',
+                     'Elapsed seconds of stages still in progress.',
+                     [('', {'stage': stage.stage, 'survey': stage.survey_name or ''},
+                       round(now - stage.started_at, 3)) for stage in running])
+
+        uploads = [s for s in stages if s.stage == 'cold_storage' and s.seconds]
+        self._metric(lines, 'archiver_upload_bytes_per_second', 'gauge',
+                     'Cold storage upload throughput of this run.',
+                     [('', {}, round(s.bytes_written / s.seconds, 1)) for s in uploads])
+        deletes = [s for s in stages if s.stage == 'delete' and s.seconds]
+        self._metric(lines, 'archiver_delete_rows_per_second', 'gauge',
+                     'Rows deleted per second by delete_survey.',
+                     [('', {'survey': s.survey_name or str(s.survey_id)},
+                       round(s.rows / s.seconds, 1)) for s in deletes])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, finished=False):
+        '''Write to a temporary file in the same directory and rename it over
+           the textfile so node_exporter never reads a partial file.'''
+        textfile_dir = os.path.dirname(os.path.abspath(self.textfile))
+        fd, tmp_fp = tempfile.mkstemp(dir=textfile_dir, prefix='.archiver-', suffix='.prom.tmp')
+        try:
+            with os.fdopen(fd, 'w') as prom_f:
+                prom_f.write(self.render(finished))
+            os.chmod(tmp_fp, 0o644)
+            os.rename(tmp_fp, self.textfile)
+        except Exception:
+            os.remove(tmp_fp)
+            raise
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except (IOError, OSError) as e:
+                logger.warning('Could not write {fp}: {e}'.format(fp=self.textfile, e=e))
+
+    def start(self):
+        self.write()
+        self._thread = threading.Thread(target=self._run, name='prometheus-textfile')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''Stop the periodic writes and mark the run finished. A run that
+           fails leaves the last periodic file with `archiver_run_finished 0`.'''
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.write(finished=True)
@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+# Stream typed rows out of archived survey bundles without extracting them:
+# `<survey>-csv.tar.gz` (the .csv exports), `<survey>.psql.gz` (the pg_dump of
+# the mobile tables except mobile_survey_responses, read from its COPY blocks),
+# `<survey>.sqlite.gz` (all five mobile tables) and the `<survey>.zip` pushed to
+# cold storage holding them. Bundles are opened from a local path or an
+# `s3://<bucket>/<key>` URL; gzip and tar members are decompressed as a stream
+# and rows outside the requested uuids or time range are dropped before their
+# columns are converted. SQLite needs random access, so a `.sqlite.gz` is
+# decompressed to a temporary file, once per bundle, and only used for the
+# tables no `.psql.gz` holds.
+#
+#   with reader.open_bundle('output/cfsf-csv.tar.gz') as bundle:
+#       for uuid, lat, lng in bundle.rows('coordinates', columns=['uuid', 'latitude', 'longitude'],
+#                                          uuids={'...'}, start=1525132800):
+#           ...
+#
+#   python3 reader.py s3://<bucket>/<survey>.zip --table coordinates --uuid <uuid> \
+#       --columns uuid,latitude,longitude [--endpoint-url http://localhost:9000]
+import argparse
+import codecs
+import csv
+import gzip
+import io
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tarfile
+import tempfile
+import zipfile
+
+import boto3
+import dateutil.parser
+import pytz
+
+
+S3_BLOCK_SIZE = 8 << 20
+CSV_TABLES = ['survey_responses', 'coordinates', 'prompt_responses', 'cancelled_prompts']
+PSQL_TABLES = ['mobile_users', 'mobile_coordinates', 'mobile_prompt_responses',
+               'mobile_cancelled_prompt_responses']
+SQLITE_TABLES = ['mobile_users', 'mobile_survey_responses', 'mobile_coordinates',
+                 'mobile_prompt_responses', 'mobile_cancelled_prompt_responses']
+
+
+def _utc(value):
+    return dateutil.parser.isoparse(value).replace(tzinfo=pytz.UTC)
+
+
+def _bool(value):
+    return value in ('True', 't', 'true')
+
+
+def _timestamptz(value):
+    return dateutil.parser.isoparse(value)
+
+
+# converters of the .csv columns that are not text; survey_responses columns
+# vary with the survey's questions so only the fixed ones are typed
+CSV_TYPES = {
+    'survey_responses': {
+        'created_at_UTC': _utc, 'created_at_epoch': int,
+        'modified_at_UTC': _utc, 'modified_at_epoch': int,
+        'location_home_lat': float, 'location_home_lon': float,
+        'location_work_lat': float, 'location_work_lon': float,
+        'location_study_lat': float, 'location_study_lon': float
+    },
+    'coordinates': {
+        'latitude': float, 'longitude': float, 'altitude': float, 'speed': float,
+        'direction': float, 'h_accuracy': float, 'v_accuracy': float,
+        'acceleration_x': float, 'acceleration_y': float, 'acceleration_z': float,
+        'mode_detected': int, 'point_type': int,
+        'timestamp_UTC': _utc, 'timestamp_epoch': int
+    },
+    'prompt_responses': {
+        'prompt_num': int, 'latitude': float, 'longitude': float,
+        'displayed_at_UTC': _utc, 'displayed_at_epoch': int,
+        'recorded_at_UTC': _utc, 'recorded_at_epoch': int,
+        'edited_at_UTC': _utc, 'edited_at_epoch': int
+    },
+    'cancelled_prompts': {
+        'latitude': float, 'longitude': float,
+        'displayed_at_UTC': _utc, 'displayed_at_epoch': int,
+        'cancelled_at_UTC': _utc, 'cancelled_at_epoch': int,
+        'is_travelling': _bool
+    }
+}
+# column compared against `start`/`end` for each table
+CSV_TIME_COLS = {
+    'survey_responses': 'created_at_epoch',
+    'coordinates': 'timestamp_epoch',
+    'prompt_responses': 'displayed_at_epoch',
+    'cancelled_prompts': 'displayed_at_epoch'
+}
+PSQL_TIME_COLS = {
+    'mobile_users': 'created_at',
+    'mobile_coordinates': 'timestamp',
+    'mobile_prompt_responses': 'displayed_at',
+    'mobile_cancelled_prompt_responses': 'displayed_at'
+}
+# converters of the PostgreSQL types in the dump's CREATE TABLE statements
+PSQL_TYPES = {
+    'integer': int,
+    'bigint': int,
+    'smallint': int,
+    'numeric': float,
+    'double precision': float,
+    'real': float,
+    'boolean': _bool,
+    'timestamp with time zone': _timestamptz,
+    'jsonb': json.loads,
+    'json': json.loads
+}
+# converters of the .sqlite columns by declared type, and of the columns whose
+# type was lost in SQLite (jsonb stored as text, boolean as integer)
+SQLITE_TYPES = {'DATETIME': _timestamptz}
+SQLITE_COLUMN_TYPES = {'response': json.loads, 'is_travelling': bool}
+COPY_ESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v', '\\': '\\'}
+
+
+class S3RangeFile(io.RawIOBase):
+    '''Seekable read-only file over an S3 object, read with range GETs so
+       zip archives can be opened without downloading them.'''
+
+    def __init__(self, client, bucket, key):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        else:
+            self.pos = self.size + offset
+        return self.pos
+
+    def readinto(self, buf):
+        if self.pos >= self.size:
+            return 0
+        end = min(self.pos + len(buf), self.size) - 1
+        data = self.client.get_object(Bucket=self.bucket, Key=self.key,
+                                      Range='bytes={start}-{end}'.format(start=self.pos, end=end))['Body'].read()
+        buf[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+
+def _parse_s3_url(url):
+    bucket, _, key = url[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def _open_raw(path, endpoint_url=None, seekable=False):
+    '''Open a local file or S3 object for reading: S3 objects are streamed
+       from a single GET, or read with range GETs when `seekable`.'''
+    if not path.startswith('s3://'):
+        return open(path, 'rb')
+    bucket, key = _parse_s3_url(path)
+    client = boto3.client('s3', endpoint_url=endpoint_url)
+    if seekable:
+        return io.BufferedReader(S3RangeFile(client, bucket, key), buffer_size=S3_BLOCK_SIZE)
+    return client.get_object(Bucket=bucket, Key=key)['Body']
+
+
+class _Filter(object):
+    '''Select rows by uuid and time on the raw text values, then convert and
+       project only the rows that pass.'''
+
+    def __init__(self, header, converters, columns=None, uuid_col=None, uuids=None,
+                 time_col=None, time_fn=None, start=None, end=None):
+        columns = columns or header
+        missing = [col for col in columns if col not in header]
+        if missing:
+            raise KeyError('Unknown columns: {cols}'.format(cols=', '.join(missing)))
+        self.indexes = [header.index(col) for col in columns]
+        self.converters = [converters.get(col) for col in columns]
+        self.uuid_idx = header.index(uuid_col) if uuids is not None and uuid_col in header else None
+        if uuids is not None and self.uuid_idx is None:
+            raise KeyError('No uuid column to filter by: {col}'.format(col=uuid_col))
+        self.uuids = uuids
+        self.time_idx = None
+        if start is not None or end is not None:
+            self.time_idx = header.index(time_col)
+        self.time_fn = time_fn
+        self.start = start
+        self.end = end
+
+    def __call__(self, values):
+        '''Return the typed, projected row or None if it is filtered out.'''
+        if self.uuid_idx is not None and values[self.uuid_idx] not in self.uuids:
+            return None
+        if self.time_idx is not None:
+            value = values[self.time_idx]
+            if value in (None, ''):
+                return None
+            epoch = self.time_fn(value)
+            if (self.start is not None and epoch < self.start) or \
+                    (self.end is not None and epoch > self.end):
+                return None
+        row = []
+        for idx, convert in zip(self.indexes, self.converters):
+            value = values[idx]
+            if value == '' or value is None:
+                value = None
+            elif convert:
+                value = convert(value)
+            row.append(value)
+        return tuple(row)
+
+
+def csv_rows(f, table, columns=None, uuids=None, start=None, end=None):
+    '''Yield typed rows of a .csv export read from the binary file `f`.'''
+    reader = csv.reader(codecs.getreader('utf-8')(f))
+    header = next(reader)
+    select = _Filter(header, CSV_TYPES.get(table, {}), columns=columns, uuid_col='uuid',
+                     uuids=uuids, time_col=CSV_TIME_COLS.get(table), time_fn=int,
+                     start=start, end=end)
+    for values in reader:
+        row = select(values)
+        if row is not None:
+            yield row
+
+
+def _unescape_copy(value):
+    if value == '\\N':
+        return None
+    if '\\' not in value:
+        return value
+    chars = []
+    it = iter(value)
+    for c in it:
+        if c == '\\':
+            c = next(it, '')
+            c = COPY_ESCAPES.get(c, c)
+        chars.append(c)
+    return ''.join(chars)
+
+
+def _column_type(definition):
+    '''PostgreSQL type of a CREATE TABLE column definition, without modifiers.'''
+    pg_type = definition.split('(')[0].split(' NOT NULL')[0].split(' DEFAULT')[0]
+    return pg_type.strip().rstrip(',')
+
+
+def psql_rows(f, table, columns=None, uuids=None, start=None, end=None, mobile_ids=None):
+    '''Yield typed rows of one table from the COPY block of a pg_dump read
+       from the binary file `f`. The dump's CREATE TABLE gives the column
+       types. Tables without a uuid column are filtered with `mobile_ids`.'''
+    table_types = {}
+    current_table = None
+    select = None
+    in_copy = False
+    for line in codecs.getreader('utf-8')(f):
+        if in_copy:
+            if line.startswith('\\.'):
+                return
+            values = [_unescape_copy(v) for v in line.rstrip('\n').split('\t')]
+            if mobile_ids is not None and values[mobile_id_idx] not in mobile_ids:
+                continue
+            row = select(values)
+            if row is not None:
+                yield row
+            continue
+        if line.startswith('CREATE TABLE '):
+            current_table = line.split()[2].split('.')[-1].strip('"')
+            table_types[current_table] = {}
+        elif current_table and line.startswith('    '):
+            name, definition = line.strip().split(' ', 1)
+            table_types[current_table][name.strip('"')] = _column_type(definition)
+        elif current_table and line.startswith(');'):
+            current_table = None
+        elif line.startswith('COPY ') and line.split()[1].split('.')[-1].strip('"') == table:
+            header = [col.strip().strip('"') for col in
+                      line[line.index('(') + 1:line.rindex(')')].split(',')]
+            types = table_types.get(table, {})
+            converters = {col: PSQL_TYPES.get(types.get(col)) for col in header}
+            select = _Filter(header, converters, columns=columns, uuid_col='uuid',
+                             uuids=uuids, time_col=PSQL_TIME_COLS.get(table),
+                             time_fn=lambda value: _timestamptz(value).timestamp(),
+                             start=start, end=end)
+            if mobile_ids is not None:
+                mobile_id_idx = header.index('id' if table == 'mobile_users' else 'mobile_id')
+                mobile_ids = {str(mobile_id) for mobile_id in mobile_ids}
+            in_copy = True
+
+
+def sqlite_rows(conn, table, columns=None, uuids=None, start=None, end=None):
+    '''Yield typed rows of one table of a .sqlite export opened as `conn`.
+       Rows of other users are left out by the query, the time range is
+       checked on the stored timestamps.'''
+    declared = [(name, dtype) for _, name, dtype, _, _, _ in
+                conn.execute('PRAGMA table_info({table});'.format(table=table))]
+    if not declared:
+        raise KeyError('No {table} table in the .sqlite export'.format(table=table))
+    header = [name for name, _ in declared]
+    converters = {name: SQLITE_COLUMN_TYPES.get(name) or SQLITE_TYPES.get(dtype)
+                  for name, dtype in declared}
+    time_col = PSQL_TIME_COLS.get(table)
+    if (start is not None or end is not None) and time_col is None:
+        raise KeyError('{table} has no time column to filter by'.format(table=table))
+    select = _Filter(header, converters, columns=columns, time_col=time_col,
+                     time_fn=lambda value: _timestamptz(value).timestamp(),
+                     start=start, end=end)
+
+    sql = 'SELECT {cols} FROM {table}'.format(cols=', '.join(header), table=table)
+    params = []
+    if uuids is not None:
+        params = list(uuids)
+        marks = ', '.join(['?'] * len(params))
+        if table == 'mobile_users':
+            sql += ' WHERE uuid IN ({marks})'.format(marks=marks)
+        else:
+            sql += ' WHERE mobile_id IN (SELECT id FROM mobile_users WHERE uuid IN ({marks}))'.format(
+                marks=marks)
+    for values in conn.execute(sql + ' ORDER BY id;', params):
+        row = select(values)
+        if row is not None:
+            yield row
+
+
+class Bundle(object):
+    '''An archived survey bundle: `<survey>-csv.tar.gz`, `<survey>.psql.gz`,
+       `<survey>.sqlite.gz` or a cold storage `<survey>.zip` holding them.
+       Each call to `rows` streams through the bundle once, except for a
+       `.sqlite.gz`, decompressed the first time one of its tables is read.'''
+
+    def __init__(self, path, endpoint_url=None):
+        self.path = path
+        self.endpoint_url = endpoint_url
+        self.name = os.path.basename(path.rstrip('/'))
+        if not self.name.endswith(('-csv.tar.gz', '.psql.gz', '.sqlite.gz', '.zip')):
+            raise ValueError('Unknown bundle type: {name}'.format(name=self.name))
+        self._zip = None
+        self._sqlite = None
+        self._tmp_dir = None
+        if self.name.endswith('.zip'):
+            self._zip = zipfile.ZipFile(_open_raw(path, endpoint_url, seekable=True))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def close(self):
+        if self._zip:
+            self._zip.fp.close()
+            self._zip.close()
+        if self._sqlite:
+            self._sqlite.close()
+            self._sqlite = None
+        if self._tmp_dir:
+            shutil.rmtree(self._tmp_dir, ignore_errors=True)
+            self._tmp_dir = None
+
+    def _has_member(self, suffix):
+        names = self._zip.namelist() if self._zip else [self.name]
+        return any(n.endswith(suffix) for n in names)
+
+    @property
+    def tables(self):
+        tables = []
+        if self._has_member('-csv.tar.gz'):
+            tables += CSV_TABLES
+        if self._has_member('.psql.gz'):
+            tables += PSQL_TABLES
+        if self._has_member('.sqlite.gz'):
+            tables += [table for table in SQLITE_TABLES if table not in tables]
+        return tables
+
+    def _open_member(self, suffix):
+        if self._zip:
+            for name in self._zip.namelist():
+                if name.endswith(suffix):
+                    return self._zip.open(name)
+            raise KeyError('{name} holds no {suffix} archive'.format(name=self.name, suffix=suffix))
+        if not self.name.endswith(suffix):
+            raise KeyError('{name} is not a {suffix} archive'.format(name=self.name, suffix=suffix))
+        return _open_raw(self.path, self.endpoint_url)
+
+    def _sqlite_conn(self):
+        '''Decompress the .sqlite.gz member to a temporary file and open it.'''
+        if self._sqlite is None:
+            self._tmp_dir = tempfile.mkdtemp(prefix='reader-')
+            sqlite_fp = os.path.join(self._tmp_dir, 'bundle.sqlite')
+            with self._open_member('.sqlite.gz') as f:
+                with gzip.GzipFile(fileobj=f) as gz_f, open(sqlite_fp, 'wb') as sqlite_f:
+                    shutil.copyfileobj(gz_f, sqlite_f, S3_BLOCK_SIZE)
+            self._sqlite = sqlite3.connect(sqlite_fp)
+        return self._sqlite
+
+    def rows(self, table, columns=None, uuids=None, start=None, end=None):
+        '''Yield typed tuples of `columns` (default: all) of a table, keeping
+           rows of the given `uuids` with a time within [start, end] epoch
+           seconds. In the .psql.gz dump, uuids are resolved to mobile ids
+           with a first pass over mobile_users. The mobile tables are read
+           from the .psql.gz when the bundle has one, and from the .sqlite.gz
+           otherwise and for mobile_survey_responses.'''
+        if uuids is not None:
+            uuids = set(uuids)
+        if table in CSV_TABLES:
+            with self._open_member('-csv.tar.gz') as f:
+                with tarfile.open(fileobj=f, mode='r|gz') as tar_f:
+                    for member in tar_f:
+                        if member.isfile() and os.path.basename(member.name) == table + '.csv':
+                            yield from csv_rows(tar_f.extractfile(member), table, columns=columns,
+                                                uuids=uuids, start=start, end=end)
+                            return
+            raise KeyError('{name} has no {table}.csv'.format(name=self.name, table=table))
+        if table not in PSQL_TABLES or not self._has_member('.psql.gz'):
+            if table not in SQLITE_TABLES:
+                raise KeyError('Unknown table: {table}'.format(table=table))
+            if not self._has_member('.sqlite.gz'):
+                raise KeyError('{name} holds no .sqlite.gz archive with {table}'.format(
+                    name=self.name, table=table))
+            yield from sqlite_rows(self._sqlite_conn(), table, columns=columns, uuids=uuids,
+                                   start=start, end=end)
+            return
+        mobile_ids = None
+        if uuids is not None and table != 'mobile_users':
+            with self._open_member('.psql.gz') as f:
+                mobile_ids = {row[0] for row in psql_rows(gzip.GzipFile(fileobj=f), 'mobile_users',
+                                                          columns=['id'], uuids=uuids)}
+            uuids = None
+        with self._open_member('.psql.gz') as f:
+            yield from psql_rows(gzip.GzipFile(fileobj=f), table, columns=columns, uuids=uuids,
+                                 start=start, end=end, mobile_ids=mobile_ids)
+
+
+def open_bundle(path, endpoint_url=None):
+    '''Open an archived survey bundle from a local path or `s3://<bucket>/<key>`;
+       `endpoint_url` points at an S3-compatible server.'''
+    return Bundle(path, endpoint_url=endpoint_url)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stream a table out of an archived survey bundle as CSV.')
+    parser.add_argument('path', help='bundle path or s3://<bucket>/<key>')
+    parser.add_argument('--table', default='coordinates')
+    parser.add_argument('--columns', help='comma-separated columns to output')
+    parser.add_argument('--uuid', action='append', dest='uuids', help='uuid to include (repeatable)')
+    parser.add_argument('--start', type=int, help='first epoch second to include')
+    parser.add_argument('--end', type=int, help='last epoch second to include')
+    parser.add_argument('--endpoint-url', help='S3-compatible endpoint, e.g. a local stand-in')
+    args = parser.parse_args()
+
+    columns = args.columns.split(',') if args.columns else None
+    writer = csv.writer(sys.stdout)
+    with open_bundle(args.path, endpoint_url=args.endpoint_url) as bundle:
+        if columns:
+            writer.writerow(columns)
+        writer.writerows(bundle.rows(args.table, columns=columns, uuids=args.uuids,
+                                     start=args.start, end=args.end))
+
+
+if __name__ == '__main__':
+    main()
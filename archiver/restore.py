@@ -0,0 +1,534 @@
+#!/usr/bin/env python3
+# Restore an archived survey into PostgreSQL: the mobile tables of a
+# `<survey>.psql.gz` dump (mobile_users, mobile_coordinates, mobile_prompt_responses
+# and mobile_cancelled_prompt_responses) or all five of a `<survey>.sqlite` or
+# `<survey>.sqlite.gz` export. Rows are loaded with parallel `COPY ... FROM STDIN`
+# streams: the dump's COPY blocks are split into chunks of about `chunk_bytes`
+# passed through as-is, and the SQLite tables into id ranges which SQLite itself
+# formats as COPY text. Tables created by the restore, or found empty, are loaded
+# without their indexes and constraints, which are built once all rows are in.
+#
+# The target database is the `restore_db` section of the config (same keys as
+# `source_db`):
+#   python3 restore.py output/<survey>.psql.gz [--config config.json] [--schema <name>] \
+#       [--workers 4] [--chunk-mb 16]
+import argparse
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, ThreadPoolExecutor, wait
+import gzip
+import io
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+from prettytable import PrettyTable
+
+from database import APPLICATION_NAME, ConnectionPool
+
+
+## GLOBALS
+CFG_FN = './config.json'
+RESTORE_TABLES = ['mobile_users', 'mobile_survey_responses', 'mobile_coordinates',
+                  'mobile_prompt_responses', 'mobile_cancelled_prompt_responses']
+CHUNK_BYTES = 16 << 20
+RANGE_ROWS = 100000
+# indexed columns of each table in the source database, built after the load
+# along with the `id` primary key on tables the restore creates
+RESTORE_INDEXES = {
+    'mobile_users': ['survey_id'],
+    'mobile_survey_responses': ['mobile_id'],
+    'mobile_coordinates': ['mobile_id', 'survey_id, id'],
+    'mobile_prompt_responses': ['survey_id', 'mobile_id'],
+    'mobile_cancelled_prompt_responses': ['survey_id', 'mobile_id']
+}
+SQLITE_POSTGRES_TYPES = {
+    'INTEGER': 'integer',
+    'REAL': 'double precision',
+    'DATETIME': 'timestamp with time zone',
+    'TEXT': 'text'
+}
+# SQLite expressions of the characters escaped in COPY text, and their escapes
+COPY_ESCAPES = [("'\\'", '\\\\'), ('char(9)', '\\t'), ('char(10)', '\\n'), ('char(13)', '\\r')]
+# columns added to the SQLite export by `SQLiteDatabase.index_coordinates`
+SQLITE_DERIVED_COLUMNS = [('mobile_coordinates', 'epoch')]
+# columns serialized to SQLite as TEXT or INTEGER that are jsonb or boolean in PostgreSQL
+SQLITE_COLUMN_TYPES = {
+    'response': 'jsonb',
+    'is_travelling': 'boolean'
+}
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class TableStats(object):
+    '''Rows and COPY bytes loaded into a table by concurrent chunks, and the
+       wall time from the first chunk's start to the last chunk's end.'''
+
+    def __init__(self, table):
+        self.table = table
+        self.rows = 0
+        self.bytes = 0
+        self.start = None
+        self.end = None
+        self.index_seconds = 0.
+        self._lock = threading.Lock()
+
+    def add(self, rows, num_bytes, start, end):
+        with self._lock:
+            self.rows += rows
+            self.bytes += num_bytes
+            self.start = start if self.start is None else min(self.start, start)
+            self.end = end if self.end is None else max(self.end, end)
+
+    @property
+    def seconds(self):
+        if self.start is None:
+            return 0.
+        return self.end - self.start
+
+
+def _quote(name):
+    return '"{name}"'.format(name=name.replace('"', '""'))
+
+
+def _copy_sql(schema, table, columns):
+    return 'COPY {schema}.{table} ({cols}) FROM STDIN;'.format(
+        schema=_quote(schema),
+        table=_quote(table),
+        cols=', '.join(_quote(col) for col in columns))
+
+
+def copy_chunk(pool, stats, sql, data, rows):
+    '''Load one chunk of COPY text on a pooled connection.'''
+    t0 = time.time()
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute('SET synchronous_commit TO off;')
+            cur.copy_expert(sql, io.BytesIO(data))
+        conn.commit()
+    stats.add(rows, len(data), t0, time.time())
+
+
+class ChunkLoader(object):
+    '''Submit COPY chunks to `workers` threads, each with its own connection,
+       keeping at most two chunks per worker in memory.'''
+
+    def __init__(self, pool, workers):
+        self.pool = pool
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._pending = set()
+
+    def _reap(self, return_when=FIRST_COMPLETED):
+        done, self._pending = wait(self._pending, return_when=return_when)
+        for future in done:
+            future.result()
+
+    def submit(self, fn, *args):
+        while len(self._pending) >= self.workers * 2:
+            self._reap()
+        self._pending.add(self._executor.submit(fn, *args))
+
+    def join(self):
+        if self._pending:
+            self._reap(return_when=ALL_COMPLETED)
+        self._executor.shutdown()
+
+    def abort(self):
+        '''Cancel the chunks not yet started and wait for the running ones.'''
+        for future in self._pending:
+            future.cancel()
+        wait(self._pending, return_when=ALL_COMPLETED)
+        self._pending = set()
+        self._executor.shutdown()
+
+
+def existing_tables(pool, schema, tables):
+    '''Return {table: is_empty} of the `tables` already in `schema`.'''
+    sql = '''
+        SELECT table_name
+        FROM information_schema.tables
+        WHERE table_schema = %s
+        AND table_name = ANY(%s);
+    '''
+    existing = {}
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql, [schema, list(tables)])
+            for table, in cur.fetchall():
+                cur.execute('SELECT NOT EXISTS (SELECT 1 FROM {schema}.{table});'.format(
+                    schema=_quote(schema), table=_quote(table)))
+                existing[table], = cur.fetchone()
+        conn.rollback()
+    return existing
+
+
+def create_tables(pool, schema, create_sqls):
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute('CREATE SCHEMA IF NOT EXISTS {schema};'.format(schema=_quote(schema)))
+            for sql in create_sqls:
+                cur.execute(sql)
+        conn.commit()
+
+
+def deferred_definitions(pool, schema, tables):
+    '''Drop the constraints and indexes of `tables` and return their
+       (table, definition SQL) to be rebuilt after the load, foreign keys last.'''
+    constraints_sql = '''
+        SELECT cl.relname, con.conname, pg_get_constraintdef(con.oid), con.contype
+        FROM pg_constraint con
+        JOIN pg_class cl ON cl.oid = con.conrelid
+        JOIN pg_namespace n ON n.oid = cl.relnamespace
+        WHERE n.nspname = %s
+        AND cl.relname = ANY(%s)
+        AND con.contype IN ('p', 'u', 'f', 'x');
+    '''
+    indexes_sql = '''
+        SELECT tablename, indexname, indexdef
+        FROM pg_indexes
+        WHERE schemaname = %s
+        AND tablename = ANY(%s);
+    '''
+    definitions, foreign_keys = [], []
+    drops, drop_fks = [], []
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(constraints_sql, [schema, list(tables)])
+            constraint_names = set()
+            for table, name, definition, contype in cur.fetchall():
+                constraint_names.add(name)
+                qualified = '{schema}.{table}'.format(schema=_quote(schema), table=_quote(table))
+                add_sql = 'ALTER TABLE {table} ADD CONSTRAINT {name} {definition};'.format(
+                    table=qualified, name=_quote(name), definition=definition)
+                drop_sql = 'ALTER TABLE {table} DROP CONSTRAINT {name};'.format(
+                    table=qualified, name=_quote(name))
+                if contype == 'f':
+                    foreign_keys.append((table, add_sql))
+                    drop_fks.append(drop_sql)
+                else:
+                    definitions.append((table, add_sql))
+                    drops.append(drop_sql)
+            cur.execute(indexes_sql, [schema, list(tables)])
+            for table, name, definition in cur.fetchall():
+                if name in constraint_names:
+                    continue
+                definitions.append((table, definition + ';'))
+                drops.append('DROP INDEX {schema}.{name};'.format(schema=_quote(schema),
+                                                                   name=_quote(name)))
+            for sql in drop_fks + drops:
+                cur.execute(sql)
+        conn.commit()
+    return definitions + foreign_keys
+
+
+def restore_indexes(schema, tables):
+    '''Primary keys and source database indexes for tables the restore created.'''
+    definitions = []
+    for table in tables:
+        qualified = '{schema}.{table}'.format(schema=_quote(schema), table=_quote(table))
+        definitions.append((table, 'ALTER TABLE {table} ADD PRIMARY KEY (id);'.format(table=qualified)))
+        for cols in RESTORE_INDEXES.get(table, []):
+            definitions.append((table, 'CREATE INDEX ON {table} ({cols});'.format(table=qualified,
+                                                                                  cols=cols)))
+    return definitions
+
+
+def build_deferred(pool, workers, stats, definitions):
+    '''Build the deferred indexes and constraints of each table concurrently,
+       then its foreign keys.'''
+    by_table, foreign_keys = {}, []
+    for table, sql in definitions:
+        if 'FOREIGN KEY' in sql:
+            foreign_keys.append((table, sql))
+        else:
+            by_table.setdefault(table, []).append(sql)
+
+    def _build(table, sqls):
+        with pool.connection() as conn:
+            with conn.cursor() as cur:
+                for sql in sqls:
+                    t0 = time.time()
+                    cur.execute(sql)
+                    stats[table].index_seconds += time.time() - t0
+            conn.commit()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_build, table, sqls) for table, sqls in by_table.items()]
+        for future in futures:
+            future.result()
+    for table, sql in foreign_keys:
+        _build(table, [sql])
+
+
+def finish_tables(pool, schema, tables):
+    '''Advance the id sequences past the restored rows and analyze the tables.'''
+    with pool.connection() as conn:
+        old_autocommit = conn.autocommit
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                for table in tables:
+                    qualified = '{schema}.{table}'.format(schema=_quote(schema), table=_quote(table))
+                    cur.execute('SELECT pg_get_serial_sequence(%s, %s);', [qualified, 'id'])
+                    sequence, = cur.fetchone()
+                    if sequence:
+                        cur.execute('''SELECT setval(%s, (SELECT MAX(id) FROM {table}));'''.format(
+                            table=qualified), [sequence])
+                    cur.execute('ANALYZE {table};'.format(table=qualified))
+        finally:
+            conn.autocommit = old_autocommit
+
+
+class PsqlDumpSource(object):
+    '''The CREATE TABLE statements and COPY blocks of a `.psql.gz` dump.'''
+
+    def __init__(self, fp):
+        self.fp = fp
+
+    def _rename(self, line, schema, pos):
+        words = line.split(' ')
+        table = words[pos].split('.')[-1].strip('"')
+        words[pos] = '{schema}.{table}'.format(schema=_quote(schema), table=_quote(table))
+        return table, ' '.join(words)
+
+    def load(self, schema, prepare, loader, stats, chunk_bytes=CHUNK_BYTES):
+        '''Stream the dump once: `prepare(create_sqls)` is called before the
+           first COPY block, whose rows are then submitted in chunks.'''
+        create_sqls = {}
+        create_table = None
+        prepared = False
+        sql, chunk, chunk_size, rows = None, [], 0, 0
+        with gzip.open(self.fp, 'rb') as dump_f:
+            for line in dump_f:
+                if sql:
+                    if line.startswith(b'\\.'):
+                        if chunk:
+                            loader.submit(copy_chunk, loader.pool, table_stats, sql, b''.join(chunk), rows)
+                        sql, chunk, chunk_size, rows = None, [], 0, 0
+                        continue
+                    chunk.append(line)
+                    chunk_size += len(line)
+                    rows += 1
+                    if chunk_size >= chunk_bytes:
+                        loader.submit(copy_chunk, loader.pool, table_stats, sql, b''.join(chunk), rows)
+                        chunk, chunk_size, rows = [], 0, 0
+                    continue
+
+                text = line.decode()
+                if create_table is not None:
+                    create_sqls[create_table].append(text)
+                    if text.startswith(');'):
+                        create_table = None
+                elif text.startswith('CREATE TABLE '):
+                    create_table, text = self._rename(text, schema, 2)
+                    create_sqls[create_table] = [text]
+                elif text.startswith('COPY '):
+                    if not prepared:
+                        prepare({table: ''.join(lines) for table, lines in create_sqls.items()})
+                        prepared = True
+                    table, text = self._rename(text, schema, 1)
+                    table_stats = stats.setdefault(table, TableStats(table))
+                    sql = text.strip()
+
+
+class SQLiteSource(object):
+    '''The mobile tables of a `.sqlite` export, read in id ranges. SQLite
+       formats each row as a line of COPY text so the reads run outside the GIL.'''
+
+    def __init__(self, fp):
+        self.fp = fp
+
+    def _connect(self):
+        return sqlite3.connect('file:{fp}?mode=ro'.format(fp=self.fp), uri=True)
+
+    def tables(self):
+        '''Return the (name, SQLite type) columns of each mobile table in the export.'''
+        conn = self._connect()
+        tables = {}
+        for table in RESTORE_TABLES:
+            columns = [(row[1], row[2]) for row in
+                       conn.execute('PRAGMA table_info({table});'.format(table=table))
+                       if (table, row[1]) not in SQLITE_DERIVED_COLUMNS]
+            if columns:
+                tables[table] = columns
+        conn.close()
+        return tables
+
+    def create_sql(self, schema, table, columns):
+        col_strs = []
+        for name, sqlite_type in columns:
+            pg_type = SQLITE_COLUMN_TYPES.get(name) or SQLITE_POSTGRES_TYPES.get(sqlite_type, 'text')
+            col_strs.append('{name} {type}'.format(name=_quote(name), type=pg_type))
+        return 'CREATE TABLE {schema}.{table} ({cols});'.format(
+            schema=_quote(schema), table=_quote(table), cols=', '.join(col_strs))
+
+    def _line_expr(self, columns):
+        exprs = []
+        for name, sqlite_type in columns:
+            col = _quote(name)
+            if sqlite_type in ('INTEGER', 'REAL'):
+                expr = 'CAST({col} AS TEXT)'.format(col=col)
+            else:
+                expr = col
+                for char, escaped in COPY_ESCAPES:
+                    expr = "REPLACE({expr}, {char}, '{escaped}')".format(expr=expr, char=char,
+                                                                        escaped=escaped)
+            exprs.append("COALESCE({expr}, '\\N')".format(expr=expr))
+        return ' || char(9) || '.join(exprs)
+
+    def _copy_range(self, pool, stats, sql, table, columns, start, end):
+        conn = self._connect()
+        select_sql = '''
+            SELECT {line}
+            FROM {table}
+            WHERE id >= ? AND id < ?;
+        '''.format(line=self._line_expr(columns), table=table)
+        lines = [line for line, in conn.execute(select_sql, [start, end])]
+        conn.close()
+        if lines:
+            lines.append('')
+            copy_chunk(pool, stats, sql, '\n'.join(lines).encode(), len(lines) - 1)
+
+    def load(self, schema, loader, stats, range_rows=RANGE_ROWS):
+        conn = self._connect()
+        for table, columns in self.tables().items():
+            min_id, max_id = conn.execute('SELECT MIN(id), MAX(id) FROM {table};'.format(
+                table=table)).fetchone()
+            if min_id is None:
+                continue
+            table_stats = stats.setdefault(table, TableStats(table))
+            sql = _copy_sql(schema, table, [name for name, _ in columns])
+            for start in range(min_id, max_id + 1, range_rows):
+                loader.submit(self._copy_range, loader.pool, table_stats, sql, table, columns,
+                              start, start + range_rows)
+        conn.close()
+
+
+def _build_deferred(pool, workers, stats, deferred):
+    for table in set(table for table, _ in deferred):
+        stats.setdefault(table, TableStats(table))
+    build_deferred(pool, workers, stats, deferred)
+
+
+def restore(pool, archive_fp, schema='public', workers=4, chunk_bytes=CHUNK_BYTES):
+    '''Restore the mobile tables of a survey archive into `schema` and return
+       the TableStats of each table.'''
+    stats = {}
+    loader = ChunkLoader(pool, workers)
+    deferred = []
+
+    def _prepare(create_sqls):
+        existing = existing_tables(pool, schema, create_sqls)
+        created = [table for table in create_sqls if table not in existing]
+        create_tables(pool, schema, [create_sqls[table] for table in created])
+        empty = [table for table, is_empty in existing.items() if is_empty]
+        if empty:
+            deferred.extend(deferred_definitions(pool, schema, empty))
+        deferred.extend(restore_indexes(schema, created))
+        for table in existing:
+            if not existing[table]:
+                logger.info('{table} already has rows: loading with its indexes in place'.format(
+                    table=table))
+
+    tmp_dir = None
+    try:
+        if archive_fp.endswith('.psql.gz'):
+            PsqlDumpSource(archive_fp).load(schema, _prepare, loader, stats, chunk_bytes=chunk_bytes)
+        elif archive_fp.endswith(('.sqlite', '.sqlite.gz')):
+            if archive_fp.endswith('.gz'):
+                # SQLite needs random access: decompress next to the archive first
+                tmp_dir = tempfile.mkdtemp(prefix='restore-', dir=os.path.dirname(archive_fp) or '.')
+                sqlite_fp = os.path.join(tmp_dir, os.path.basename(archive_fp)[:-len('.gz')])
+                with gzip.open(archive_fp, 'rb') as gz_f, open(sqlite_fp, 'wb') as sqlite_f:
+                    shutil.copyfileobj(gz_f, sqlite_f)
+                archive_fp = sqlite_fp
+            source = SQLiteSource(archive_fp)
+            tables = source.tables()
+            _prepare({table: source.create_sql(schema, table, columns)
+                      for table, columns in tables.items()})
+            source.load(schema, loader, stats)
+        else:
+            raise ValueError('Cannot restore {fp}: expected a .psql.gz, .sqlite or .sqlite.gz'.format(
+                fp=archive_fp))
+        loader.join()
+    except Exception:
+        # the dropped indexes and constraints of existing tables were committed,
+        # so put them back before giving up on the load
+        loader.abort()
+        if deferred:
+            logger.error('Restore of {fp} failed: rebuilding deferred indexes and constraints'.format(
+                fp=archive_fp))
+            try:
+                _build_deferred(pool, workers, stats, deferred)
+            except Exception:
+                logger.exception('Could not rebuild the deferred indexes and constraints')
+        raise
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir)
+
+    _build_deferred(pool, workers, stats, deferred)
+    finish_tables(pool, schema, stats.keys())
+    return stats
+
+
+def report(stats, seconds):
+    table = PrettyTable()
+    table.field_names = ['table', 'rows', 'MB', 'load s', 'rows/s', 'MB/s', 'index s']
+    total_rows, total_bytes = 0, 0
+    for name in RESTORE_TABLES:
+        if name not in stats:
+            continue
+        s = stats[name]
+        mb = s.bytes / 1e6
+        table.add_row([name, s.rows, round(mb, 1), round(s.seconds, 1),
+                       int(s.rows / s.seconds) if s.seconds else '-',
+                       round(mb / s.seconds, 1) if s.seconds else '-',
+                       round(s.index_seconds, 1)])
+        total_rows += s.rows
+        total_bytes += s.bytes
+    print(table)
+    print('Restored {rows} rows ({mb:.1f} MB) in {seconds:.1f}s: {rate} rows/s, {mb_rate:.1f} MB/s'.format(
+        rows=total_rows, mb=total_bytes / 1e6, seconds=seconds,
+        rate=int(total_rows / seconds) if seconds else '-',
+        mb_rate=total_bytes / 1e6 / seconds if seconds else 0.))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Restore an archived survey into PostgreSQL.')
+    parser.add_argument('archive', help='<survey>.psql.gz, <survey>.sqlite or <survey>.sqlite.gz')
+    parser.add_argument('--config', default=CFG_FN,
+                        help='JSON config with a `restore_db` section for the target database')
+    parser.add_argument('--schema', default='public', help='schema to restore the tables into')
+    parser.add_argument('--workers', type=int, default=4, help='parallel COPY connections')
+    parser.add_argument('--chunk-mb', type=float, default=CHUNK_BYTES / float(1 << 20),
+                        help='size of the .psql.gz COPY chunks')
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as cfg_f:
+        cfg = json.load(cfg_f)
+    if 'restore_db' not in cfg:
+        parser.error('{fn} has no `restore_db` section'.format(fn=args.config))
+    pool = ConnectionPool(**cfg['restore_db'], maxconn=args.workers,
+                          application_name=APPLICATION_NAME + '-restore',
+                          health_check=False)
+    logger.info('Restoring {fp} into {db} ({schema}) with {workers} workers...'.format(
+        fp=args.archive, db=cfg['restore_db']['dbname'], schema=args.schema,
+        workers=args.workers))
+    t0 = time.time()
+    try:
+        stats = restore(pool, args.archive, schema=args.schema, workers=args.workers,
+                        chunk_bytes=int(args.chunk_mb * (1 << 20)))
+    finally:
+        pool.closeall()
+    report(stats, time.time() - t0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+# Seekable copies of a survey's coordinates.csv, prompt_responses.csv and
+# cancelled_prompts.csv (`<survey>-seekable/`). Rows are sorted by uuid and
+# time and written as independently gzip-compressed frames of about
+# `frame_bytes` of CSV, so each file is still a plain .csv.gz, and `index.json`
+# maps each uuid and week to the frames holding its rows. One participant's
+# trace, or one of their weeks, is then a single ranged read of the file,
+# locally or with an S3 range GET.
+#
+# Query a local directory or its cold storage copy:
+#   python3 seekable.py output/<survey>-seekable --table coordinates --uuid <uuid>
+#   python3 seekable.py s3://<bucket>/<survey>-seekable --table coordinates \
+#       --uuid <uuid> --week 2018-05-07 [--endpoint-url http://localhost:9000]
+import argparse
+import calendar
+import csv
+from datetime import datetime
+import gzip
+import heapq
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import zlib
+
+import boto3
+
+import checksums
+
+
+INDEX_FN = 'index.json'
+FRAME_BYTES = 1 << 20
+RUN_ROWS = 500000
+# weeks start on Mondays: the epoch was a Thursday
+BUCKET_SECONDS = 7 * 86400
+BUCKET_ORIGIN = 4 * 86400
+# table -> (csv in the survey's -csv directory, column of the row's time)
+TABLES = {
+    'coordinates': ('coordinates.csv', 'timestamp_epoch'),
+    'prompt_responses': ('prompt_responses.csv', 'displayed_at_epoch'),
+    'cancelled_prompts': ('cancelled_prompts.csv', 'displayed_at_epoch')
+}
+
+
+def bucket(epoch):
+    '''Start (epoch seconds) of the week containing `epoch`.'''
+    return (epoch - BUCKET_ORIGIN) // BUCKET_SECONDS * BUCKET_SECONDS + BUCKET_ORIGIN
+
+
+def _epoch(value):
+    return int(value) if value else 0
+
+
+def sorted_rows(csv_fp, time_col, run_rows=RUN_ROWS, tmp_dir=None):
+    '''Read a CSV and return its header and rows sorted by (uuid, time). Runs
+       of `run_rows` rows are sorted in memory and spilled to temporary files
+       which are then merged, so memory is bounded by the run size.'''
+    csv_f = open(csv_fp, 'r', newline='')
+    reader = csv.reader(csv_f)
+    header = next(reader)
+    time_idx = header.index(time_col)
+
+    def _key(row):
+        return row[0], _epoch(row[time_idx])
+
+    run_fps = []
+    run = []
+    run_dir = tempfile.mkdtemp(prefix='seekable-', dir=tmp_dir)
+    try:
+        for row in reader:
+            run.append(row)
+            if len(run) == run_rows:
+                run.sort(key=_key)
+                run_fp = os.path.join(run_dir, '{n}.csv'.format(n=len(run_fps)))
+                with open(run_fp, 'w', newline='') as run_f:
+                    csv.writer(run_f).writerows(run)
+                run_fps.append(run_fp)
+                run = []
+        csv_f.close()
+        run.sort(key=_key)
+        if not run_fps:
+            yield header
+            yield from run
+            return
+        run_fs = [open(fp, 'r', newline='') for fp in run_fps]
+        try:
+            yield header
+            yield from heapq.merge(*[csv.reader(f) for f in run_fs], run, key=_key)
+        finally:
+            for f in run_fs:
+                f.close()
+    finally:
+        csv_f.close()
+        shutil.rmtree(run_dir)
+
+
+class FrameWriter(object):
+    '''Write CSV rows as a multi-member .csv.gz of frames of about
+       `frame_bytes` uncompressed, recording which frames hold the rows of
+       each uuid and week. The header is the first line of the first frame.
+       `bytes` counts the CSV written and, once closed, `compressed_bytes` and
+       `sha256` describe the file.'''
+
+    def __init__(self, fp, header, time_col, frame_bytes=FRAME_BYTES, level=6):
+        self.header = header
+        self.time_col = time_col
+        self.frame_bytes = frame_bytes
+        self.level = level
+        self.rows = 0
+        self.frames = []
+        self.keys = {}
+        self._time_idx = header.index(time_col)
+        self.bytes = 0
+        self.compressed_bytes = None
+        self.sha256 = None
+        self._f = checksums.HashingWriter(open(fp, 'wb'))
+        self._buffer = io.StringIO()
+        self._writer = csv.writer(self._buffer)
+        self._writer.writerow(header)
+        self._frame_rows = 0
+
+    def write(self, row):
+        uuid, week = row[0], bucket(_epoch(row[self._time_idx]))
+        frame = len(self.frames)
+        entries = self.keys.setdefault(uuid, [])
+        if entries and entries[-1][0] == week:
+            entries[-1][2] = frame
+            entries[-1][3] += 1
+        else:
+            entries.append([week, frame, frame, 1])
+        self._writer.writerow(row)
+        self._frame_rows += 1
+        self.rows += 1
+        if self._buffer.tell() >= self.frame_bytes:
+            self._flush()
+
+    def _flush(self):
+        data = self._buffer.getvalue().encode()
+        if not data:
+            return
+        self.bytes += len(data)
+        frame = gzip.compress(data, self.level)
+        self.frames.append([self._f.tell(), len(frame), self._frame_rows])
+        self._f.write(frame)
+        self._buffer.seek(0)
+        self._buffer.truncate()
+        self._frame_rows = 0
+
+    def close(self):
+        '''Write the last frame and return the table's index entry.'''
+        self._flush()
+        self.compressed_bytes = self._f.bytes
+        self.sha256 = self._f.sha256
+        self._f.close()
+        return {
+            'header': self.header,
+            'time_col': self.time_col,
+            'rows': self.rows,
+            'frames': self.frames,
+            'keys': self.keys
+        }
+
+
+def build(csv_dir, seekable_dir, frame_bytes=FRAME_BYTES, run_rows=RUN_ROWS, manifest=None):
+    '''Write seekable .csv.gz copies of a survey's -csv directory tables and
+       their index.json to `seekable_dir`. Returns the rows written, appending
+       a manifest entry for each file to `manifest` when given.'''
+    if os.path.exists(seekable_dir):
+        shutil.rmtree(seekable_dir)
+    os.mkdir(seekable_dir)
+    seekable_fn = os.path.basename(seekable_dir.rstrip('/'))
+    index = {
+        'version': 1,
+        'bucket_seconds': BUCKET_SECONDS,
+        'bucket_origin': BUCKET_ORIGIN,
+        'tables': {}
+    }
+    rows = 0
+    for table, (csv_fn, time_col) in sorted(TABLES.items()):
+        csv_fp = os.path.join(csv_dir, csv_fn)
+        if not os.path.exists(csv_fp):
+            continue
+        fn = csv_fn + '.gz'
+        sorted_csv = sorted_rows(csv_fp, time_col, run_rows=run_rows, tmp_dir=seekable_dir)
+        header = next(sorted_csv)
+        writer = FrameWriter(os.path.join(seekable_dir, fn), header, time_col,
+                             frame_bytes=frame_bytes)
+        for row in sorted_csv:
+            writer.write(row)
+        index['tables'][table] = dict(writer.close(), file=fn)
+        rows += writer.rows
+        if manifest is not None:
+            manifest.append(checksums.manifest_entry('{dir}/{fn}'.format(dir=seekable_fn, fn=fn),
+                                                     writer.rows, writer.bytes,
+                                                     writer.compressed_bytes, writer.sha256))
+    with open(os.path.join(seekable_dir, INDEX_FN), 'wb') as index_f:
+        hashed_f = checksums.HashingWriter(index_f)
+        hashed_f.write(json.dumps(index).encode())
+    if manifest is not None:
+        manifest.append(checksums.manifest_entry('{dir}/{fn}'.format(dir=seekable_fn, fn=INDEX_FN),
+                                                 None, hashed_f.bytes, hashed_f.bytes,
+                                                 hashed_f.sha256))
+    return rows
+
+
+class LocalSource(object):
+    def __init__(self, path):
+        self.path = path
+
+    def read(self, fn, start=None, end=None):
+        with open(os.path.join(self.path, fn), 'rb') as f:
+            if start is None:
+                return f.read()
+            f.seek(start)
+            return f.read(end - start)
+
+
+class S3Source(object):
+    '''Read a seekable directory uploaded to `s3://<bucket>/<prefix>` with range
+       GETs; `endpoint_url` points at an S3-compatible stand-in.'''
+
+    def __init__(self, url, endpoint_url=None, client=None):
+        bucket_name, _, prefix = url[len('s3://'):].partition('/')
+        self.bucket = bucket_name
+        self.prefix = prefix.strip('/')
+        self.client = client or boto3.client('s3', endpoint_url=endpoint_url)
+        self.requests = 0
+
+    def read(self, fn, start=None, end=None):
+        kwargs = {'Bucket': self.bucket, 'Key': '/'.join(filter(None, [self.prefix, fn]))}
+        if start is not None:
+            kwargs['Range'] = 'bytes={start}-{end}'.format(start=start, end=end - 1)
+        self.requests += 1
+        return self.client.get_object(**kwargs)['Body'].read()
+
+
+def open_source(path, endpoint_url=None):
+    if path.startswith('s3://'):
+        return S3Source(path, endpoint_url=endpoint_url)
+    return LocalSource(path)
+
+
+def load_index(source):
+    return json.loads(source.read(INDEX_FN).decode())
+
+
+def _frame_ranges(table_index, uuid=None, start=None, end=None):
+    '''Frame spans [first, last] holding the rows of `uuid` (or every uuid)
+       with a week overlapping [start, end], adjacent spans merged.'''
+    bucket_end = BUCKET_SECONDS - 1
+    spans = []
+    keys = table_index['keys']
+    for key_uuid in ([uuid] if uuid is not None else sorted(keys)):
+        for week, first, last, _ in keys.get(key_uuid, []):
+            if start is not None and week + bucket_end < start:
+                continue
+            if end is not None and week > end:
+                continue
+            spans.append([first, last])
+    spans.sort()
+    merged = []
+    for first, last in spans:
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    return merged
+
+
+def _decompress_members(data):
+    text = []
+    while data:
+        decompressor = zlib.decompressobj(wbits=31)
+        text.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+    return b''.join(text).decode()
+
+
+def query(source, table, uuid=None, start=None, end=None, index=None):
+    '''Return the header and rows of `table` for `uuid` (or all users) with a
+       time within [start, end] epoch seconds, reading one byte range per run
+       of adjacent frames: a single read for one uuid, or one uuid's week.'''
+    index = index or load_index(source)
+    table_index = index['tables'][table]
+    frames = table_index['frames']
+    time_idx = table_index['header'].index(table_index['time_col'])
+    rows = []
+    for first, last in _frame_ranges(table_index, uuid, start, end):
+        data = source.read(table_index['file'], frames[first][0],
+                           frames[last][0] + frames[last][1])
+        reader = csv.reader(io.StringIO(_decompress_members(data)))
+        if first == 0:
+            next(reader)
+        for row in reader:
+            if uuid is not None and row[0] != uuid:
+                continue
+            epoch = _epoch(row[time_idx])
+            if (start is None or epoch >= start) and (end is None or epoch <= end):
+                rows.append(row)
+    return table_index['header'], rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Extract rows from a seekable survey archive.')
+    parser.add_argument('path', help='<survey>-seekable directory or s3://<bucket>/<survey>-seekable')
+    parser.add_argument('--table', choices=sorted(TABLES), default='coordinates')
+    parser.add_argument('--uuid')
+    parser.add_argument('--week', help='date within the week to extract (weeks start on Monday)')
+    parser.add_argument('--start', type=int, help='first epoch second to include')
+    parser.add_argument('--end', type=int, help='last epoch second to include')
+    parser.add_argument('--endpoint-url', help='S3-compatible endpoint, e.g. a local stand-in')
+    args = parser.parse_args()
+
+    start, end = args.start, args.end
+    if args.week:
+        day = datetime.strptime(args.week, '%Y-%m-%d')
+        start = bucket(calendar.timegm(day.timetuple()))
+        end = start + BUCKET_SECONDS - 1
+    source = open_source(args.path, endpoint_url=args.endpoint_url)
+    header, rows = query(source, args.table, uuid=args.uuid, start=start, end=end)
+    writer = csv.writer(sys.stdout)
+    writer.writerow(header)
+    writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    main()
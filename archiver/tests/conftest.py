@@ -0,0 +1,28 @@
+# The archiver's modules import each other by name from the `archiver`
+# directory, so put it on the path wherever pytest is run from.
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import psycopg2
+import pytest
+
+
+@pytest.fixture
+def pg_cfg():
+    '''Connection settings of the local PostgreSQL from the standard PGHOST,
+       PGPORT, PGUSER, PGPASSWORD and PGDATABASE variables (default
+       postgres@localhost:5432/postgres); skip the test if it is unreachable.'''
+    cfg = {
+        'host': os.environ.get('PGHOST', 'localhost'),
+        'port': os.environ.get('PGPORT', '5432'),
+        'user': os.environ.get('PGUSER', 'postgres'),
+        'password': os.environ.get('PGPASSWORD', ''),
+        'dbname': os.environ.get('PGDATABASE', 'postgres')
+    }
+    try:
+        psycopg2.connect(connect_timeout=3, **cfg).close()
+    except psycopg2.OperationalError as e:
+        pytest.skip('no local PostgreSQL: {e}'.format(e=str(e).strip()))
+    return cfg
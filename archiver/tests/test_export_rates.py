@@ -0,0 +1,34 @@
+# Project export throughput from the `export_metrics` of previous runs, with
+# surveys exported on their own and in batches.
+from database import ExportsDatabase
+from metrics import METRICS_COLS
+
+
+def _exports_db(tmp_path, records):
+    exports_db = ExportsDatabase(str(tmp_path / 'exports.sqlite'))
+    exports_db.create_export_metrics_table()
+    exports_db.upsert_many('export_metrics', METRICS_COLS, records)
+    return exports_db
+
+
+def test_rates_without_history(tmp_path):
+    exports_db = _exports_db(tmp_path, [])
+    assert exports_db.fetch_export_rates() == (None, None)
+    exports_db.close()
+
+
+def test_rates_count_batch_stages(tmp_path):
+    # (run, survey id, survey name, stage, started, ended, rows, read, written, compressed)
+    exports_db = _exports_db(tmp_path, [
+        (1, 1, 'large', 'sqlite', 0., 10., 1000, 0, 0, 0),
+        (1, 1, 'large', 'compress', 10., 20., 0, 400, 0, 100),
+        (1, None, None, 'batch_sqlite', 20., 25., 2000, 0, 0, 0),
+        (1, None, None, 'batch_csv', 25., 30., 2000, 0, 0, 0),
+        (1, 2, 'small', 'compress', 30., 40., 0, 600, 0, 100),
+        # run-level stages are not part of any survey's export
+        (1, None, None, 'vacuum', 40., 1000., 0, 0, 0, 0)
+    ])
+    rows_per_second, compression_ratio = exports_db.fetch_export_rates()
+    assert rows_per_second == 3000 / 40.
+    assert compression_ratio == 200 / 1000.
+    exports_db.close()
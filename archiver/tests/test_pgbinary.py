@@ -0,0 +1,240 @@
+# Decode binary COPY streams built in memory, then copy the same PostgreSQL
+# rows to SQLite through the default, `raw_types` and `binary_copy` fetches and
+# check they store the same values. The database tests use the local PostgreSQL
+# of the `pg_cfg` fixture and run in their own schema, dropped afterwards.
+from datetime import datetime, timedelta
+import json
+import sqlite3
+import struct
+import uuid
+
+import pytest
+import pytz
+
+import database
+from database import ConnectionPool
+import fileio
+import pgbinary
+
+
+def _copy_stream(rows, codes):
+    '''Encode rows as PostgreSQL sends them for `COPY ... (FORMAT binary)`.'''
+    data = bytearray(pgbinary.SIGNATURE + struct.pack('>ii', 0, 0))
+    for row in rows:
+        data += struct.pack('>h', len(row))
+        for value, code in zip(row, codes):
+            if value is None:
+                data += struct.pack('>i', -1)
+            elif code == 's':
+                encoded = value.encode('utf-8')
+                data += struct.pack('>i', len(encoded)) + encoded
+            else:
+                field = pgbinary.FIELD_STRUCTS[code]
+                data += struct.pack('>i', field.size) + field.pack(value)
+    data += struct.pack('>h', -1)
+    return bytes(data)
+
+
+def _microseconds(dt):
+    return (dt - pgbinary.POSTGRES_EPOCH) // timedelta(microseconds=1)
+
+
+SUMMER = datetime(2018, 5, 7, 10, 0, 0, 500000, tzinfo=pytz.UTC)
+WINTER = datetime(2018, 1, 7, 10, 0, tzinfo=pytz.UTC)
+# every fixed-width code, so rows without NULLs take the single-struct path
+FIXED_CODES = ['i', 'd', '?', 't', 'z']
+FIXED_ROWS = [
+    [1, 45.5, True, _microseconds(SUMMER), -4 * 3600],
+    [2, -73.25, False, _microseconds(WINTER), -5 * 3600],
+    [3, 0.0, True, pgbinary.TIMESTAMP_INFINITY, None],
+    [4, 1e-300, False, pgbinary.TIMESTAMP_NEG_INFINITY, None]
+]
+FIXED_DECODED = [
+    [1, 45.5, True, '2018-05-07 06:00:00.500000-04:00'],
+    [2, -73.25, False, '2018-01-07 05:00:00-05:00'],
+    [3, 0.0, True, '9999-12-31 23:59:59.999999+00:00'],
+    [4, 1e-300, False, '0001-01-01 00:00:00+00:00']
+]
+
+
+def _decode(data, block_size):
+    decoder = pgbinary.BinaryCopyDecoder(FIXED_CODES)
+    rows = []
+    for start in range(0, len(data), block_size):
+        rows.extend(decoder.feed(data[start:start + block_size]))
+    assert decoder.finished
+    return rows
+
+
+def test_decode_fixed_rows():
+    data = _copy_stream(FIXED_ROWS, FIXED_CODES)
+    assert _decode(data, len(data)) == FIXED_DECODED
+
+
+@pytest.mark.parametrize('block_size', [1, 7, 19, 64])
+def test_decode_rows_split_across_feeds(block_size):
+    # header, row and field boundaries all land mid-buffer
+    data = _copy_stream(FIXED_ROWS, FIXED_CODES)
+    assert _decode(data, block_size) == FIXED_DECODED
+
+
+def test_decode_nulls():
+    rows = [
+        [None, 1.5, True, _microseconds(SUMMER), -4 * 3600],
+        [2, None, None, None, None],
+        [3, 2.5, False, _microseconds(WINTER), -5 * 3600]
+    ]
+    data = _copy_stream(rows, FIXED_CODES)
+    assert _decode(data, 5) == [
+        [None, 1.5, True, '2018-05-07 06:00:00.500000-04:00'],
+        [2, None, None, None],
+        [3, 2.5, False, '2018-01-07 05:00:00-05:00']
+    ]
+
+
+def test_decode_text_and_several_timestamps():
+    codes = ['i', 's', 't', 'z', 's', 't', 'z']
+    rows = [
+        [1, 'é\t\\', _microseconds(SUMMER), -4 * 3600, '{"a": [1]}', _microseconds(WINTER), 0],
+        [2, '', None, None, None, _microseconds(SUMMER), 3600]
+    ]
+    decoder = pgbinary.BinaryCopyDecoder(codes)
+    data = _copy_stream(rows, codes)
+    decoded = decoder.feed(data[:30]) + decoder.feed(data[30:])
+    assert decoded == [
+        [1, 'é\t\\', '2018-05-07 06:00:00.500000-04:00', '{"a": [1]}', '2018-01-07 10:00:00+00:00'],
+        [2, '', None, None, '2018-05-07 11:00:00.500000+01:00']
+    ]
+
+
+def test_format_timestamp_matches_psycopg2():
+    # a pre-1883 Montreal time has the local mean time offset, with seconds
+    lmt = datetime(1850, 1, 1, tzinfo=pytz.UTC)
+    offset = -(5 * 3600 + 17 * 60 + 32)
+    assert pgbinary.format_timestamp(_microseconds(lmt), offset) == '1849-12-31 18:42:28-05:17:32'
+
+
+def test_decode_rejects_other_streams():
+    decoder = pgbinary.BinaryCopyDecoder(FIXED_CODES)
+    with pytest.raises(ValueError):
+        decoder.feed(b'id,timestamp\n1,2018-05-07\n')
+
+
+def test_copy_columns_adds_offsets():
+    select_cols, codes = pgbinary.copy_columns([('id', 'integer'),
+                                                ('response', 'jsonb'),
+                                                ('timestamp', 'timestamp with time zone')])
+    assert select_cols == ['id', 'response::text', 'timestamp',
+                           'EXTRACT(TIMEZONE FROM timestamp)::integer']
+    assert codes == ['i', 's', 't', 'z']
+
+
+TABLE = 'pgbinary_rows'
+TABLE_SQL = '''
+    CREATE TABLE {schema}.{table} (
+        id integer PRIMARY KEY,
+        survey_id integer,
+        label character varying(36),
+        latitude numeric(16,10),
+        speed double precision,
+        is_travelling boolean,
+        response jsonb,
+        timestamp timestamp with time zone
+    );
+'''
+TIMESTAMPS = [
+    '2018-05-07 10:00:00.5+00',
+    '2018-01-07 10:00:00+00',
+    '2018-11-04 05:30:00+00',
+    '1850-01-01 00:00:00+00',
+    'infinity',
+    '-infinity',
+    None
+]
+
+
+@pytest.fixture
+def source(pg_cfg):
+    '''An `ItinerumDatabase` in Montreal time with the test table on its path.'''
+    schema = 'pgbinary_test_{hex}'.format(hex=uuid.uuid4().hex[:12])
+    pool = ConnectionPool(maxconn=2, health_check=False, **pg_cfg)
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute('CREATE SCHEMA {schema};'.format(schema=schema))
+            cur.execute(TABLE_SQL.format(schema=schema, table=TABLE))
+            for n, timestamp in enumerate(TIMESTAMPS, start=1):
+                cur.execute('''
+                    INSERT INTO {schema}.{table} VALUES (%s, 1, %s, %s, %s, %s, %s, %s);
+                '''.format(schema=schema, table=TABLE),
+                    [n, None if n == 2 else 'user-é{n}'.format(n=n),
+                     None if n == 3 else '45.{n}123456789'.format(n=n),
+                     None if n == 4 else n / 3.,
+                     None if n == 5 else n % 2 == 0,
+                     None if n == 6 else json.dumps({'answer': [n, 'é'], 'ok': True}),
+                     timestamp])
+        conn.commit()
+    source_db = database.ItinerumDatabase(pool_cfg={'maxconn': 2, 'health_check': False}, **pg_cfg)
+    source_db._query("SET TIME ZONE 'America/Montreal';")
+    source_db._query('SET search_path TO {schema};'.format(schema=schema))
+    source_db._db_conn.commit()
+    try:
+        yield source_db
+    finally:
+        source_db._db_conn.rollback()
+        source_db._query('RESET ALL;')
+        source_db._db_conn.commit()
+        source_db.close()
+        with pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute('DROP SCHEMA {schema} CASCADE;'.format(schema=schema))
+            conn.commit()
+        pool.closeall()
+
+
+def _sqlite_rows(source_db, fp, fetch):
+    '''Copy the test table into SQLite as `archiver.copy_psql_sqlite` does and
+       read the stored values back.'''
+    cols = source_db.table_schema(TABLE)
+    dest_db = fileio.SQLiteDatabase(fp)
+    dest_db.generate_table(TABLE, cols)
+    for rows in fetch(cols):
+        dest_db.insert_many(TABLE, cols, rows)
+    del dest_db
+    conn = sqlite3.connect(fp)
+    rows = conn.execute('SELECT * FROM {table} ORDER BY id;'.format(table=TABLE)).fetchall()
+    conn.close()
+    return [row[:6] + (json.loads(row[6]) if row[6] else None,) + row[7:] for row in rows]
+
+
+def test_fetch_paths_store_the_same_values(source, tmp_path):
+    default = _sqlite_rows(source, str(tmp_path / 'default.sqlite'), lambda cols: (
+        [database.format_sqlite_row(row, ['response'], ['latitude']) for row in rows]
+        for rows in source.select_all_chunks(TABLE, 1, chunk_size=3)))
+    raw = _sqlite_rows(source, str(tmp_path / 'raw.sqlite'), lambda cols: (
+        source.select_all_raw_chunks(TABLE, 1, [name for name, _ in cols], chunk_size=3)))
+    binary = _sqlite_rows(source, str(tmp_path / 'binary.sqlite'), lambda cols: (
+        source.copy_binary_chunks(TABLE, 1, source.table_types(TABLE), batch_size=3,
+                                  buffer_size=64)))
+
+    assert len(default) == len(TIMESTAMPS)
+    assert [row[7] for row in default[:4]] == ['2018-05-07 06:00:00.500000-04:00',
+                                              '2018-01-07 05:00:00-05:00',
+                                              '2018-11-04 01:30:00-04:00',
+                                              '1849-12-31 18:42:28-05:17:32']
+    assert raw == default
+    assert binary == default
+
+
+def test_binary_copy_outlives_statement_timeout(pg_cfg):
+    pool = ConnectionPool(maxconn=1, statement_timeout=100, health_check=False, **pg_cfg)
+    try:
+        with pool.connection() as conn:
+            sql = 'COPY (SELECT 1 FROM pg_sleep(0.5)) TO STDOUT (FORMAT binary);'
+            assert list(pgbinary.stream_copy(conn, sql, ['i'])) == [[[1]]]
+            # the pool's timeout applies again after the COPY
+            with conn.cursor() as cur:
+                cur.execute('SHOW statement_timeout;')
+                assert cur.fetchone()[0] == '100ms'
+            conn.rollback()
+    finally:
+        pool.closeall()
@@ -0,0 +1,110 @@
+# Read the mobile tables of a `.sqlite.gz` export through `reader.open_bundle`,
+# on its own and inside a cold storage `.zip` beside the `.psql.gz` dump.
+from datetime import datetime, timedelta
+import gzip
+import json
+import os
+import zipfile
+
+import pytest
+import pytz
+
+import fileio
+import reader
+
+
+START = datetime(2018, 5, 7, 10, 0, tzinfo=pytz.UTC)
+USERS = ['user-1', 'user-2', 'user-3']
+
+
+def _write_sqlite(fp):
+    '''A .sqlite export of three users, two coordinates each, as written by
+       `archiver.copy_psql_sqlite` and indexed like the `sqlite_indexes` option.'''
+    db = fileio.SQLiteDatabase(fp)
+    tables = [
+        ('mobile_users', [('id', 'INTEGER'), ('uuid', 'TEXT'), ('created_at', 'DATETIME')],
+         [[n, uuid, str(START + timedelta(days=n))] for n, uuid in enumerate(USERS, start=1)]),
+        ('mobile_survey_responses', [('id', 'INTEGER'), ('mobile_id', 'INTEGER'), ('response', 'TEXT')],
+         [[n, n, json.dumps({'member_type': n, 'note': 'é'})] for n in range(1, len(USERS) + 1)]),
+        ('mobile_coordinates', [('id', 'INTEGER'), ('mobile_id', 'INTEGER'), ('latitude', 'REAL'),
+                                ('longitude', 'REAL'), ('timestamp', 'DATETIME')],
+         [[2 * (n - 1) + i + 1, n, 45.5 + n / 10., -73.6, str(START + timedelta(hours=n, minutes=i))]
+          for n in range(1, len(USERS) + 1) for i in range(2)]),
+        ('mobile_cancelled_prompt_responses', [('id', 'INTEGER'), ('mobile_id', 'INTEGER'),
+                                               ('is_travelling', 'INTEGER'), ('displayed_at', 'DATETIME')],
+         [[1, 2, 1, str(START)], [2, 3, 0, None]])
+    ]
+    for table, cols, rows in tables:
+        db.generate_table(table, cols)
+        db.insert_many(table, cols, rows)
+    db.index_coordinates()
+    del db
+    archive_fp, _ = fileio.create_archive(fp)
+    return archive_fp
+
+
+def _write_psql(fp):
+    '''A .psql.gz dump of the same users, without mobile_survey_responses.'''
+    with gzip.open(fp, 'wt') as dump_f:
+        dump_f.write('CREATE TABLE public.mobile_users (\n'
+                     '    id integer,\n'
+                     '    uuid character varying(36),\n'
+                     '    created_at timestamp with time zone\n'
+                     ');\n\n'
+                     'COPY public.mobile_users (id, uuid, created_at) FROM stdin;\n')
+        for n, uuid in enumerate(USERS, start=1):
+            dump_f.write('{n}\t{uuid}\t{ts}\n'.format(n=n, uuid=uuid, ts=START + timedelta(days=n)))
+        dump_f.write('\\.\n\n')
+    return fp
+
+
+def test_sqlite_bundle(tmp_path):
+    fp = _write_sqlite(str(tmp_path / 'survey.sqlite'))
+    with reader.open_bundle(fp) as bundle:
+        assert bundle.tables == reader.SQLITE_TABLES
+        responses = list(bundle.rows('mobile_survey_responses', columns=['mobile_id', 'response']))
+        assert responses == [(n, {'member_type': n, 'note': 'é'}) for n in range(1, 4)]
+
+        points = list(bundle.rows('mobile_coordinates', columns=['id', 'latitude', 'timestamp'],
+                                  uuids=['user-2']))
+        assert points == [(3, 45.7, START + timedelta(hours=2)),
+                          (4, 45.7, START + timedelta(hours=2, minutes=1))]
+        start = (START + timedelta(hours=2, minutes=1)).timestamp()
+        end = (START + timedelta(hours=3)).timestamp()
+        assert [row[0] for row in bundle.rows('mobile_coordinates', start=start, end=end)] == [4, 5]
+
+        cancelled = list(bundle.rows('mobile_cancelled_prompt_responses',
+                                     columns=['is_travelling', 'displayed_at']))
+        assert cancelled == [(True, START), (False, None)]
+        with pytest.raises(KeyError):
+            list(bundle.rows('mobile_survey_responses', start=start))
+        tmp_dir = bundle._tmp_dir
+        assert os.path.isdir(tmp_dir)
+    assert not os.path.exists(tmp_dir)
+
+
+def test_zip_reads_survey_responses_from_sqlite(tmp_path):
+    sqlite_fp = _write_sqlite(str(tmp_path / 'survey.sqlite'))
+    psql_fp = _write_psql(str(tmp_path / 'survey.psql.gz'))
+    zip_fp = str(tmp_path / 'survey.zip')
+    with zipfile.ZipFile(zip_fp, 'w') as zip_f:
+        zip_f.write(sqlite_fp, arcname='survey.sqlite.gz')
+        zip_f.write(psql_fp, arcname='survey.psql.gz')
+
+    with reader.open_bundle(zip_fp) as bundle:
+        assert bundle.tables == reader.PSQL_TABLES + ['mobile_survey_responses']
+        users = list(bundle.rows('mobile_users', columns=['id'], uuids=['user-3']))
+        assert users == [(3,)]
+        # the dump is read without decompressing the .sqlite.gz
+        assert bundle._sqlite is None
+        responses = list(bundle.rows('mobile_survey_responses', columns=['response'],
+                                     uuids=['user-1', 'user-3']))
+        assert responses == [({'member_type': 1, 'note': 'é'},), ({'member_type': 3, 'note': 'é'},)]
+
+
+def test_psql_bundle_has_no_survey_responses(tmp_path):
+    fp = _write_psql(str(tmp_path / 'survey.psql.gz'))
+    with reader.open_bundle(fp) as bundle:
+        assert 'mobile_survey_responses' not in bundle.tables
+        with pytest.raises(KeyError):
+            list(bundle.rows('mobile_survey_responses'))
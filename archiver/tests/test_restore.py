@@ -0,0 +1,325 @@
+# Restore a small `.psql.gz` dump and `.sqlite` export into a local PostgreSQL
+# and check the rows, primary keys, indexes, constraints and id sequences. The
+# database is read from the standard PGHOST, PGPORT, PGUSER, PGPASSWORD and
+# PGDATABASE variables (default postgres@localhost:5432/postgres); each test
+# restores into its own schema, dropped afterwards. Tests are skipped when no
+# database is reachable.
+from datetime import datetime, timedelta
+import gzip
+import json
+import uuid
+
+import psycopg2
+import pytest
+import pytz
+
+from database import ConnectionPool
+import fileio
+import restore
+
+
+START = datetime(2018, 5, 7, 10, 0, tzinfo=pytz.UTC)
+USERS = 20
+POINTS = 50
+# (table, [(column, PostgreSQL type, SQLite type)]) as exported for a survey
+TABLES = [
+    ('mobile_users', [('id', 'integer', 'INTEGER'),
+                      ('survey_id', 'integer', 'INTEGER'),
+                      ('uuid', 'character varying(36)', 'TEXT'),
+                      ('created_at', 'timestamp with time zone', 'DATETIME')]),
+    ('mobile_survey_responses', [('id', 'integer', 'INTEGER'),
+                                 ('survey_id', 'integer', 'INTEGER'),
+                                 ('mobile_id', 'integer', 'INTEGER'),
+                                 ('response', 'jsonb', 'TEXT')]),
+    ('mobile_coordinates', [('id', 'integer', 'INTEGER'),
+                            ('survey_id', 'integer', 'INTEGER'),
+                            ('mobile_id', 'integer', 'INTEGER'),
+                            ('latitude', 'numeric(16,10)', 'REAL'),
+                            ('longitude', 'numeric(16,10)', 'REAL'),
+                            ('timestamp', 'timestamp with time zone', 'DATETIME')]),
+    ('mobile_prompt_responses', [('id', 'integer', 'INTEGER'),
+                                 ('survey_id', 'integer', 'INTEGER'),
+                                 ('mobile_id', 'integer', 'INTEGER'),
+                                 ('response', 'jsonb', 'TEXT'),
+                                 ('displayed_at', 'timestamp with time zone', 'DATETIME')]),
+    ('mobile_cancelled_prompt_responses', [('id', 'integer', 'INTEGER'),
+                                           ('survey_id', 'integer', 'INTEGER'),
+                                           ('mobile_id', 'integer', 'INTEGER'),
+                                           ('is_travelling', 'boolean', 'INTEGER'),
+                                           ('displayed_at', 'timestamp with time zone', 'DATETIME')])
+]
+# tables of the .psql.gz dump, which leaves out mobile_survey_responses
+DUMP_TABLES = ['mobile_users', 'mobile_coordinates', 'mobile_prompt_responses',
+               'mobile_cancelled_prompt_responses']
+# tables with serial ids, indexes and constraints like the source database
+SOURCE_SCHEMA_SQL = '''
+    CREATE TABLE {schema}.mobile_users (
+        id serial PRIMARY KEY,
+        survey_id integer NOT NULL,
+        uuid character varying(36) UNIQUE,
+        created_at timestamp with time zone
+    );
+    CREATE INDEX ON {schema}.mobile_users (survey_id);
+    CREATE TABLE {schema}.mobile_coordinates (
+        id serial PRIMARY KEY,
+        survey_id integer,
+        mobile_id integer REFERENCES {schema}.mobile_users (id),
+        latitude numeric(16,10),
+        longitude numeric(16,10),
+        timestamp timestamp with time zone
+    );
+    CREATE INDEX ON {schema}.mobile_coordinates (mobile_id);
+    CREATE INDEX ON {schema}.mobile_coordinates (survey_id, id);
+'''
+
+
+def _rows():
+    rows = {table: [] for table, _ in TABLES}
+    for n in range(1, USERS + 1):
+        # a tab and a backslash in the first uuid exercise COPY escaping
+        user_uuid = 'user\t\\{n:02d}'.format(n=n) if n == 1 else str(uuid.UUID(int=n))
+        created_at = None if n == 2 else START + timedelta(hours=n)
+        rows['mobile_users'].append([n, 1, user_uuid, created_at])
+        rows['mobile_survey_responses'].append([n, 1, n, {'member_type': n % 3,
+                                                           'note': 'line\nbreak'}])
+        for i in range(POINTS):
+            rows['mobile_coordinates'].append([(n - 1) * POINTS + i + 1, 1, n,
+                                               45.5 + i / 1000., -73.6 - n / 1000.,
+                                               START + timedelta(minutes=i)])
+        rows['mobile_prompt_responses'].append([n, 1, n, {'answer': [n, 'é']},
+                                                START + timedelta(days=1)])
+        rows['mobile_cancelled_prompt_responses'].append([n, 1, n, n % 2 == 0,
+                                                          START + timedelta(days=2)])
+    return rows
+
+
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, dict):
+        value = json.dumps(value)
+    elif isinstance(value, bool):
+        value = 't' if value else 'f'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
+
+
+def write_dump(fp, rows, bad_row=None):
+    '''Write `rows` as `fileio.dump_psql_copy_tables` does: pg_dump's output for
+       the temporary copy tables, renamed to the original tables.'''
+    columns = dict(TABLES)
+    with gzip.open(fp, 'wt') as dump_f:
+        dump_f.write('--\n-- PostgreSQL database dump\n--\n\n'
+                     'SET statement_timeout = 0;\n'
+                     'SET standard_conforming_strings = on;\n'
+                     "SELECT pg_catalog.set_config('search_path', '', false);\n\n")
+        for table in DUMP_TABLES:
+            dump_f.write('CREATE TABLE public.{table} (\n{cols}\n);\n\n\n'.format(
+                table=table,
+                cols=',\n'.join('    {name} {type}'.format(name=name, type=pg_type)
+                                for name, pg_type, _ in columns[table])))
+            dump_f.write('ALTER TABLE public.{table} OWNER TO postgres;\n\n'.format(table=table))
+        for table in DUMP_TABLES:
+            dump_f.write('COPY public.{table} ({cols}) FROM stdin;\n'.format(
+                table=table, cols=', '.join(name for name, _, _ in columns[table])))
+            table_rows = rows[table] + ([bad_row] if bad_row and table == 'mobile_coordinates' else [])
+            for row in table_rows:
+                dump_f.write('\t'.join(_copy_value(v) for v in row) + '\n')
+            dump_f.write('\\.\n\n\n')
+        dump_f.write('--\n-- PostgreSQL database dump complete\n--\n\n')
+
+
+def write_sqlite(fp, rows):
+    '''Write `rows` as `archiver.copy_psql_sqlite` does, then index the
+       coordinates like the `sqlite_indexes` option.'''
+    dest_db = fileio.SQLiteDatabase(fp)
+    for table, columns in TABLES:
+        sqlite_cols = [(name, sqlite_type) for name, _, sqlite_type in columns]
+        dest_db.generate_table(table, sqlite_cols)
+        dest_db.insert_many(table, sqlite_cols,
+                            [[json.dumps(v) if isinstance(v, dict)
+                              else int(v) if isinstance(v, bool)
+                              else str(v) if isinstance(v, datetime) else v for v in row]
+                             for row in rows[table]])
+    dest_db.index_coordinates()
+    del dest_db
+
+
+@pytest.fixture
+def target(pg_cfg):
+    pool = ConnectionPool(maxconn=4, health_check=False, **pg_cfg)
+    schema = 'restore_test_{hex}'.format(hex=uuid.uuid4().hex[:12])
+    try:
+        yield pool, schema
+    finally:
+        with pool.connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute('DROP SCHEMA IF EXISTS {schema} CASCADE;'.format(schema=schema))
+            conn.commit()
+        pool.closeall()
+
+
+def _fetch(pool, sql, params=None):
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql, params)
+            rows = [list(row) for row in cur.fetchall()]
+        conn.rollback()
+    return rows
+
+
+def _indexes(pool, schema, table):
+    '''Return the primary key columns and the set of other indexed columns.'''
+    sql = '''
+        SELECT i.indisprimary, array_agg(a.attname::text ORDER BY k.ord)
+        FROM pg_index i
+        JOIN pg_class t ON t.oid = i.indrelid
+        JOIN pg_namespace n ON n.oid = t.relnamespace
+        CROSS JOIN LATERAL unnest(i.indkey) WITH ORDINALITY AS k(attnum, ord)
+        JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum
+        WHERE n.nspname = %s
+        AND t.relname = %s
+        GROUP BY i.indexrelid, i.indisprimary;
+    '''
+    primary_key, indexes = None, set()
+    for is_primary, cols in _fetch(pool, sql, [schema, table]):
+        if is_primary:
+            primary_key = cols
+        else:
+            indexes.add(tuple(cols))
+    return primary_key, indexes
+
+
+def _definitions(pool, schema, tables=('mobile_users', 'mobile_coordinates')):
+    '''The constraint and index definitions of `tables` in `schema`.'''
+    constraints = _fetch(pool, '''
+        SELECT cl.relname, con.conname, pg_get_constraintdef(con.oid)
+        FROM pg_constraint con
+        JOIN pg_class cl ON cl.oid = con.conrelid
+        JOIN pg_namespace n ON n.oid = cl.relnamespace
+        WHERE n.nspname = %s
+        AND cl.relname = ANY(%s);
+    ''', [schema, list(tables)])
+    indexes = _fetch(pool, '''
+        SELECT tablename, indexname, indexdef
+        FROM pg_indexes
+        WHERE schemaname = %s
+        AND tablename = ANY(%s);
+    ''', [schema, list(tables)])
+    return sorted(map(tuple, constraints)), sorted(map(tuple, indexes))
+
+
+def _create_source_tables(pool, schema):
+    with pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute('CREATE SCHEMA {schema};'.format(schema=schema))
+            cur.execute(SOURCE_SCHEMA_SQL.format(schema=schema))
+        conn.commit()
+
+
+def _check_rows(pool, schema, rows, tables, stats):
+    for table in tables:
+        count, = _fetch(pool, 'SELECT COUNT(*) FROM {schema}.{table};'.format(
+            schema=schema, table=table))[0]
+        assert count == len(rows[table])
+        assert stats[table].rows == len(rows[table])
+    restored = _fetch(pool, 'SELECT id, uuid, created_at FROM {schema}.mobile_users ORDER BY id;'.format(
+        schema=schema))
+    assert restored == [row[:1] + row[2:] for row in rows['mobile_users']]
+
+
+def _check_created_indexes(pool, schema, tables):
+    for table in tables:
+        primary_key, indexes = _indexes(pool, schema, table)
+        assert primary_key == ['id']
+        assert indexes == set(tuple(c.strip() for c in cols.split(','))
+                              for cols in restore.RESTORE_INDEXES[table])
+
+
+def test_restore_psql_dump(target, tmp_path):
+    pool, schema = target
+    rows = _rows()
+    fp = str(tmp_path / 'survey.psql.gz')
+    write_dump(fp, rows)
+
+    # small chunks so each table is loaded by several concurrent COPYs
+    stats = restore.restore(pool, fp, schema=schema, workers=3, chunk_bytes=512)
+
+    _check_rows(pool, schema, rows, DUMP_TABLES, stats)
+    _check_created_indexes(pool, schema, DUMP_TABLES)
+    responses = _fetch(pool, 'SELECT response FROM {schema}.mobile_prompt_responses ORDER BY id;'.format(
+        schema=schema))
+    assert [r for r, in responses] == [row[3] for row in rows['mobile_prompt_responses']]
+
+
+@pytest.mark.parametrize('compressed', [False, True])
+def test_restore_sqlite(target, tmp_path, compressed):
+    pool, schema = target
+    rows = _rows()
+    fp = str(tmp_path / 'survey.sqlite')
+    write_sqlite(fp, rows)
+    if compressed:
+        fp, _ = fileio.create_archive(fp)
+
+    stats = restore.restore(pool, fp, schema=schema, workers=3)
+
+    tables = [table for table, _ in TABLES]
+    _check_rows(pool, schema, rows, tables, stats)
+    _check_created_indexes(pool, schema, tables)
+    # derived columns of the export are left out, jsonb and booleans are typed
+    columns = _fetch(pool, '''
+        SELECT table_name, column_name, data_type
+        FROM information_schema.columns
+        WHERE table_schema = %s
+        AND column_name IN ('epoch', 'response', 'is_travelling');
+    ''', [schema])
+    assert sorted(columns) == [['mobile_cancelled_prompt_responses', 'is_travelling', 'boolean'],
+                               ['mobile_prompt_responses', 'response', 'jsonb'],
+                               ['mobile_survey_responses', 'response', 'jsonb']]
+    travelling = _fetch(pool, 'SELECT is_travelling FROM {schema}.mobile_cancelled_prompt_responses '
+                              'ORDER BY id;'.format(schema=schema))
+    assert [t for t, in travelling] == [row[3] for row in rows['mobile_cancelled_prompt_responses']]
+    notes = _fetch(pool, "SELECT response->>'note' FROM {schema}.mobile_survey_responses;".format(
+        schema=schema))
+    assert set(note for note, in notes) == {'line\nbreak'}
+
+
+def test_restore_into_empty_tables(target, tmp_path):
+    pool, schema = target
+    _create_source_tables(pool, schema)
+    definitions = _definitions(pool, schema)
+    rows = _rows()
+    fp = str(tmp_path / 'survey.psql.gz')
+    write_dump(fp, rows)
+
+    stats = restore.restore(pool, fp, schema=schema, workers=3, chunk_bytes=512)
+
+    _check_rows(pool, schema, rows, DUMP_TABLES, stats)
+    # the existing tables' constraints and indexes were dropped for the load and rebuilt
+    assert _definitions(pool, schema) == definitions
+    assert any('FOREIGN KEY' in definition for _, _, definition in definitions[0])
+    _check_created_indexes(pool, schema, ['mobile_prompt_responses', 'mobile_cancelled_prompt_responses'])
+
+    # the serial sequences continue after the restored ids
+    for table in ['mobile_users', 'mobile_coordinates']:
+        last_value, = _fetch(pool, 'SELECT last_value FROM {schema}.{table}_id_seq;'.format(
+            schema=schema, table=table))[0]
+        assert last_value == len(rows[table])
+    new_id, = _fetch(pool, '''
+        INSERT INTO {schema}.mobile_users (survey_id, uuid) VALUES (1, 'new') RETURNING id;
+    '''.format(schema=schema))[0]
+    assert new_id == USERS + 1
+
+
+def test_failed_restore_rebuilds_indexes(target, tmp_path):
+    pool, schema = target
+    _create_source_tables(pool, schema)
+    definitions = _definitions(pool, schema)
+    rows = _rows()
+    fp = str(tmp_path / 'survey.psql.gz')
+    write_dump(fp, rows, bad_row=[10 ** 6, 1, 1, 'not a number', 0, START])
+
+    with pytest.raises(psycopg2.DataError):
+        restore.restore(pool, fp, schema=schema, workers=3, chunk_bytes=512)
+
+    assert _definitions(pool, schema) == definitions
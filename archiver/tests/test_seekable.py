@@ -0,0 +1,153 @@
+# Build seekable copies of a small survey's .csv files, then extract one
+# participant and one participant-week locally and through S3 range GETs
+# against a stubbed client.
+import csv
+import gzip
+import io
+import os
+
+import boto3
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+import pytest
+
+import seekable
+
+
+UUIDS = ['uuid-{n:02d}'.format(n=n) for n in range(6)]
+START = 1525651200  # Monday 2018-05-07
+HEADER = ['uuid', 'latitude', 'longitude', 'timestamp_UTC', 'timestamp_epoch']
+
+
+def _rows():
+    rows = []
+    for n, uuid in enumerate(UUIDS):
+        for i in range(120):
+            # three weeks of points per user, every ~4 hours
+            epoch = START + n * 60 + i * 4 * 3600
+            rows.append([uuid, '45.{n}{i:03d}'.format(n=n, i=i), '-73.{i:03d}'.format(i=i),
+                         'ts', str(epoch)])
+    # the exporter writes users interleaved by id, not sorted by uuid
+    rows.sort(key=lambda row: (int(row[4]) % 7, row[0]))
+    return rows
+
+
+@pytest.fixture
+def archive(tmp_path):
+    csv_dir = tmp_path / 'survey-csv'
+    csv_dir.mkdir()
+    rows = _rows()
+    with open(csv_dir / 'coordinates.csv', 'w', newline='') as csv_f:
+        writer = csv.writer(csv_f)
+        writer.writerow(HEADER)
+        writer.writerows(rows)
+    seekable_dir = str(tmp_path / 'survey-seekable')
+    manifest = []
+    built = seekable.build(str(csv_dir), seekable_dir, frame_bytes=2048, run_rows=100,
+                           manifest=manifest)
+    assert built == len(rows)
+    assert [entry['artifact'] for entry in manifest] == ['survey-seekable/coordinates.csv.gz',
+                                                         'survey-seekable/index.json']
+    return seekable_dir, rows
+
+
+def _expected(rows, uuid, start=None, end=None):
+    return sorted((row for row in rows if row[0] == uuid
+                   and (start is None or int(row[4]) >= start)
+                   and (end is None or int(row[4]) <= end)),
+                  key=lambda row: int(row[4]))
+
+
+def _week():
+    start = seekable.bucket(START + 8 * 86400)
+    return start, start + seekable.BUCKET_SECONDS - 1
+
+
+class CountingSource(seekable.LocalSource):
+    def __init__(self, path):
+        super().__init__(path)
+        self.ranges = []
+
+    def read(self, fn, start=None, end=None):
+        if start is not None:
+            self.ranges.append((fn, start, end))
+        return super().read(fn, start, end)
+
+
+def test_frames_are_a_plain_gzip_csv(archive):
+    seekable_dir, rows = archive
+    with gzip.open(os.path.join(seekable_dir, 'coordinates.csv.gz'), 'rt', newline='') as gz_f:
+        written = list(csv.reader(gz_f))
+    assert written[0] == HEADER
+    assert sorted(written[1:]) == sorted(rows)
+    index = seekable.load_index(seekable.LocalSource(seekable_dir))
+    assert len(index['tables']['coordinates']['frames']) > len(UUIDS)
+
+
+@pytest.mark.parametrize('uuid', [UUIDS[0], UUIDS[3], UUIDS[-1]])
+def test_local_user(archive, uuid):
+    seekable_dir, rows = archive
+    source = CountingSource(seekable_dir)
+    header, found = seekable.query(source, 'coordinates', uuid=uuid)
+    assert header == HEADER
+    assert found == _expected(rows, uuid)
+    assert len(source.ranges) == 1
+
+
+def test_local_user_week(archive):
+    seekable_dir, rows = archive
+    source = CountingSource(seekable_dir)
+    start, end = _week()
+    _, found = seekable.query(source, 'coordinates', uuid=UUIDS[2], start=start, end=end)
+    assert found == _expected(rows, UUIDS[2], start, end)
+    assert found
+    assert len(source.ranges) == 1
+    # a week's frames are a narrower read than the user's whole trace
+    _, week_start, week_end = source.ranges[0]
+    user_source = CountingSource(seekable_dir)
+    seekable.query(user_source, 'coordinates', uuid=UUIDS[2])
+    _, user_start, user_end = user_source.ranges[0]
+    assert week_end - week_start < user_end - user_start
+
+
+def test_unknown_user(archive):
+    seekable_dir, _ = archive
+    source = CountingSource(seekable_dir)
+    _, found = seekable.query(source, 'coordinates', uuid='missing')
+    assert found == []
+    assert source.ranges == []
+
+
+def _stub_get(stubber, seekable_dir, fn, key, start=None, end=None):
+    data = seekable.LocalSource(seekable_dir).read(fn, start, end)
+    params = {'Bucket': 'archive', 'Key': key}
+    if start is not None:
+        params['Range'] = 'bytes={start}-{end}'.format(start=start, end=end - 1)
+    stubber.add_response('get_object',
+                         {'Body': StreamingBody(io.BytesIO(data), len(data))},
+                         params)
+
+
+@pytest.mark.parametrize('week', [False, True])
+def test_s3_single_range_get(archive, week):
+    seekable_dir, rows = archive
+    uuid = UUIDS[4]
+    start, end = _week() if week else (None, None)
+
+    # the byte range a local query reads is the one expected from S3
+    local = CountingSource(seekable_dir)
+    seekable.query(local, 'coordinates', uuid=uuid, start=start, end=end)
+    (fn, range_start, range_end), = local.ranges
+
+    client = boto3.client('s3', region_name='us-east-1', aws_access_key_id='test',
+                          aws_secret_access_key='test')
+    source = seekable.S3Source('s3://archive/survey-seekable', client=client)
+    with Stubber(client) as stubber:
+        _stub_get(stubber, seekable_dir, seekable.INDEX_FN, 'survey-seekable/index.json')
+        _stub_get(stubber, seekable_dir, fn, 'survey-seekable/' + fn, range_start, range_end)
+        header, found = seekable.query(source, 'coordinates', uuid=uuid, start=start, end=end)
+        stubber.assert_no_pending_responses()
+    assert header == HEADER
+    assert found == _expected(rows, uuid, start, end)
+    # the index and a single ranged GET for the user's rows
+    assert source.requests == 2
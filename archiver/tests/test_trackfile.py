@@ -0,0 +1,134 @@
+# Write points to a `.tracks` file and read them back as `coordinates.csv` rows,
+# in one block and split across blocks, whole and filtered by user and time.
+from datetime import datetime, timedelta
+import calendar
+
+import pytest
+import pytz
+
+import trackfile
+
+
+START = datetime(2018, 5, 7, 10, 0, tzinfo=pytz.UTC)
+FLOAT_COLS = ['altitude', 'speed', 'direction', 'h_accuracy', 'v_accuracy',
+              'acceleration_x', 'acceleration_y', 'acceleration_z']
+
+
+def _point(point_id, mobile_id, minutes, n):
+    '''A point as from `fetch_coordinate_tracks`, at `minutes` after START or
+       without a timestamp when None.'''
+    timestamp = None if minutes is None else START + timedelta(minutes=minutes, microseconds=250)
+    point = {
+        'id': point_id,
+        'mobile_id': mobile_id,
+        'latitude': 45.5 + n / 1000.,
+        'longitude': -73.6 - n / 500.,
+        'mode_detected': None if n % 3 == 0 else n % 4,
+        'point_type': 1,
+        'timestamp_UTC': timestamp,
+        'timestamp_epoch': None if timestamp is None else int(timestamp.timestamp())
+    }
+    for idx, col in enumerate(FLOAT_COLS):
+        point[col] = None if n % 5 == idx else n * (idx + 1) / 4.
+    return point
+
+
+def _row(uuid, point):
+    '''The `coordinates.csv` row the point is read back as, with values
+       rounded to their column's scale.'''
+    timestamp = point['timestamp_UTC']
+    return ([uuid] +
+            [point[col] if point[col] is None or scale is None else round(point[col] * scale) / scale
+             for col, scale in trackfile.COLUMNS] +
+            [None if timestamp is None else timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+             point['timestamp_epoch']])
+
+
+def _tracks(num_users=3, num_points=10):
+    points = []
+    for mobile_id in range(1, num_users + 1):
+        for i in range(num_points):
+            point_id = len(points) + 1
+            points.append(_point(point_id, mobile_id, i * 5, point_id))
+    return points
+
+
+def _write(fp, points, **kwargs):
+    uuids = {}
+    with trackfile.TrackWriter(fp, **kwargs) as writer:
+        for point in points:
+            uuid = uuids.setdefault(point['mobile_id'], 'user-{n}'.format(n=point['mobile_id']))
+            writer.add(uuid, point)
+    return writer, [_row(uuids[p['mobile_id']], p) for p in points]
+
+
+@pytest.mark.parametrize('block_rows', [trackfile.BLOCK_ROWS, 4, 10, 1])
+def test_round_trip(tmp_path, block_rows):
+    points = _tracks()
+    fp = str(tmp_path / 'survey.tracks')
+    writer, expected = _write(fp, points, block_rows=block_rows)
+
+    assert writer.rows == len(points)
+    with trackfile.TrackReader(fp) as reader:
+        assert reader.num_rows == len(points)
+        assert reader.header == trackfile.HEADER
+        assert list(reader) == expected
+        # users never share a block and full blocks split a user's track
+        assert [block[3] for block in reader.blocks] == [
+            min(block_rows, 10 - start) for _ in range(3) for start in range(0, 10, block_rows)]
+
+
+def test_duplicates_are_skipped(tmp_path):
+    point = _point(1, 1, 0, 1)
+    duplicate = dict(point, id=2)
+    fp = str(tmp_path / 'survey.tracks')
+    with trackfile.TrackWriter(fp) as writer:
+        assert writer.add('user-1', point)
+        assert not writer.add('user-1', duplicate)
+    with trackfile.TrackReader(fp) as reader:
+        assert list(reader) == [_row('user-1', point)]
+
+
+def test_null_timestamps_sort_last(tmp_path):
+    points = [_point(1, 2, 10, 1), _point(2, 1, None, 2), _point(3, 1, 20, 3),
+              _point(4, 2, None, 4), _point(5, 1, 5, 5), _point(6, 1, None, 6)]
+    tracks = sorted(points, key=trackfile.track_order)
+    assert [p['id'] for p in tracks] == [5, 3, 2, 6, 1, 4]
+
+    fp = str(tmp_path / 'survey.tracks')
+    _, expected = _write(fp, tracks, block_rows=3)
+    with trackfile.TrackReader(fp) as reader:
+        assert list(reader) == expected
+        # the index ranges only cover known times
+        assert [block[4:] for block in reader.blocks] == [
+            [points[4]['timestamp_epoch'], points[2]['timestamp_epoch']],
+            [None, None],
+            [points[0]['timestamp_epoch'], points[0]['timestamp_epoch']]]
+        # points without a time never fall in a time range
+        assert [row[0] for row in reader.rows(start=0)] == ['user-1', 'user-1', 'user-2']
+
+
+def test_filter_by_uuid_and_time(tmp_path):
+    points = _tracks(num_users=3, num_points=20)
+    fp = str(tmp_path / 'survey.tracks')
+    _, expected = _write(fp, points, block_rows=6)
+    start = calendar.timegm((START + timedelta(minutes=22)).utctimetuple())
+    end = calendar.timegm((START + timedelta(minutes=61)).utctimetuple())
+
+    with trackfile.TrackReader(fp) as reader:
+        assert list(reader.rows(uuid='user-2')) == [row for row in expected if row[0] == 'user-2']
+        assert list(reader.rows(uuid='unknown')) == []
+        in_range = [row for row in expected if start <= row[-1] <= end]
+        # minutes 25 to 60, across three blocks of each user
+        assert len(in_range) == 3 * 8
+        assert list(reader.rows(start=start, end=end)) == in_range
+        assert list(reader.rows(uuid='user-3', start=start)) == [
+            row for row in expected if row[0] == 'user-3' and row[-1] >= start]
+        assert list(reader.rows(end=start)) == [row for row in expected if row[-1] <= start]
+
+
+def test_reader_rejects_other_files(tmp_path):
+    fp = tmp_path / 'survey.csv'
+    fp.write_text('uuid,latitude\n')
+    with pytest.raises(ValueError):
+        trackfile.TrackReader(str(fp))
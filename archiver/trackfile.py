@@ -0,0 +1,380 @@
+#!/usr/bin/env python3
+# Compact per-survey coordinates archive (`<survey>.tracks`). Points are grouped
+# into per-user tracks sorted by time and stored column by column in blocks of
+# up to `block_rows` points: latitude/longitude as fixed-point microdegrees and
+# the other sensor readings at a fixed precision, each as zigzag deltas from
+# the previous point packed at the smallest width that fits the block, and
+# epoch timestamps as deltas of deltas. Blocks are
+# zlib-compressed and listed in an index (user, epoch range, offset) at the end
+# of the file so a reader can seek to a single user's track or a time window.
+#
+# Layout: MAGIC, header length (uint32), JSON header | blocks | zlib-compressed
+# JSON index | index offset (uint64), index length (uint32), MAGIC
+#
+# Read back as `coordinates.csv` rows with:
+#   python3 trackfile.py <survey>.tracks [--uuid <uuid>] [--start <epoch>] [--end <epoch>]
+import argparse
+import calendar
+import csv
+import itertools
+import json
+import struct
+import sys
+import time
+import zlib
+
+import checksums
+
+
+MAGIC = b'ITRK'
+VERSION = 1
+BLOCK_ROWS = 8192
+LENGTH = struct.Struct('>I')
+FOOTER = struct.Struct('>QI4s')
+# columns of `coordinates.csv` as emitted by `csv_formatters.coordinate_row`
+HEADER = ['uuid', 'latitude', 'longitude', 'altitude', 'speed', 'direction',
+          'h_accuracy', 'v_accuracy', 'acceleration_x', 'acceleration_y', 'acceleration_z',
+          'mode_detected', 'point_type', 'timestamp_UTC', 'timestamp_epoch']
+# (column, scale) stored as deltas: floats are rounded to 1/scale, integer
+# columns (scale None) are stored as is
+COLUMNS = [
+    ('latitude', 10 ** 6),
+    ('longitude', 10 ** 6),
+    ('altitude', 100),
+    ('speed', 100),
+    ('direction', 100),
+    ('h_accuracy', 100),
+    ('v_accuracy', 100),
+    ('acceleration_x', 1000),
+    ('acceleration_y', 1000),
+    ('acceleration_z', 1000),
+    ('mode_detected', None),
+    ('point_type', None)
+]
+# column stream encodings and flags; the width of a column's packed values is
+# stored in the flags as an index into WIDTHS
+PLAIN, DELTA, DELTA_OF_DELTA = 0, 1, 2
+HAS_NULLS = 1
+NOT_DELTA = 2
+WIDTH_SHIFT = 4
+WIDTHS = [(1, 'B'), (2, 'H'), (4, 'I'), (8, 'Q')]
+
+
+def _zigzag(values):
+    return [v * 2 if v >= 0 else -2 * v - 1 for v in values]
+
+
+def _unzigzag(values):
+    return [(z >> 1) ^ -(z & 1) for z in values]
+
+
+def _deltas(values):
+    return [b - a for a, b in zip(itertools.chain([0], values), values)]
+
+
+def _width(zigzags):
+    largest = max(zigzags) if zigzags else 0
+    for idx, (size, _) in enumerate(WIDTHS):
+        if largest < 1 << (size * 8):
+            return idx
+    raise ValueError('Value too large for a .tracks column: {v}'.format(v=largest))
+
+
+def encode_column(out, values, encoding):
+    '''Append a column of integers (or None) to `out`: a flags byte, a null
+       bitmap when any value is None, then the zigzag integers of the non-null
+       values, deltas or deltas of deltas, packed little-endian at the width
+       of the largest with their bytes shuffled (all first bytes, then all
+       second bytes...) so the mostly-zero high bytes compress well. Noisy
+       DELTA columns whose deltas need a wider packing than the values are
+       stored plain instead.'''
+    present = [v for v in values if v is not None]
+    flags = 0
+    bitmap = b''
+    if len(present) < len(values):
+        flags |= HAS_NULLS
+        bits = bytearray((len(values) + 7) // 8)
+        for idx, v in enumerate(values):
+            if v is not None:
+                bits[idx >> 3] |= 1 << (idx & 7)
+        bitmap = bytes(bits)
+    if encoding == DELTA:
+        plain = _zigzag(present)
+        zigzags = _zigzag(_deltas(present))
+        if _width(plain) < _width(zigzags):
+            flags |= NOT_DELTA
+            zigzags = plain
+    else:
+        for _ in range(encoding):
+            present = _deltas(present)
+        zigzags = _zigzag(present)
+    width = _width(zigzags)
+    out.append(flags | width << WIDTH_SHIFT)
+    out += bitmap
+    size, code = WIDTHS[width]
+    packed = struct.pack('<{n}{code}'.format(n=len(zigzags), code=code), *zigzags)
+    for idx in range(size):
+        out += packed[idx::size]
+
+
+def decode_column(buf, pos, count, encoding):
+    '''Read a column written by `encode_column` with `count` values starting
+       at `pos`, returning (values, next pos).'''
+    flags = buf[pos]
+    pos += 1
+    present_mask = None
+    num_present = count
+    if flags & HAS_NULLS:
+        bitmap_len = (count + 7) // 8
+        bits = buf[pos:pos + bitmap_len]
+        pos += bitmap_len
+        present_mask = [bool(bits[idx >> 3] & (1 << (idx & 7))) for idx in range(count)]
+        num_present = sum(present_mask)
+    size, code = WIDTHS[flags >> WIDTH_SHIFT]
+    packed = bytearray(num_present * size)
+    for idx in range(size):
+        packed[idx::size] = buf[pos:pos + num_present]
+        pos += num_present
+    zigzags = struct.unpack('<{n}{code}'.format(n=num_present, code=code), packed)
+    present = _unzigzag(zigzags)
+    if flags & NOT_DELTA:
+        encoding = PLAIN
+    for _ in range(encoding):
+        present = list(itertools.accumulate(present))
+    if present_mask is None:
+        return present, pos
+    values = iter(present)
+    return [next(values) if is_present else None for is_present in present_mask], pos
+
+
+def _quantize(value, scale):
+    if value is None:
+        return None
+    if scale is None:
+        return int(value)
+    return int(round(float(value) * scale))
+
+
+def _utc_seconds(ts):
+    '''Whole UTC seconds of a timestamp, as truncated by `timestamp_UTC`.'''
+    if not ts:
+        return None
+    return calendar.timegm(ts.utctimetuple())
+
+
+def track_order(point):
+    '''Sort key of points in the order `TrackWriter` stores them, like
+       `ItinerumDatabase.fetch_coordinate_tracks`: by user, then time with
+       NULL timestamps last, then id.'''
+    return (point['mobile_id'], point['timestamp_UTC'] is None, point['timestamp_UTC'] or 0,
+            point['id'])
+
+
+class TrackWriter(object):
+    '''Write points to a .tracks file. Points are added with their user's uuid,
+       grouped by user and in time order (as from `ItinerumDatabase.
+       fetch_coordinate_tracks`), as mappings with the columns of
+       `fetch_coordinates_chunks`. With `skip_duplicates`, a point identical
+       to the user's previous stored point is dropped like in coordinates.csv.
+       Once closed, `sha256` holds the checksum of the file.'''
+
+    def __init__(self, fp, block_rows=BLOCK_ROWS, level=6, skip_duplicates=True):
+        self.fp = fp
+        self.block_rows = block_rows
+        self.level = level
+        self.skip_duplicates = skip_duplicates
+        self.rows = 0
+        self.uuids = []
+        self.blocks = []
+        self._uuid_idx = {}
+        self._uuid = None
+        self._points = []
+        self._last = None
+        self.sha256 = None
+        self._f = checksums.HashingWriter(open(fp, 'wb'))
+        header = json.dumps({
+            'version': VERSION,
+            'header': HEADER,
+            'columns': COLUMNS,
+            'block_rows': block_rows
+        }).encode()
+        self._f.write(MAGIC + LENGTH.pack(len(header)) + header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def add(self, uuid, point):
+        '''Add a point, returning False if it was dropped as a duplicate.'''
+        if uuid != self._uuid:
+            self._flush()
+            self._uuid = uuid
+            self._last = None
+        epoch = point['timestamp_epoch']
+        utc_seconds = _utc_seconds(point['timestamp_UTC'])
+        values = tuple(_quantize(point[col], scale) for col, scale in COLUMNS) + (
+            epoch, None if epoch is None or utc_seconds is None else utc_seconds - epoch)
+        if self.skip_duplicates and values == self._last:
+            return False
+        self._last = values
+        self._points.append(values)
+        if len(self._points) == self.block_rows:
+            self._flush()
+        return True
+
+    def _flush(self):
+        if not self._points:
+            return
+        columns = list(zip(*self._points))
+        payload = bytearray(LENGTH.pack(len(self._points)))
+        for values in columns[:len(COLUMNS)]:
+            encode_column(payload, values, DELTA)
+        epochs = columns[len(COLUMNS)]
+        encode_column(payload, epochs, DELTA_OF_DELTA)
+        encode_column(payload, columns[len(COLUMNS) + 1], PLAIN)
+        data = zlib.compress(bytes(payload), self.level)
+
+        if self._uuid not in self._uuid_idx:
+            self._uuid_idx[self._uuid] = len(self.uuids)
+            self.uuids.append(self._uuid)
+        known_epochs = [e for e in epochs if e is not None]
+        self.blocks.append([self._uuid_idx[self._uuid], self._f.tell(), len(data), len(self._points),
+                            min(known_epochs) if known_epochs else None,
+                            max(known_epochs) if known_epochs else None])
+        self._f.write(data)
+        self.rows += len(self._points)
+        self._points = []
+
+    def close(self):
+        '''Flush the last block and write the index; returns the file size.'''
+        if self._f.closed:
+            return None
+        self._flush()
+        index = zlib.compress(json.dumps({'uuids': self.uuids, 'blocks': self.blocks}).encode(),
+                              self.level)
+        index_offset = self._f.tell()
+        self._f.write(index)
+        self._f.write(FOOTER.pack(index_offset, len(index), MAGIC))
+        size = self._f.tell()
+        self.sha256 = self._f.sha256
+        self._f.close()
+        return size
+
+
+class TrackReader(object):
+    '''Read a .tracks file back into `coordinates.csv` rows, block by block.
+       Values are as exact as the column scales: a float with more decimals
+       than its scale keeps are rounded.'''
+
+    def __init__(self, fp):
+        self.fp = fp
+        self._f = open(fp, 'rb')
+        magic = self._f.read(len(MAGIC))
+        if magic != MAGIC:
+            raise ValueError('{fp} is not a .tracks file'.format(fp=fp))
+        header_len, = LENGTH.unpack(self._f.read(LENGTH.size))
+        header = json.loads(self._f.read(header_len).decode())
+        if header['version'] > VERSION:
+            raise ValueError('Unsupported .tracks version: {v}'.format(v=header['version']))
+        self.header = header['header']
+        self.columns = [tuple(col) for col in header['columns']]
+
+        self._f.seek(-FOOTER.size, 2)
+        index_offset, index_len, magic = FOOTER.unpack(self._f.read(FOOTER.size))
+        if magic != MAGIC:
+            raise ValueError('{fp} is truncated: no .tracks index'.format(fp=fp))
+        self._f.seek(index_offset)
+        index = json.loads(zlib.decompress(self._f.read(index_len)).decode())
+        self.uuids = index['uuids']
+        self.blocks = index['blocks']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def __iter__(self):
+        return self.rows()
+
+    @property
+    def num_rows(self):
+        return sum(block[3] for block in self.blocks)
+
+    def close(self):
+        self._f.close()
+
+    def _decode_block(self, uuid, data):
+        buf = zlib.decompress(data)
+        count, = LENGTH.unpack_from(buf, 0)
+        pos = LENGTH.size
+        columns = []
+        for _, scale in self.columns:
+            values, pos = decode_column(buf, pos, count, DELTA)
+            if scale is not None:
+                values = [None if v is None else v / scale for v in values]
+            columns.append(values)
+        epochs, pos = decode_column(buf, pos, count, DELTA_OF_DELTA)
+        offsets, pos = decode_column(buf, pos, count, PLAIN)
+
+        timestamps = []
+        last_seconds = last_ts = None
+        for epoch, offset in zip(epochs, offsets):
+            if epoch is None or offset is None:
+                timestamps.append(None)
+                continue
+            seconds = epoch + offset
+            if seconds != last_seconds:
+                last_seconds = seconds
+                last_ts = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(seconds))
+            timestamps.append(last_ts)
+        return [[uuid] + list(values)
+                for values in zip(*columns, timestamps, epochs)]
+
+    def rows(self, uuid=None, start=None, end=None):
+        '''Yield rows, optionally of one user's track and/or with a
+           `timestamp_epoch` within [start, end]; blocks outside the range are
+           skipped using the index.'''
+        uuid_idx = None
+        if uuid is not None:
+            if uuid not in self.uuids:
+                return
+            uuid_idx = self.uuids.index(uuid)
+        for block_uuid, offset, length, _, first_epoch, last_epoch in self.blocks:
+            if uuid_idx is not None and block_uuid != uuid_idx:
+                continue
+            if start is not None and last_epoch is not None and last_epoch < start:
+                continue
+            if end is not None and first_epoch is not None and first_epoch > end:
+                continue
+            self._f.seek(offset)
+            rows = self._decode_block(self.uuids[block_uuid], self._f.read(length))
+            if start is None and end is None:
+                yield from rows
+                continue
+            for row in rows:
+                epoch = row[-1]
+                if epoch is None:
+                    continue
+                if (start is None or epoch >= start) and (end is None or epoch <= end):
+                    yield row
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write the rows of a .tracks file as coordinates.csv.')
+    parser.add_argument('tracks')
+    parser.add_argument('--uuid')
+    parser.add_argument('--start', type=int, help='first timestamp_epoch to include')
+    parser.add_argument('--end', type=int, help='last timestamp_epoch to include')
+    args = parser.parse_args()
+
+    with TrackReader(args.tracks) as reader:
+        writer = csv.writer(sys.stdout)
+        writer.writerow(reader.header)
+        writer.writerows(reader.rows(uuid=args.uuid, start=args.start, end=args.end))
+
+
+if __name__ == '__main__':
+    main()
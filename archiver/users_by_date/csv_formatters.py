@@ -3,6 +3,7 @@
 import csv
 from datetime import datetime
 from decimal import Decimal
+import itertools
 import os
 import pytz
 import time
@@ -122,6 +123,21 @@ def group_prompt_responses(prompts):
     return labeled_prompts
 
 
+def group_sorted_prompt_responses(prompts):
+    '''Streaming `group_prompt_responses` for prompts already ordered by
+       `displayed_at_UTC`: only one group of responses is held at a time.'''
+    for displayed_at, prompt_group in itertools.groupby(prompts, key=lambda p: p['displayed_at_UTC']):
+        seen = []
+        for idx, r in enumerate(prompt_group, start=1):
+            r = dict(r)
+            answer = r['response']
+            if answer not in seen:
+                seen.append(answer)
+                # relabel num as list/array index
+                r['prompt_num'] = idx
+                yield r
+
+
 def prompt_response_row(header, response):
     response['displayed_at_UTC'] = _format_UTC_timestamp(response['displayed_at_UTC'])
     response['recorded_at_UTC'] = _format_UTC_timestamp(response['recorded_at_UTC'])
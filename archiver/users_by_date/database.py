@@ -1,17 +1,24 @@
 #!/usr/bin/env python3
 # Kyle Fitzsimmons, 2018
+from contextlib import contextmanager
 from datetime import datetime
+import io
+import itertools
 import json
 import logging
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.pool
 import pytz
 import sqlite3
+import threading
 
 
 logger = logging.getLogger(__name__)
 
 
+APPLICATION_NAME = 'itinerum-archiver'
 HARDCODED_SERVER_START_TIME = datetime(2017, 5, 1, 0, 0, 0, tzinfo=pytz.UTC)
 POSTGRES_SQLITE_TYPES = {
     'numeric': 'REAL',
@@ -22,21 +29,118 @@ POSTGRES_SQLITE_TYPES = {
     'jsonb': 'TEXT',
     'boolean': 'INTEGER'
 }
+ID_FILTER_DEFAULTS = {
+    'strategy': 'auto',
+    'array_max_ids': 10000,
+    'chunk_size': 100000
+}
+TEMP_MOBILE_IDS_TABLE = 'archiver_mobile_ids'
+# rows fetched per round trip by the server-side cursors of `_stream_query`
+STREAM_ITERSIZE = 10000
+
+
+# ConnectionPool and get_pool are kept identical to ../database.py: users_by_date
+# runs standalone from its own directory with copies of the archiver modules.
+class ConnectionPool(object):
+    '''Thread-safe pool of connections to a single PostgreSQL database. Borrowing
+       blocks once `maxconn` connections are checked out so parallel workers
+       can never open more than `maxconn` connections against production.'''
+
+    def __init__(self, host, dbname, port, user, password, minconn=1, maxconn=4,
+                 statement_timeout=None, application_name=APPLICATION_NAME,
+                 health_check=True):
+        options = None
+        if statement_timeout:
+            options = '-c statement_timeout={ms}'.format(ms=int(statement_timeout))
+        self._pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn,
+                                                          dbname=dbname,
+                                                          user=user,
+                                                          password=password,
+                                                          host=host,
+                                                          port=port,
+                                                          application_name=application_name,
+                                                          options=options,
+                                                          cursor_factory=psycopg2.extras.DictCursor)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self.health_check = health_check
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        if conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+            return False
+        if not self.health_check:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1;')
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def getconn(self):
+        self._slots.acquire()
+        try:
+            conn = self._pool.getconn()
+            if not self._healthy(conn):
+                logger.info('Replacing broken pooled connection')
+                self._pool.putconn(conn, close=True)
+                conn = self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        return conn
+
+    def putconn(self, conn):
+        try:
+            self._pool.putconn(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        self._pool.closeall()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(host, dbname, port, user, password, **pool_cfg):
+    '''Return the shared connection pool for a set of credentials, creating it
+       with `pool_cfg` (minconn, maxconn, statement_timeout, application_name,
+       health_check) on first use.'''
+    key = (host, port, dbname, user)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(host, dbname, port, user, password, **pool_cfg)
+        return _pools[key]
 
 
 class PostgreSQLDatabase(object):
 
-    def __init__(self, host, dbname, port, user, password):
-        self._db_conn = psycopg2.connect(dbname=dbname,
-                                         user=user,
-                                         password=password,
-                                         host=host,
-                                         port=port,
-                                         cursor_factory=psycopg2.extras.DictCursor)
+    def __init__(self, host, dbname, port, user, password, pool_cfg=None):
+        self._pool = get_pool(host, dbname, port, user, password, **(pool_cfg or {}))
+        self._db_conn = self._pool.getconn()
         self._db_cur = self._db_conn.cursor()
 
     def __del__(self):
-        self._db_conn.close()
+        self.close()
+
+    def close(self):
+        '''Return the borrowed connection to the shared pool.'''
+        if getattr(self, '_db_conn', None) is not None:
+            self._db_cur.close()
+            self._pool.putconn(self._db_conn)
+            self._db_conn = None
 
     def _query(self, query, params=None):
         return self._db_cur.execute(query, params)
@@ -104,8 +208,63 @@ class PostgreSQLDatabase(object):
 
 
 class ItinerumDatabase(PostgreSQLDatabase):
-    def __init__(self, host, dbname, port, user, password):
-        super().__init__(host, dbname, port, user, password)
+    def __init__(self, host, dbname, port, user, password, pool_cfg=None, id_filter_cfg=None):
+        super().__init__(host, dbname, port, user, password, pool_cfg)
+        self.id_filter_cfg = dict(ID_FILTER_DEFAULTS, **(id_filter_cfg or {}))
+        self._temp_mobile_ids = None
+        self._cursor_ids = itertools.count()
+
+    def _stream_query(self, query, params=None, itersize=STREAM_ITERSIZE):
+        '''Run `query` on a named (server-side) cursor and yield its rows,
+           fetching `itersize` at a time so only one batch is held in memory.'''
+        name = 'users_by_date_{n}'.format(n=next(self._cursor_ids))
+        with self._db_conn.cursor(name=name) as cur:
+            cur.itersize = itersize
+            cur.execute(query, params)
+            for row in cur:
+                yield row
+
+    def _load_temp_mobile_ids(self, mobile_ids):
+        '''Load `mobile_ids` into a session temp table with COPY in chunks of
+           `chunk_size` and analyze it so the planner knows its size.'''
+        ids = sorted(set(mobile_ids))
+        chunk_size = self.id_filter_cfg['chunk_size']
+        self._query('''CREATE TEMP TABLE IF NOT EXISTS {table} (id integer PRIMARY KEY);'''.format(
+            table=TEMP_MOBILE_IDS_TABLE))
+        self._query('''TRUNCATE {table};'''.format(table=TEMP_MOBILE_IDS_TABLE))
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            ids_f = io.StringIO(''.join('{}\n'.format(_id) for _id in chunk))
+            self._db_cur.copy_from(ids_f, TEMP_MOBILE_IDS_TABLE, columns=('id',))
+        self._query('''ANALYZE {table};'''.format(table=TEMP_MOBILE_IDS_TABLE))
+        self._db_conn.commit()
+        self._temp_mobile_ids = set(ids)
+
+    def _mobile_ids_filter(self, col, mobile_ids):
+        '''Return a WHERE condition restricting `col` to `mobile_ids` and its
+           query parameters. Sets of up to `array_max_ids` are bound as a single
+           array literal; larger sets are joined from a temp table. The `in_list`
+           strategy keeps the original inlined `IN (...)` list.'''
+        strategy = self.id_filter_cfg['strategy']
+        if strategy == 'auto':
+            if len(mobile_ids) <= self.id_filter_cfg['array_max_ids']:
+                strategy = 'array'
+            else:
+                strategy = 'temp_table'
+
+        if strategy == 'in_list':
+            condition = '{col} IN ({ids})'.format(col=col,
+                                                  ids=','.join([str(_id) for _id in mobile_ids]))
+            return condition, None
+        if strategy == 'array':
+            condition = '{col} = ANY(%(mobile_ids)s::integer[])'.format(col=col)
+            ids_literal = '{' + ','.join([str(_id) for _id in mobile_ids]) + '}'
+            return condition, {'mobile_ids': ids_literal}
+        if self._temp_mobile_ids != set(mobile_ids):
+            self._load_temp_mobile_ids(mobile_ids)
+        condition = '{col} IN (SELECT id FROM {table})'.format(col=col,
+                                                              table=TEMP_MOBILE_IDS_TABLE)
+        return condition, None
 
 
     def end_time(self, survey_id):
@@ -130,36 +289,37 @@ class ItinerumDatabase(PostgreSQLDatabase):
         return end
 
     def fetch_coordinates(self, mobile_ids):
+        ids_filter, params = self._mobile_ids_filter('mobile_coordinates.mobile_id', mobile_ids)
         sql = '''SELECT mobile_users.uuid, mobile_coordinates.latitude, mobile_coordinates.longitude,
                         mobile_coordinates.altitude, mobile_coordinates.speed, mobile_coordinates.direction,
                         mobile_coordinates.h_accuracy, mobile_coordinates.v_accuracy, mobile_coordinates.acceleration_x,
                         mobile_coordinates.acceleration_y, mobile_coordinates.acceleration_z, mobile_coordinates.mode_detected,
                         mobile_coordinates.point_type, mobile_coordinates.timestamp AS "timestamp_UTC",
-                        DATE_PART('epoch', mobile_coordinates.timestamp)::integer AS timestamp_epoch
+                        DATE_PART('epoch', mobile_coordinates.timestamp)::integer AS timestamp_epoch,
+                        mobile_coordinates.mobile_id
                  FROM mobile_coordinates
                  JOIN mobile_users ON (mobile_coordinates.mobile_id=mobile_users.id)
-                 WHERE mobile_coordinates.mobile_id IN ({ids});'''.format(
-            ids=','.join([str(_id) for _id in mobile_ids])
+                 WHERE {ids_filter};'''.format(
+            ids_filter=ids_filter
         )
-        self._query(sql)
-        return self._db_cur.fetchall()
+        return self._stream_query(sql, params)
 
     def fetch_cancelled_prompt_responses(self, mobile_ids):
+        ids_filter, params = self._mobile_ids_filter('mobile_users.id', mobile_ids)
         sql = '''SELECT mobile_users.uuid, mobile_cancelled_prompt_responses.prompt_uuid,
                         mobile_cancelled_prompt_responses.latitude, mobile_cancelled_prompt_responses.longitude,
                         mobile_cancelled_prompt_responses.displayed_at AS "displayed_at_UTC",
                         DATE_PART('epoch', mobile_cancelled_prompt_responses.displayed_at)::integer AS displayed_at_epoch,
                         mobile_cancelled_prompt_responses.cancelled_at AS "cancelled_at_UTC",
                         DATE_PART('epoch', mobile_cancelled_prompt_responses.cancelled_at)::integer AS cancelled_at_epoch,
-                        mobile_cancelled_prompt_responses.is_travelling
+                        mobile_cancelled_prompt_responses.is_travelling, mobile_cancelled_prompt_responses.mobile_id
                  FROM mobile_cancelled_prompt_responses
                  JOIN mobile_users ON (mobile_cancelled_prompt_responses.mobile_id=mobile_users.id)
-                 WHERE mobile_users.id IN ({ids})
+                 WHERE {ids_filter}
                  ORDER BY mobile_cancelled_prompt_responses.id;'''.format(
-            ids=','.join([str(_id) for _id in mobile_ids])
+            ids_filter=ids_filter
         )
-        self._query(sql)
-        return self._db_cur.fetchall()
+        return self._stream_query(sql, params)
 
     def fetch_survey_questions(self, survey_id):
         sql = '''
@@ -174,17 +334,18 @@ class ItinerumDatabase(PostgreSQLDatabase):
         return self._db_cur.fetchall()
 
     def fetch_survey_responses(self, mobile_ids):
+        ids_filter, params = self._mobile_ids_filter('mobile_users.id', mobile_ids)
         sql = '''SELECT *
                  FROM mobile_survey_responses
                  JOIN mobile_users ON mobile_survey_responses.mobile_id=mobile_users.id
-                 WHERE mobile_users.id IN ({ids})
+                 WHERE {ids_filter}
                  ORDER BY mobile_users.created_at;'''.format(
-            ids=','.join([str(_id) for _id in mobile_ids])
+            ids_filter=ids_filter
         )
-        self._query(sql)
-        return self._db_cur.fetchall()
+        return self._stream_query(sql, params)
 
     def fetch_prompt_responses(self, mobile_ids):
+        ids_filter, params = self._mobile_ids_filter('mobile_users.id', mobile_ids)
         sql = '''SELECT mobile_users.uuid, mobile_prompt_responses.prompt_uuid, mobile_prompt_responses.response,
                         mobile_prompt_responses.latitude, mobile_prompt_responses.longitude, 
                         mobile_prompt_responses.displayed_at AS "displayed_at_UTC",
@@ -192,15 +353,15 @@ class ItinerumDatabase(PostgreSQLDatabase):
                         mobile_prompt_responses.recorded_at AS "recorded_at_UTC",
                         DATE_PART('epoch', mobile_prompt_responses.recorded_at)::integer AS recorded_at_epoch,
                         mobile_prompt_responses.edited_at AS "edited_at_UTC",
-                        DATE_PART('epoch', mobile_prompt_responses.edited_at)::integer AS edited_at_epoch
+                        DATE_PART('epoch', mobile_prompt_responses.edited_at)::integer AS edited_at_epoch,
+                        mobile_prompt_responses.mobile_id
                  FROM mobile_prompt_responses
                  JOIN mobile_users ON (mobile_prompt_responses.mobile_id=mobile_users.id)
-                 WHERE mobile_users.id IN ({ids})
+                 WHERE {ids_filter}
                  ORDER BY mobile_prompt_responses.displayed_at, mobile_prompt_responses.prompt_uuid, mobile_prompt_responses.prompt_num;'''.format(
-            ids=','.join([str(_id) for _id in mobile_ids])
+            ids_filter=ids_filter
         )
-        self._query(sql)
-        return self._db_cur.fetchall()
+        return self._stream_query(sql, params)
 
     def get_survey_id(self, survey_name):
         sql = '''SELECT id FROM surveys WHERE name ILIKE '{name}';'''.format(name=survey_name)
@@ -236,23 +397,47 @@ class ItinerumDatabase(PostgreSQLDatabase):
         mobile_ids = [_id for _id, in self._db_cur.fetchall()]
         return mobile_ids
 
+    def latest_signups_by_jobs(self, jobs):
+        '''Resolve the users of many (survey_name, cutoff) jobs in one query,
+           returning {job index: (survey_id, mobile_ids)} for the jobs whose
+           survey exists.'''
+        values = ', '.join([self._db_cur.mogrify('(%s, %s, %s::timestamptz)',
+                                                 (idx, survey_name, cutoff)).decode()
+                            for idx, (survey_name, cutoff) in enumerate(jobs)])
+        sql = '''
+            SELECT jobs.idx, surveys.id AS survey_id, mobile_users.id AS mobile_id
+            FROM (VALUES {values}) AS jobs (idx, survey_name, cutoff)
+            JOIN surveys ON surveys.name ILIKE jobs.survey_name
+            LEFT JOIN mobile_users ON mobile_users.survey_id = surveys.id
+                                  AND mobile_users.created_at >= jobs.cutoff
+            ORDER BY jobs.idx, mobile_users.id;
+        '''.format(
+            values=values
+        )
+        self._query(sql)
+        signups = {}
+        for idx, survey_id, mobile_id in self._db_cur.fetchall():
+            _, mobile_ids = signups.setdefault(idx, (survey_id, []))
+            if mobile_id is not None:
+                mobile_ids.append(mobile_id)
+        return signups
+
     def select_all(self, table_name, mobile_ids, json_cols=None, float_cols=None):
         if table_name == 'mobile_users':
             id_col = 'id'
         else:
             id_col = 'mobile_id'
 
+        ids_filter, params = self._mobile_ids_filter(id_col, mobile_ids)
         sql = '''
             SELECT *
             FROM {table}
-            WHERE {col} IN ({ids});
+            WHERE {ids_filter};
         '''.format(
             table=table_name,
-            col=id_col,
-            ids=','.join([str(_id) for _id in mobile_ids])
+            ids_filter=ids_filter
         )
-        self._query(sql)
-        for row in self._db_cur.fetchall():
+        for row in self._stream_query(sql, params):
             if json_cols:
                 for col in json_cols:
                     row[col] = json.dumps(row[col])
@@ -1,30 +1,43 @@
 #!/usr/bin/env python3
 # Kyle Fitzsimmons, 2018
+from contextlib import ExitStack
 import csv
 import gzip
+import itertools
 import os
 import shutil
 import sqlite3
 import tarfile
 
-from sh import pg_dump
-
-
-def write_csv(fp, header, rows):
-    with open(fp, 'w') as csv_f:
-        writer = csv.writer(csv_f)
-        writer.writerow(header)
-        writer.writerows(rows)
 
+def write_csv(fp, header, rows, chunk_size=10000):
+    '''Write `rows`, which may be a generator, to `fp` in a single pass and
+       return the number of rows written.'''
     # write legacy-version encoded as Latin-1 so accents
     # display correctly on open in Excel
+    legacy_fp = None
     if 'coordinates' not in fp and 'surveys-latest_users' not in fp:
         parts = fp.rsplit('.', 1)
         legacy_fp = parts[0] + '_latin1.csv'
-        with open(legacy_fp, 'w', encoding='latin-1', errors='ignore') as csv_f:
-            writer = csv.writer(csv_f)
+
+    num_rows = 0
+    with ExitStack() as stack:
+        writers = [csv.writer(stack.enter_context(open(fp, 'w')))]
+        if legacy_fp:
+            legacy_f = stack.enter_context(open(legacy_fp, 'w', encoding='latin-1', errors='ignore'))
+            writers.append(csv.writer(legacy_f))
+        for writer in writers:
             writer.writerow(header)
-            writer.writerows(rows)
+
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            for writer in writers:
+                writer.writerows(chunk)
+            num_rows += len(chunk)
+    return num_rows
 
 
 def create_archive(fp_or_dir):
@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 # Kyle Fitzsimmons, 2018
+from concurrent.futures import ThreadPoolExecutor
+import copy
 import dateutil.parser
+import functools
 import json
 import logging
 import os
+import queue
 import shutil
+import threading
 import time
 import unicodedata
 
@@ -15,6 +20,18 @@ import fileio
 
 ## GLOBALS
 CFG_FN = './config.json'
+SQLITE_TABLES = [
+    ('mobile_users', None, None),
+    ('mobile_survey_responses', ['response'], None),
+    ('mobile_coordinates', None, ['latitude', 'longitude', 'altitude', 'speed', 'direction',
+                                  'h_accuracy', 'v_accuracy', 'acceleration_x',
+                                  'acceleration_y', 'acceleration_z']),
+    ('mobile_prompt_responses', ['response'], ['latitude', 'longitude']),
+    ('mobile_cancelled_prompt_responses', None, ['latitude', 'longitude'])
+]
+LOCATIONS_COLS = ['location_home', 'location_work', 'location_study']
+SURVEY_TIMESTAMP_COLS = ['created_at', 'modified_at']
+_DONE = object()
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -37,9 +54,9 @@ def copy_psql_sqlite(source_db, dest_db, table_name, mobile_ids, json_cols=None,
     dest_db.insert_many(table_name, cols, rows)
 
 
-def dump_csv_survey_responses(source_db, csv_dir, mobile_ids, survey_id):
-    locations_cols = ['location_home', 'location_work', 'location_study']
-    timestamp_cols = ['created_at', 'modified_at']
+def survey_responses_header(source_db, survey_id):
+    locations_cols = LOCATIONS_COLS
+    timestamp_cols = SURVEY_TIMESTAMP_COLS
     exclude_cols = ['id', 'survey_id', 'mobile_id', 'response']
 
     mobile_users_cols = [col for col in source_db.table_cols('mobile_users')
@@ -56,64 +73,85 @@ def dump_csv_survey_responses(source_db, csv_dir, mobile_ids, survey_id):
                                                    timestamp_cols,
                                                    locations_cols,
                                                    exclude_cols)
-    responses = source_db.fetch_survey_responses(mobile_ids=mobile_ids)
-    csv_rows = []
-    for user in responses:
-        survey_response = user.get('response')
-        # skip users who never completed a survey response
-        if not survey_response:
-            continue
-        row = csv_formatters.survey_response_row(header, user, timestamp_cols, locations_cols)
-        csv_rows.append(row)
+    return header
+
+
+def write_csv_survey_responses(csv_dir, header, responses):
+    def _csv_rows():
+        for user in responses:
+            survey_response = user.get('response')
+            # skip users who never completed a survey response
+            if not survey_response:
+                continue
+            yield csv_formatters.survey_response_row(header, user, SURVEY_TIMESTAMP_COLS,
+                                                     LOCATIONS_COLS)
 
     fp = os.path.join(csv_dir, 'survey_responses.csv')
-    fileio.write_csv(fp, header, csv_rows)
+    fileio.write_csv(fp, header, _csv_rows())
 
 
-def dump_csv_coordinates(source_db, csv_dir, mobile_ids):
+def dump_csv_survey_responses(source_db, csv_dir, mobile_ids, survey_id):
+    header = survey_responses_header(source_db, survey_id)
+    responses = source_db.fetch_survey_responses(mobile_ids=mobile_ids)
+    write_csv_survey_responses(csv_dir, header, responses)
+
+
+def write_csv_coordinates(csv_dir, coordinates):
     header = ['uuid', 'latitude', 'longitude', 'altitude', 'speed', 'direction',
               'h_accuracy', 'v_accuracy', 'acceleration_x', 'acceleration_y', 'acceleration_z',
               'mode_detected', 'point_type', 'timestamp_UTC', 'timestamp_epoch']
-    coordinates = source_db.fetch_coordinates(mobile_ids=mobile_ids)
-    csv_rows = []
-    last_row = None  # filters points recorded as duplicates in database
-    for point in coordinates:
-        if int(point['latitude']) == 0 and int(point['longitude'] == 0):
-            continue
-        row = csv_formatters.coordinate_row(header, point)
-        if row != last_row:
-            csv_rows.append(row)
-        last_row = row    
+
+    def _csv_rows():
+        last_row = None  # filters points recorded as duplicates in database
+        for point in coordinates:
+            if int(point['latitude']) == 0 and int(point['longitude'] == 0):
+                continue
+            row = csv_formatters.coordinate_row(header, point)
+            if row != last_row:
+                yield row
+            last_row = row
 
     fp = os.path.join(csv_dir, 'coordinates.csv')
-    fileio.write_csv(fp, header, csv_rows)
+    fileio.write_csv(fp, header, _csv_rows())
 
 
-def dump_csv_prompts(source_db, csv_dir, mobile_ids):
-    timestamp_cols = ['displayed_at', 'recorded_at', 'edited_at']
+def dump_csv_coordinates(source_db, csv_dir, mobile_ids):
+    coordinates = source_db.fetch_coordinates(mobile_ids=mobile_ids)
+    write_csv_coordinates(csv_dir, coordinates)
+
+
+def write_csv_prompts(csv_dir, prompts):
     header = ['uuid', 'prompt_uuid', 'prompt_num', 'response', 'displayed_at_UTC',
               'displayed_at_epoch', 'recorded_at_UTC', 'recorded_at_epoch',
               'edited_at_UTC', 'edited_at_epoch', 'latitude', 'longitude']
 
-    # group the prompt responses by displayed_at
-    prompts = source_db.fetch_prompt_responses(mobile_ids=mobile_ids)
-    grouped_prompts = csv_formatters.group_prompt_responses(prompts)
-    
-    csv_rows = []
-    for prompt_response in grouped_prompts:
-        row = csv_formatters.prompt_response_row(header, prompt_response)
-        csv_rows.append(row)
+    # group the prompt responses by displayed_at, which they are ordered by
+    grouped_prompts = csv_formatters.group_sorted_prompt_responses(prompts)
+    csv_rows = (csv_formatters.prompt_response_row(header, prompt_response)
+                for prompt_response in grouped_prompts)
 
     fp = os.path.join(csv_dir, 'prompt_responses.csv')
     fileio.write_csv(fp, header, csv_rows)
 
 
+def dump_csv_prompts(source_db, csv_dir, mobile_ids):
+    prompts = source_db.fetch_prompt_responses(mobile_ids=mobile_ids)
+    write_csv_prompts(csv_dir, prompts)
+
+
 def _prompt_timestamps_by_uuid(prompts):
     answered_prompt_times = {}
+    for p in _record_prompt_timestamps(prompts, answered_prompt_times):
+        pass
+    return answered_prompt_times
+
+
+def _record_prompt_timestamps(prompts, answered_prompt_times):
+    '''Pass `prompts` through, adding each displayed_at to `answered_prompt_times`.'''
     for p in prompts:
         uuid, displayed_at = p['uuid'], p['displayed_at_UTC']
         answered_prompt_times.setdefault(uuid, set()).add(displayed_at)
-    return answered_prompt_times
+        yield p
 
 
 def _duplicate_prompt_exists(cancelled, answered_prompt_times):
@@ -121,43 +159,217 @@ def _duplicate_prompt_exists(cancelled, answered_prompt_times):
     return displayed_at in answered_prompt_times.get(uuid, [])
 
 
-def dump_csv_cancelled_prompts(source_db, csv_dir, mobile_ids):
+def write_csv_cancelled_prompts(csv_dir, cancelled_prompts, answered_prompt_times):
     header = ['uuid', 'prompt_uuid', 'latitude', 'longitude', 'displayed_at_UTC', 
               'displayed_at_epoch', 'cancelled_at_UTC', 'cancelled_at_epoch',
               'is_travelling']
 
+    csv_rows = (csv_formatters.cancelled_prompt_row(header, cancelled)
+                for cancelled in cancelled_prompts
+                if not _duplicate_prompt_exists(cancelled, answered_prompt_times))
+
+    fp = os.path.join(csv_dir, 'cancelled_prompts.csv')
+    fileio.write_csv(fp, header, csv_rows)
+
+
+def dump_csv_cancelled_prompts(source_db, csv_dir, mobile_ids):
     prompts = source_db.fetch_prompt_responses(mobile_ids=mobile_ids)
     answered_prompt_times = _prompt_timestamps_by_uuid(prompts)
 
     cancelled_prompts = source_db.fetch_cancelled_prompt_responses(mobile_ids=mobile_ids)
-    csv_rows = []
-    for cancelled in cancelled_prompts:
-        if _duplicate_prompt_exists(cancelled, answered_prompt_times):
-            continue
-        row = csv_formatters.cancelled_prompt_row(header, cancelled)
-        csv_rows.append(row)
+    write_csv_cancelled_prompts(csv_dir, cancelled_prompts, answered_prompt_times)
 
-    fp = os.path.join(csv_dir, 'cancelled_prompts.csv')
-    fileio.write_csv(fp, header, csv_rows)
+
+def ascii_survey_name(survey_name):
+    '''Coerce accented survey_name to pure ASCII version appending
+       an underscore after any previously accented characters.'''
+    nfkd_form = unicodedata.normalize('NFKD', survey_name)
+    survey_name = u''.join([c if not unicodedata.combining(c)
+                            else '_' for c in nfkd_form])
+    return survey_name.replace(' ', '_').replace('\'', '')
+
+
+def fan_out(rows, route_col, routes, consumers, queue_size=4, batch_size=1000):
+    '''Stream `rows` once to several consumers: each row goes to the consumers
+       of the jobs listed in `routes` for its `route_col` mobile id. Every
+       consumer is a function taking an iterable of rows and runs on its own
+       thread behind a bounded queue, so a slow job slows the scan rather than
+       buffering it. Rows sent to more than one job are copied since the
+       formatters modify rows in place.'''
+    queues = {key: queue.Queue(maxsize=queue_size) for key in consumers}
+    errors = []
+
+    def _consume(key, fn):
+        q = queues[key]
+        done = False
+
+        def _rows():
+            nonlocal done
+            while True:
+                batch = q.get()
+                if batch is _DONE:
+                    done = True
+                    return
+                for row in batch:
+                    yield row
+
+        try:
+            fn(_rows())
+        except Exception as e:
+            errors.append(e)
+        # keep draining so the scan never blocks on a consumer that stopped
+        while not done:
+            done = q.get() is _DONE
+
+    threads = [threading.Thread(target=_consume, args=(key, fn), name='fan-out-{}'.format(key))
+               for key, fn in consumers.items()]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    batches = {key: [] for key in consumers}
+    try:
+        for row in rows:
+            for idx, key in enumerate(routes.get(row[route_col], ())):
+                batch = batches[key]
+                batch.append(row if idx == 0 else copy.copy(row))
+                if len(batch) >= batch_size:
+                    queues[key].put(batch)
+                    batches[key] = []
+        for key, batch in batches.items():
+            if batch:
+                queues[key].put(batch)
+    finally:
+        for q in queues.values():
+            q.put(_DONE)
+        for t in threads:
+            t.join()
+    if errors:
+        raise errors[0]
+
+
+def _write_sqlite_table(dest_sqlite_fp, table_name, cols, rows):
+    # opened on the consuming thread since sqlite3 connections are thread-bound
+    dest_db = fileio.SQLiteDatabase(dest_sqlite_fp)
+    dest_db.generate_table(table_name, cols)
+    dest_db.insert_many(table_name, cols, rows)
+
+
+def export_survey_jobs(cfg, survey_id, jobs):
+    '''Export every job of one survey, reading each source table once for the
+       union of the jobs' users and routing rows to each job's outputs.'''
+    source_db = database.ItinerumDatabase(**cfg['source_db'], pool_cfg=cfg.get('pool'),
+                                          id_filter_cfg=cfg.get('id_filter'))
+    try:
+        routes = {}
+        for idx, job in enumerate(jobs):
+            for mobile_id in job['mobile_ids']:
+                routes.setdefault(mobile_id, []).append(idx)
+            if not os.path.exists(job['output_dir']):
+                os.makedirs(job['output_dir'])
+            if os.path.exists(job['sqlite_fp']):
+                os.remove(job['sqlite_fp'])
+            if os.path.exists(job['csv_dir']):
+                shutil.rmtree(job['csv_dir'])
+            os.mkdir(job['csv_dir'])
+            logger.info('Export {survey} users since {cutoff} ({n} users) to {dir}'.format(
+                survey=job['survey_name'], cutoff=job['cutoff_date'], n=len(job['mobile_ids']),
+                dir=job['output_dir']))
+        mobile_ids = sorted(routes)
+        job_idxs = range(len(jobs))
+
+        for table_name, json_cols, float_cols in SQLITE_TABLES:
+            cols = source_db.table_schema(table_name)
+            id_col = 'id' if table_name == 'mobile_users' else 'mobile_id'
+            rows = source_db.select_all(table_name, mobile_ids, json_cols, float_cols)
+            fan_out(rows, id_col, routes,
+                    {idx: functools.partial(_write_sqlite_table, jobs[idx]['sqlite_fp'],
+                                            table_name, cols) for idx in job_idxs})
+
+        header = survey_responses_header(source_db, survey_id)
+        fan_out(source_db.fetch_survey_responses(mobile_ids), 'mobile_id', routes,
+                {idx: functools.partial(write_csv_survey_responses, jobs[idx]['csv_dir'], header)
+                 for idx in job_idxs})
+        fan_out(source_db.fetch_coordinates(mobile_ids), 'mobile_id', routes,
+                {idx: functools.partial(write_csv_coordinates, jobs[idx]['csv_dir'])
+                 for idx in job_idxs})
+        # prompts are read once for both their .csv and the cancelled prompts filter
+        answered_prompt_times = {}
+        prompts = _record_prompt_timestamps(source_db.fetch_prompt_responses(mobile_ids),
+                                            answered_prompt_times)
+        fan_out(prompts, 'mobile_id', routes,
+                {idx: functools.partial(write_csv_prompts, jobs[idx]['csv_dir'])
+                 for idx in job_idxs})
+        fan_out(source_db.fetch_cancelled_prompt_responses(mobile_ids), 'mobile_id', routes,
+                {idx: functools.partial(write_csv_cancelled_prompts, jobs[idx]['csv_dir'],
+                                        answered_prompt_times=answered_prompt_times)
+                 for idx in job_idxs})
+    finally:
+        source_db.close()
+
+    for job in jobs:
+        fileio.create_archive(job['sqlite_fp'])
+        fileio.create_archive(job['csv_dir'])
+
+
+def run_jobs(cfg):
+    '''Batch mode: export each (survey_name, cutoff_date) of `archive.jobs`.
+       Jobs of the same survey share their table scans, and different surveys
+       (which never share users) are exported by `archive.workers` threads.'''
+    jobs = []
+    for job_cfg in cfg['archive']['jobs']:
+        survey_name = ascii_survey_name(job_cfg['survey_name'])
+        cutoff_date = dateutil.parser.parse(job_cfg['cutoff_date'])
+        output_dir = job_cfg.get('output_dir') or os.path.join(
+            cfg['archive']['output_dir'],
+            '{survey}-{cutoff:%Y%m%d}'.format(survey=survey_name, cutoff=cutoff_date))
+        jobs.append({
+            'survey_name': job_cfg['survey_name'],
+            'cutoff_date': cutoff_date,
+            'output_dir': output_dir,
+            'sqlite_fp': os.path.join(output_dir, '{}_users.sqlite'.format(survey_name)),
+            'csv_dir': os.path.join(output_dir, '{survey}-csv_users'.format(survey=survey_name))
+        })
+
+    source_db = database.ItinerumDatabase(**cfg['source_db'], pool_cfg=cfg.get('pool'))
+    try:
+        signups = source_db.latest_signups_by_jobs([(job['survey_name'], job['cutoff_date'])
+                                                    for job in jobs])
+    finally:
+        source_db.close()
+
+    jobs_by_survey = {}
+    for idx, job in enumerate(jobs):
+        if idx not in signups:
+            raise ValueError('Survey not found: {}'.format(job['survey_name']))
+        survey_id, job['mobile_ids'] = signups[idx]
+        jobs_by_survey.setdefault(survey_id, []).append(job)
+
+    workers = cfg['archive'].get('workers', 1)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(export_survey_jobs, cfg, survey_id, survey_jobs)
+                   for survey_id, survey_jobs in jobs_by_survey.items()]
+        for future in futures:
+            future.result()
 
 
 def main():
     run_timestamp = int(time.time())
 
     cfg = load_config(CFG_FN)
-    source_db = database.ItinerumDatabase(**cfg['source_db'])
+    if cfg['archive'].get('jobs'):
+        run_jobs(cfg)
+        return
+
+    source_db = database.ItinerumDatabase(**cfg['source_db'], pool_cfg=cfg.get('pool'),
+                                          id_filter_cfg=cfg.get('id_filter'))
 
     # create output directory
     if not os.path.exists(cfg['archive']['output_dir']):
         logger.info('Creating output directory: %s' % cfg['archive']['output_dir'])
         os.mkdir(cfg['archive']['output_dir'])
 
-    # coerce accented survey_name to pure ASCII version appending
-    # an underscore after any previously accented characters
-    nfkd_form = unicodedata.normalize('NFKD', cfg['archive']['survey_name'])
-    survey_name = u''.join([c if not unicodedata.combining(c)
-                            else '_' for c in nfkd_form])
-    survey_name = survey_name.replace(' ', '_').replace('\'', '')
+    survey_name = ascii_survey_name(cfg['archive']['survey_name'])
     cutoff_date = dateutil.parser.parse(cfg['archive']['cutoff_date'])
 
     mobile_ids = source_db.latest_signups_in_survey(survey_name=cfg['archive']['survey_name'],
@@ -171,17 +383,9 @@ def main():
     logger.info('Export {survey} to {fn}'.format(survey=survey_name,
                                                  fn=dest_sqlite_fp))
     dest_db = fileio.SQLiteDatabase(dest_sqlite_fp)
-    copy_psql_sqlite(source_db, dest_db, 'mobile_users', mobile_ids)
-    copy_psql_sqlite(source_db, dest_db, 'mobile_survey_responses', mobile_ids,
-        json_cols=['response'])
-    copy_psql_sqlite(source_db, dest_db, 'mobile_coordinates', mobile_ids,
-        float_cols=[
-            'latitude', 'longitude', 'altitude', 'speed', 'direction', 'h_accuracy',
-            'v_accuracy', 'acceleration_x', 'acceleration_y', 'acceleration_z'])
-    copy_psql_sqlite(source_db, dest_db, 'mobile_prompt_responses', mobile_ids,
-        json_cols=['response'], float_cols=['latitude', 'longitude'])
-    copy_psql_sqlite(source_db, dest_db, 'mobile_cancelled_prompt_responses', mobile_ids,
-        float_cols=['latitude', 'longitude'])
+    for table_name, json_cols, float_cols in SQLITE_TABLES:
+        copy_psql_sqlite(source_db, dest_db, table_name, mobile_ids,
+                         json_cols=json_cols, float_cols=float_cols)
 
     # step 5: archive inactive surveys to .csv                 
     csv_dir_fn = '{survey}-csv_users'.format(survey=survey_name)
@@ -4,6 +4,7 @@ from datetime import datetime
 from jinja2 import Template
 
 import database
+import metrics
 
 WEBUI_TEMPLATE = '../www/status.html.tmpl'
 WEBUI_HTML = '../www/status.html'
@@ -54,10 +55,31 @@ def generate_html(exports_sqlite_fp=None):
             'survey_last_update': end_UTC
         })
 
+    run_time = None
+    run_metrics = []
+    exports_db.create_export_metrics_table()
+    metrics_rows = exports_db.fetch_export_metrics()
+    if metrics_rows:
+        run_time = datetime.utcfromtimestamp(metrics_rows[0][0]).isoformat()
+    for total in metrics.summarize(metrics_rows):
+        seconds = total['seconds']
+        run_metrics.append({
+            'stage': total['stage'],
+            'surveys': total['surveys'],
+            'seconds': round(seconds, 1),
+            'rows': total['rows'],
+            'rows_per_sec': round(total['rows'] / seconds) if seconds else None,
+            'mb_read': round(total['bytes_read'] / 1e6, 1),
+            'mb_written': round(total['bytes_written'] / 1e6, 1),
+            'mb_compressed': round(total['compressed_bytes'] / 1e6, 1)
+        })
+
     with open(WEBUI_TEMPLATE, 'r') as tmpl_f:
         template = Template(tmpl_f.read())
         rendered = template.render(archived_surveys=archived_statuses,
-                                   active_surveys=active_statuses)
+                                   active_surveys=active_statuses,
+                                   run_time=run_time,
+                                   run_metrics=run_metrics)
         write_webpage(rendered)
 
 